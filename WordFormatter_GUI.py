@@ -1,11 +1,12 @@
 import streamlit as st
+import docx
 from docx import Document
 from docx.shared import Pt
-from docx.oxml.ns import qn
+from docx.oxml.ns import qn, nsdecls
 from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
-from pathlib import Path
 import re
 import os
+import sys
 import tempfile
 import base64
 import io
@@ -14,6 +15,29 @@ import datetime
 import hashlib
 import importlib.metadata
 import shutil
+import threading
+import time
+import tracemalloc
+import zipfile
+import uuid
+import collections
+import traceback
+import sqlite3
+import contextlib
+import random
+import array
+import bisect
+import multiprocessing
+import functools
+import socket
+import atexit
+import cProfile
+import pstats
+from xml.sax.saxutils import escape as xml_escape
+from xml.etree import ElementTree
+from lxml import etree
+from docx.oxml import parse_xml
+from docx.text.paragraph import Paragraph
 
 # 检查OpenAI版本
 try:
@@ -24,7 +48,8 @@ except:
     is_old_api = False
 
 import openai
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 
 # 默认配置
 DEFAULT_CONFIG = {
@@ -37,15 +62,50 @@ DEFAULT_CONFIG = {
     "ai_settings": {
         "api_key": "",
         "model": "gpt-3.5-turbo",
-        "api_base": ""
+        "api_base": "",
+        "timeout": 60,
+        "hedge": True
     },
     "formatting": {
         "font_name": "宋体",
         "font_size": 12,
         "indent": True
+    },
+    "processing": {
+        "streaming_writer": False,
+        "archive": True,
+        "template_path": "",
+        "queue_path": "",
+        # 每个工作进程都要完整导入应用，默认不启用，在系统设置中开启
+        "process_pool": False
     }
 }
 
+# 配置项（在配置文件中的路径）与会话状态键的对应关系，初始化、保存和恢复默认设置都按这张表进行
+CONFIG_SESSION_KEYS = {
+    ("title_keywords",): "title_keywords",
+    ("image_keywords",): "image_keywords",
+    ("redundant_keywords",): "redundant_keywords",
+    ("ai_settings", "api_key"): "api_key",
+    ("ai_settings", "model"): "model",
+    ("ai_settings", "api_base"): "api_base",
+    ("ai_settings", "timeout"): "ai_timeout",
+    ("ai_settings", "hedge"): "ai_hedge",
+    ("formatting", "font_name"): "font_name",
+    ("formatting", "font_size"): "font_size",
+    ("formatting", "indent"): "indent",
+    ("processing", "streaming_writer"): "streaming_writer",
+    ("processing", "archive"): "archive_enabled",
+    ("processing", "template_path"): "template_path",
+    ("processing", "queue_path"): "queue_path",
+    ("processing", "process_pool"): "process_pool",
+}
+
+def config_value(config, path):
+    for key in path:
+        config = config[key]
+    return config
+
 # 获取配置目录
 def get_config_dir():
     if 'config_dir' in st.session_state and st.session_state.config_dir:
@@ -118,44 +178,20 @@ def init_session_state():
     config = load_config()
     
     # 设置会话状态
-    if 'title_keywords' not in st.session_state:
-        st.session_state.title_keywords = config['title_keywords']
-    if 'image_keywords' not in st.session_state:
-        st.session_state.image_keywords = config['image_keywords']
-    if 'redundant_keywords' not in st.session_state:
-        st.session_state.redundant_keywords = config['redundant_keywords']
+    for path, session_key in CONFIG_SESSION_KEYS.items():
+        if session_key not in st.session_state:
+            st.session_state[session_key] = config_value(config, path)
     if 'enable_ai' not in st.session_state:
         st.session_state.enable_ai = False
-    if 'api_key' not in st.session_state:
-        st.session_state.api_key = config['ai_settings']['api_key']
-    if 'model' not in st.session_state:
-        st.session_state.model = config['ai_settings']['model']
-    if 'api_base' not in st.session_state:
-        st.session_state.api_base = config['ai_settings']['api_base']
-    if 'font_name' not in st.session_state:
-        st.session_state.font_name = config['formatting']['font_name']
-    if 'font_size' not in st.session_state:
-        st.session_state.font_size = config['formatting']['font_size']
-    if 'indent' not in st.session_state:
-        st.session_state.indent = config['formatting']['indent']
 
 # 更新配置
 def update_config():
-    config = {
-        "title_keywords": st.session_state.title_keywords,
-        "image_keywords": st.session_state.image_keywords,
-        "redundant_keywords": st.session_state.redundant_keywords,
-        "ai_settings": {
-            "api_key": st.session_state.api_key,
-            "model": st.session_state.model,
-            "api_base": st.session_state.api_base
-        },
-        "formatting": {
-            "font_name": st.session_state.font_name,
-            "font_size": st.session_state.font_size,
-            "indent": st.session_state.indent
-        }
-    }
+    config = {}
+    for path, session_key in CONFIG_SESSION_KEYS.items():
+        section = config
+        for key in path[:-1]:
+            section = section.setdefault(key, {})
+        section[path[-1]] = st.session_state[session_key]
     return save_config(config)
 
 # 标题关键词
@@ -170,19 +206,31 @@ IMAGE_CAPTION_KEYWORDS = [
 # 系统冗余关键词
 REDUNDANT_KEYWORDS = ["发布人", "浏览数", "日期"]
 
+@functools.lru_cache(maxsize=64)
+def keyword_pattern(keywords):
+    """
+    将关键词元组编译为一个正则表达式（一次扫描匹配全部关键词），按关键词组合缓存
+    """
+    return re.compile("|".join(re.escape(k) for k in keywords)) if keywords else None
+
+def contains_keyword(text, keywords):
+    pattern = keyword_pattern(tuple(keywords))
+    return pattern is not None and pattern.search(text) is not None
+
 def is_image_caption(text, image_keywords=None):
     if image_keywords is None:
         image_keywords = st.session_state.image_keywords if hasattr(st.session_state, 'image_keywords') else DEFAULT_CONFIG["image_keywords"]
-    return any(k in text for k in image_keywords) and len(text) <= 20
+    return len(text) <= 20 and contains_keyword(text, image_keywords)
 
-def is_redundant(text):
-    redundant_kw = st.session_state.redundant_keywords if hasattr(st.session_state, 'redundant_keywords') else DEFAULT_CONFIG["redundant_keywords"]
-    return any(k in text for k in redundant_kw)
+def is_redundant(text, redundant_keywords=None):
+    if redundant_keywords is None:
+        redundant_keywords = st.session_state.redundant_keywords if hasattr(st.session_state, 'redundant_keywords') else DEFAULT_CONFIG["redundant_keywords"]
+    return contains_keyword(text, redundant_keywords)
 
 def is_title(text, title_keywords=None):
     if title_keywords is None:
         title_keywords = st.session_state.title_keywords if hasattr(st.session_state, 'title_keywords') else DEFAULT_CONFIG["title_keywords"]
-    return any(k in text for k in title_keywords) and len(text) <= 40
+    return len(text) <= 40 and contains_keyword(text, title_keywords)
 
 def normalize_review_info(text):
     pattern = re.compile(r"(一审|二审|三审)[：: ]?\s*([\u4e00-\u9fa5]{2,})")
@@ -200,407 +248,4590 @@ def set_style(p, font_name="宋体", font_size=12, bold=False, indent=True, alig
     if align_left:
         p.alignment = WD_PARAGRAPH_ALIGNMENT.LEFT
 
-def process_docx(input_path, output_path, title_keywords=None, image_keywords=None,
-                font_name="宋体", font_size=12, indent=True, progress_callback=None):
-    doc = Document(input_path)
-    new_doc = Document()
-    seen_titles = set()
-    
-    # 使用传入的关键词或默认值
-    title_kw = title_keywords if title_keywords else TITLE_KEYWORDS
-    image_kw = image_keywords if image_keywords else IMAGE_CAPTION_KEYWORDS
-    
-    total_paragraphs = len(doc.paragraphs)
+# 段落分类结果
+CATEGORY_TITLE = "title"
+CATEGORY_CAPTION = "caption_removed"
+CATEGORY_REDUNDANT = "redundant_removed"
+CATEGORY_DUPLICATE = "duplicate_title_removed"
+CATEGORY_NEAR_DUPLICATE = "near_duplicate_removed"
+CATEGORY_BYLINE = "byline"
+CATEGORY_REVIEW = "review_info"
+CATEGORY_BODY = "body"
 
-    for i, para in enumerate(doc.paragraphs):
-        # 更新进度
-        if progress_callback and total_paragraphs > 0:
-            progress_value = int((i / total_paragraphs) * 100)
-            progress_callback(progress_value, f"处理段落 {i+1}/{total_paragraphs}")
-        
-        text = para.text.strip()
-        if not text:
-            continue
-            
-        # 检查是否为图片说明
-        if is_image_caption(text, image_kw):
-            continue
-            
-        if is_redundant(text):
-            continue
-            
-        if text.startswith("[物电院]"):
-            if text not in seen_titles:
-                seen_titles.add(text)
-                p = new_doc.add_paragraph(text)
-                set_style(p, font_name="黑体", font_size=16, bold=True, indent=False, align_left=True)
-            continue
-            
-        # 检查是否为标题
-        if is_title(text, title_kw):
-            tagged = f"[物电院] {text}"
-            if tagged not in seen_titles:
-                seen_titles.add(tagged)
-                p = new_doc.add_paragraph(tagged)
-                set_style(p, font_name="黑体", font_size=16, bold=True, indent=False, align_left=True)
-            continue
-            
-        if text.startswith("（通讯员"):
-            p = new_doc.add_paragraph(text)
-            set_style(p, indent=False)
-            continue
-            
-        if any(k in text for k in ["一审", "二审", "三审"]):
-            for line in normalize_review_info(text):
-                p = new_doc.add_paragraph(line)
-                set_style(p, indent=False)
-            continue
-            
-        # 普通正文
-        p = new_doc.add_paragraph(text)
-        set_style(p, font_name=font_name, font_size=font_size, indent=indent)
-    
-    # 保存文件
-    if progress_callback:
-        progress_callback(95, "正在保存文件...")
-    
-    new_doc.save(output_path)
+# 审稿信息标记
+REVIEW_MARKERS = ["一审", "二审", "三审"]
 
-    if progress_callback:
-        progress_callback(100, "处理完成")
+def classify_paragraph(text, title_keywords, image_keywords, redundant_keywords):
+    """
+    按处理规则的先后顺序判断段落类别（标题去重在resolve_output_lines中处理）
+    """
+    if is_image_caption(text, image_keywords):
+        return CATEGORY_CAPTION
+    if is_redundant(text, redundant_keywords):
+        return CATEGORY_REDUNDANT
+    if text.startswith("[物电院]") or is_title(text, title_keywords):
+        return CATEGORY_TITLE
+    if text.startswith("（通讯员"):
+        return CATEGORY_BYLINE
+    if any(k in text for k in REVIEW_MARKERS):
+        return CATEGORY_REVIEW
+    return CATEGORY_BODY
 
-def extract_docx_text(docx_file):
+def resolve_output_lines(text, category, seen_titles):
     """
-    从docx文件中提取文本内容用于预览
+    根据段落类别生成输出文本，返回 (最终类别, 输出行列表)
     """
-    if isinstance(docx_file, str):  # 如果是文件路径
-        doc = Document(docx_file)
-    else:  # 如果是上传的文件对象
-        doc = Document(io.BytesIO(docx_file.getvalue()))
-    
-    paragraphs = []
-    for para in doc.paragraphs:
-        text = para.text.strip()
-        if text:
-            paragraphs.append(text)
-    
-    return paragraphs
+    if category == CATEGORY_TITLE:
+        tagged = text if text.startswith("[物电院]") else f"[物电院] {text}"
+        if tagged in seen_titles:
+            return CATEGORY_DUPLICATE, []
+        seen_titles.add(tagged)
+        return category, [tagged]
+    if category == CATEGORY_REVIEW:
+        return category, normalize_review_info(text)
+    if category in (CATEGORY_BYLINE, CATEGORY_BODY):
+        return category, [text]
+    return category, []
 
-def render_preview(paragraphs, max_height=400):
+def paragraph_style(category, font_name="宋体", font_size=12, indent=True):
     """
-    渲染文档预览
+    返回输出段落对应的set_style参数
     """
-    if not paragraphs:
-        st.info("无内容可预览")
-        return
-    
-    # 创建一个固定高度的容器，带滚动条
-    preview_container = st.container()
-    
-    # 在容器中使用自定义CSS创建一个可滚动的区域
-    scrollable_text = f"""
-    <div style="height: {max_height}px; overflow-y: auto; border: 1px solid #e6e6e6; padding: 15px; border-radius: 5px; background-color: #f9f9f9;">
+    if category == CATEGORY_TITLE:
+        return {"font_name": "黑体", "font_size": 16, "bold": True, "indent": False, "align_left": True}
+    if category in (CATEGORY_BYLINE, CATEGORY_REVIEW):
+        return {"indent": False}
+    return {"font_name": font_name, "font_size": font_size, "indent": indent}
+
+def resolve_keywords(title_keywords=None, image_keywords=None, redundant_keywords=None):
     """
-    
-    # 添加段落
-    for para in paragraphs[:100]:  # 限制最多显示100段，避免过大
-        if para.startswith("[物电院]") or (len(para) <= 40 and any(kw in para for kw in TITLE_KEYWORDS)):
-            # 标题样式
-            scrollable_text += f'<p style="font-weight: bold; font-size: 16px; margin-bottom: 8px;">{para}</p>'
-        else:
-            # 普通段落样式
-            scrollable_text += f'<p style="margin-bottom: 8px; text-indent: 2em;">{para}</p>'
-    
-    if len(paragraphs) > 100:
-        scrollable_text += '<p style="color: #888;">...</p>'
-    
-    scrollable_text += "</div>"
-    
-    # 显示预览
-    preview_container.markdown(scrollable_text, unsafe_allow_html=True)
+    补全未提供的关键词列表，与process_docx的默认行为一致
+    """
+    title_kw = title_keywords if title_keywords else TITLE_KEYWORDS
+    image_kw = image_keywords if image_keywords else IMAGE_CAPTION_KEYWORDS
+    if redundant_keywords is None:
+        redundant_keywords = st.session_state.redundant_keywords if hasattr(st.session_state, 'redundant_keywords') else DEFAULT_CONFIG["redundant_keywords"]
+    return title_kw, image_kw, redundant_keywords
 
-def get_binary_file_downloader_html(bin_file, file_label='文件'):
-    with open(bin_file, 'rb') as f:
-        data = f.read()
-    b64 = base64.b64encode(data).decode()
-    href = f'<a href="data:application/octet-stream;base64,{b64}" download="{os.path.basename(bin_file)}">{file_label}</a>'
-    return href
+@functools.lru_cache(maxsize=65536)
+def shingle_hash(shingle):
+    """
+    分片的64位哈希。内置hash()在每个进程中随机化，分桶结果每次运行都不同，因此使用blake2b；
+    常用汉字组成的分片大量重复，缓存结果
+    """
+    return int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "little")
 
-def process_single_file(uploaded_file, title_keywords, image_keywords, font_name, font_size, indent):
-    if uploaded_file is None:
-        return None, None
-        
-    # 创建临时文件
-    temp_input = tempfile.NamedTemporaryFile(suffix='.docx', delete=False)
-    temp_input.write(uploaded_file.getvalue())
-    temp_input.close()
-    
-    # 创建输出文件路径
-    temp_output = tempfile.NamedTemporaryFile(suffix='_标准化处理.docx', delete=False)
-    temp_output.close()
-    
-    # 处理函数
-    progress_bar = st.progress(0)
-    status_text = st.empty()
-    
-    def update_progress(value, message=""):
-        progress_bar.progress(value / 100)
-        status_text.text(message)
-    
-    try:
-        process_docx(
-            temp_input.name,
-            temp_output.name,
-            title_keywords=title_keywords,
-            image_keywords=image_keywords,
-            font_name=font_name,
-            font_size=font_size,
-            indent=indent,
-            progress_callback=update_progress
-        )
+class NearDuplicateIndex:
+    """
+    基于MinHash/LSH的近似重复索引，整批文档共享一个索引；
+    签名采用单次哈希分桶（one permutation hashing）计算，每段只与同一LSH桶中的候选比较，
+    处理时间与段落总数成线性关系
+    """
+    def __init__(self, threshold=0.8, drop=False, num_perm=64, bands=16, shingle_size=2, min_chars=8):
+        self.threshold = threshold
+        self.drop = drop
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.min_chars = min_chars
+        self.buckets = [{} for _ in range(bands)]
+        self.entries = []
+        self.indexed_counts = {}
+        self.duplicates = []
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def normalize(text):
+        text = text[len("[物电院]"):] if text.startswith("[物电院]") else text
+        return re.sub(r"[\W_]+", "", text)
+
+    def signature(self, normalized):
+        size = self.shingle_size
+        num_perm = self.num_perm
+        shingles = {normalized[i:i + size] for i in range(max(1, len(normalized) - size + 1))}
         
-        # 确保输出文件存在
-        if not os.path.exists(temp_output.name):
-            st.error("处理后的文件未成功生成")
-            return None, None
-            
-        # 返回处理后的文件和输出文件路径
-        output_paragraphs = extract_docx_text(temp_output.name)
+        # 每个分片只哈希一次：低位决定所在分桶，其余位取桶内最小值
+        empty = 1 << 64
+        slots = [empty] * num_perm
+        for sh in shingles:
+            h = shingle_hash(sh)
+            slot, value = h % num_perm, h // num_perm
+            if value < slots[slot]:
+                slots[slot] = value
         
-        # 添加调试信息
-        if not output_paragraphs:
-            st.warning("处理后的文档内容为空，请检查处理逻辑")
-            
-        return temp_output.name, output_paragraphs
-    except Exception as e:
-        st.error(f"处理出错: {str(e)}")
-        import traceback
-        st.error(f"详细错误: {traceback.format_exc()}")
-        return None, None
-    finally:
-        # 清理临时输入文件
-        if os.path.exists(temp_input.name):
-            os.unlink(temp_input.name)
+        # 空桶向右借用最近的非空桶（旋转填充），保持签名之间可比较
+        if empty in slots:
+            filled = slots[:]
+            for j in range(num_perm):
+                if slots[j] == empty:
+                    step = 1
+                    while slots[(j + step) % num_perm] == empty:
+                        step += 1
+                    filled[j] = slots[(j + step) % num_perm] + step * empty
+            slots = filled
+        return tuple(slots)
 
-def process_batch_files(uploaded_files, title_keywords, image_keywords, font_name, font_size, indent):
-    if not uploaded_files:
-        return None
-    
-    # 创建临时目录
-    temp_dir = tempfile.mkdtemp()
-    output_files = []
-    
-    # 批量处理进度条
-    batch_progress = st.progress(0)
-    file_progress = st.progress(0)
-    status_text = st.empty()
-    
-    for i, uploaded_file in enumerate(uploaded_files):
-        # 更新批量处理进度
-        batch_value = int((i / len(uploaded_files)) * 100)
-        batch_progress.progress(batch_value / 100)
-        status_text.text(f"处理文件 {i+1}/{len(uploaded_files)}: {uploaded_file.name}")
+    def _band_keys(self, signature):
+        rows = self.rows
+        return [signature[b * rows:(b + 1) * rows] for b in range(self.bands)]
+
+    def check(self, text, source, position):
+        """
+        查询并登记一个段落，若与已登记段落近似重复则返回匹配记录，否则返回None
+        """
+        normalized = self.normalize(text)
+        if len(normalized) < self.min_chars:
+            return None
+        signature = self.signature(normalized)
+        band_keys = self._band_keys(signature)
+        with self.lock:
+            return self._check_signature(text, source, position, signature, band_keys)
+
+    def add(self, text, source, position):
+        """
+        只登记段落不做检测，用于把已处理完成的文件加入索引
+        """
+        normalized = self.normalize(text)
+        if len(normalized) < self.min_chars:
+            return
+        signature = self.signature(normalized)
+        with self.lock:
+            self._insert(text, source, position, signature, self._band_keys(signature))
+
+    def _check_signature(self, text, source, position, signature, band_keys):
+        # 只在共享LSH桶的候选中估计相似度
+        best, best_similarity = None, 0.0
+        seen = set()
+        for bucket, key in zip(self.buckets, band_keys):
+            for entry_id in bucket.get(key, ()):
+                if entry_id in seen:
+                    continue
+                seen.add(entry_id)
+                # 只检测跨文件的重复，同一文件内的标题重复由seen_titles处理
+                if self.entries[entry_id][0] == source:
+                    continue
+                other = self.entries[entry_id][3]
+                similarity = sum(a == b for a, b in zip(signature, other)) / len(signature)
+                if similarity > best_similarity:
+                    best, best_similarity = entry_id, similarity
         
-        # 创建临时文件
-        temp_input = tempfile.NamedTemporaryFile(suffix='.docx', delete=False)
-        temp_input.write(uploaded_file.getvalue())
-        temp_input.close()
+        if best is not None and best_similarity >= self.threshold:
+            matched_source, matched_position, matched_text, _ = self.entries[best]
+            record = {
+                "文件": source,
+                "段落": position + 1,
+                "内容": text,
+                "重复来源": matched_source,
+                "来源段落": matched_position + 1,
+                "来源内容": matched_text,
+                "相似度": round(best_similarity, 2),
+            }
+            self.duplicates.append(record)
+            return record
         
-        # 创建输出文件路径
-        output_filename = Path(uploaded_file.name).stem + "_标准化处理.docx"
-        output_path = os.path.join(temp_dir, output_filename)
+        self._insert(text, source, position, signature, band_keys)
+        return None
+
+    def _insert(self, text, source, position, signature, band_keys):
+        entry_id = len(self.entries)
+        self.entries.append((source, position, text, signature))
+        for bucket, key in zip(self.buckets, band_keys):
+            bucket.setdefault(key, []).append(entry_id)
+        self.indexed_counts[source] = self.indexed_counts.get(source, 0) + 1
+
+    def file_overlaps(self):
+        """
+        汇总文件之间的重复段落比例，用于发现整篇转载的文章
+        """
+        pairs = {}
+        for record in self.duplicates:
+            key = (record["文件"], record["重复来源"])
+            pairs[key] = pairs.get(key, 0) + 1
+        overlaps = []
+        for (source, matched_source), count in pairs.items():
+            total = count + self.indexed_counts.get(source, 0)
+            overlaps.append({
+                "文件": source,
+                "重复来源": matched_source,
+                "重复段落数": count,
+                "重复比例": f"{count / total:.0%}",
+            })
+        return sorted(overlaps, key=lambda item: -item["重复段落数"])
+
+# python-docx自带的默认模板
+DEFAULT_TEMPLATE_PATH = os.path.join(os.path.dirname(docx.__file__), "templates", "default.docx")
+
+# Word模板（.dotx）主文档部件的内容类型，作为输出模板时改为普通文档
+TEMPLATE_MAIN_CONTENT_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.template.main+xml"
+DOCUMENT_MAIN_CONTENT_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"
+
+class DocxTemplate:
+    """
+    输出文档的模板，每个进程只载入一次：缓存主文档以外所有部件的内容，
+    以及主文档正文的开头和节属性（sectPr）；模板中原有的段落不会输出。
+    每个输出文件只需生成正文，其余部件直接写入，不再重新打开和解析模板
+    """
+    def __init__(self, path):
+        self.path = path
+        self.parts = []
+        with zipfile.ZipFile(path) as template:
+            self.document_part = self._main_document_part(template)
+            for info in template.infolist():
+                data = template.read(info)
+                if info.filename == self.document_part:
+                    document_xml = data.decode("utf-8")
+                    continue
+                if info.filename == "[Content_Types].xml":
+                    data = data.replace(TEMPLATE_MAIN_CONTENT_TYPE.encode(), DOCUMENT_MAIN_CONTENT_TYPE.encode())
+                self.parts.append((info, data))
         
-        # 文件处理进度回调
-        def update_file_progress(value, message=""):
-            file_progress.progress(value / 100)
+        # 保留模板正文的开头和节属性（sectPr），丢弃模板中原有的段落
+        body_start = re.search(r"<w:body[^>]*>", document_xml).end()
+        sect_start = document_xml.rfind("<w:sectPr")
+        body_end = document_xml.rfind("</w:body>")
+        self.head = document_xml[:body_start].encode("utf-8")
+        self.tail = document_xml[sect_start if sect_start > body_start else body_end:].encode("utf-8")
         
-        try:
-            process_docx(
-                temp_input.name,
-                output_path,
-                title_keywords=title_keywords,
-                image_keywords=image_keywords,
-                font_name=font_name,
-                font_size=font_size,
-                indent=indent,
-                progress_callback=update_file_progress
-            )
-            output_files.append((output_filename, output_path))
-        except Exception as e:
-            st.error(f"处理文件 {uploaded_file.name} 失败: {str(e)}")
-        finally:
-            # 清理临时输入文件
-            os.unlink(temp_input.name)
-    
-    # 完成
-    batch_progress.progress(1.0)
-    status_text.text("批处理完成")
-    
-    return output_files
+        # 预先压缩好模板部件，输出时整体复制后以追加模式写入主文档，省去每个文件重复压缩
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as prefix:
+            for info, data in self.parts:
+                prefix.writestr(info, data)
+        self.prefix = buffer.getvalue()
 
-def create_zip_of_files(files):
-    import zipfile
-    
-    # 创建临时zip文件
-    temp_zip = tempfile.NamedTemporaryFile(suffix='.zip', delete=False)
-    temp_zip.close()
-    
-    # 添加文件到zip
-    with zipfile.ZipFile(temp_zip.name, 'w') as zipf:
-        for filename, filepath in files:
-            zipf.write(filepath, arcname=filename)
-    
-    return temp_zip.name
+    @staticmethod
+    def _main_document_part(template):
+        # 主文档部件不一定是word/document.xml，按包关系查找
+        rels = ElementTree.fromstring(template.read("_rels/.rels"))
+        for rel in rels:
+            if rel.get("Type", "").endswith("/officeDocument"):
+                return rel.get("Target").lstrip("/")
+        return "word/document.xml"
 
-def extract_content_for_ai(docx_file):
+    def open_output(self, output_path):
+        """
+        创建输出zip并写入模板部件，返回 (zip文件, 主文档写入流)
+        """
+        if isinstance(output_path, (str, os.PathLike)):
+            with open(output_path, "wb") as f:
+                f.write(self.prefix)
+            output = zipfile.ZipFile(output_path, "a", zipfile.ZIP_DEFLATED)
+        else:
+            output = zipfile.ZipFile(output_path, "w", zipfile.ZIP_DEFLATED)
+            for info, data in self.parts:
+                output.writestr(info, data)
+        stream = output.open(self.document_part, "w", force_zip64=True)
+        stream.write(self.head)
+        return output, stream
+
+@functools.lru_cache(maxsize=4)
+def load_docx_template(path, mtime):
     """
-    提取文档内容，用于AI分析
+    按路径和修改时间缓存模板，进程内所有会话、后台任务和命令行共享（不依赖Streamlit运行时）
     """
-    if isinstance(docx_file, str):  # 如果是文件路径
-        doc = Document(docx_file)
-    else:  # 如果是上传的文件对象
-        doc = Document(io.BytesIO(docx_file.getvalue()))
-    
-    # 提取前3000个字符用于分析
-    content = ""
-    for para in doc.paragraphs:
-        content += para.text + "\n"
-        if len(content) > 3000:
-            content = content[:3000]
-            break
-    
-    return content
+    return DocxTemplate(path)
 
-def analyze_with_openai(content, api_key, model, api_base=None):
+def get_docx_template(path=None):
     """
-    使用OpenAI API分析文档内容，提取关键词
+    返回输出模板，未指定时使用python-docx自带的默认模板
     """
-    try:
-        # 设置API密钥
-        openai.api_key = api_key
-        
-        # 准备客户端参数
-        client_params = {"api_key": api_key}
-        
-        # 如果提供了自定义API基础URL，则设置它
-        if api_base and api_base.strip():
-            if is_old_api:
-                openai.api_base = api_base
-            else:
-                client_params["base_url"] = api_base
-        
-        # 增强提示信息
-        prompt = f"""
-        你是一位专业的文档分析师，擅长分析学术报告和活动文档。你的任务是从以下文档内容中提取**关键词**，这将用于文档格式化和规范化。
+    path = path or DEFAULT_TEMPLATE_PATH
+    return load_docx_template(path, os.path.getmtime(path))
 
-        ## 分析要求
-        请识别并提取以下三类关键词：
+class PythonDocxWriter:
+    """
+    通过python-docx段落对象生成正文并设置格式，文档其余部件直接复制缓存的模板
+    """
+    def __init__(self, output_path, template=None):
+        self.output_path = output_path
+        self.template = template or get_docx_template()
+        self.body = parse_xml(f"<w:body {nsdecls('w')}/>")
 
-        1. **标题关键词**：这些词通常出现在文档的标题和小标题中，用于描述具体活动或事件。它们一般是**动词+名词**的组合，标识了文档的核心内容。请提取与活动描述直接相关的关键词，避免长句或短语：
-           - 例如：举办、开展、协助、组织、召开、宣讲会、志愿活动、竞赛等。
+    def add_paragraph(self, text, **style):
+        # 与Document.add_paragraph一致：新建段落后添加文本
+        p = Paragraph(self.body.add_p(), None)
+        if text:
+            p.add_run(text)
+        set_style(p, **style)
 
-        2. **图片说明关键词**：这些词通常用于描述图片的内容，简短且与图片直接相关。关键词通常为**动词或名词**，而非长短语。请提取与图片动作或场景相关的词汇：
-           - 例如：主持人、发言、展示、合影、授课、讲解等。
+    def save(self):
+        # 只输出body的子元素，命名空间声明沿用模板文档的根元素
+        body = etree.tostring(self.body, encoding="utf-8")
+        content = body[body.index(b">") + 1:body.rindex(b"</w:body>")] if not body.endswith(b"/>") else b""
+        output, stream = self.template.open_output(self.output_path)
+        with output:
+            stream.write(content)
+            stream.write(self.template.tail)
+            stream.close()
 
-        3. **系统冗余关键词**：这些是自动生成的无实质意义的词，通常包括元数据或格式标记，应当被移除：
-           - 例如：发布人、浏览数、日期、审稿信息（如一审、二审、三审）等。
+    def discard(self):
+        pass
 
-        ## 文档上下文
-        这份文档是一个{guess_document_type(content)}。请根据文档类型调整你的分析策略。
+class StreamingDocxWriter:
+    """
+    直接把document.xml逐段流式写入输出zip，不构建python-docx对象树；
+    模板中的样式、主题等其他部件原样复制，段落格式与set_style的结果一致
+    """
+    def __init__(self, output_path, template=None):
+        self.output_path = output_path
+        self.template = template or get_docx_template()
+        self._style_cache = {}
+        self._zip, self._stream = self.template.open_output(output_path)
 
-        ## 文档内容开始：
-        {content}
-        ## 文档内容结束
+    def _paragraph_prefix(self, font_name="宋体", font_size=12, bold=False, indent=True, align_left=False):
+        key = (font_name, font_size, bold, indent, align_left)
+        if key not in self._style_cache:
+            font = xml_escape(font_name, {'"': "&quot;"})
+            jc = '<w:jc w:val="left"/>' if align_left else ""
+            first_line = 420 if indent else 0
+            b = "<w:b/>" if bold else '<w:b w:val="0"/>'
+            self._style_cache[key] = (
+                f'<w:p><w:pPr><w:spacing w:line="360" w:lineRule="auto"/><w:ind w:firstLine="{first_line}"/>{jc}</w:pPr>'
+                f'<w:r><w:rPr><w:rFonts w:ascii="{font}" w:hAnsi="{font}" w:eastAsia="{font}"/>{b}'
+                f'<w:sz w:val="{round(font_size * 2)}"/></w:rPr>'
+            )
+        return self._style_cache[key]
 
-        ## 输出要求
-        1. 每类关键词至少提供**5个**，最多**15个**。
-        2. 关键词应当是**具体**且**简短**，避免长句或描述。
-        3. 关键词应当是文档中**实际出现过的**或**高度相关**的词汇。
-        4. 严格按照以下JSON格式返回结果，确保格式正确：
+    @staticmethod
+    def _run_content(text):
+        # 与python-docx一致：制表符转为w:tab，换行转为w:br
+        parts = []
+        for chunk in re.split(r"(\t|\r|\n)", text):
+            if chunk == "\t":
+                parts.append("<w:tab/>")
+            elif chunk in ("\r", "\n"):
+                parts.append("<w:br/>")
+            elif chunk:
+                space = ' xml:space="preserve"' if chunk.strip() != chunk else ""
+                parts.append(f"<w:t{space}>{xml_escape(chunk)}</w:t>")
+        return "".join(parts)
 
-        ```json
-        {{
-          "title_keywords": ["关键词1", "关键词2", ...],
-          "image_keywords": ["关键词1", "关键词2", ...],
-          "redundant_keywords": ["关键词1", "关键词2", ...]
-        }}
-        ```
+    def add_paragraph(self, text, **style):
+        xml = self._paragraph_prefix(**style) + self._run_content(text) + "</w:r></w:p>"
+        self._stream.write(xml.encode("utf-8"))
 
-        只返回JSON数据，不要有其他任何解释或说明。
-        """
+    def add_page_break(self):
+        self._stream.write(b'<w:p><w:r><w:br w:type="page"/></w:r></w:p>')
 
-        
-        # 根据API版本调用不同的方法
-        if is_old_api:
-            # 旧版API (openai < 1.0.0)
-            # 使用旧版API时忽略linter警告
-            # noinspection PyUnresolvedReferences
-            response = openai.ChatCompletion.create(
-                model=model,
-                messages=[
-                    {"role": "system", "content": "你是一个专业的文档分析助手，擅长提取文档中的关键信息。你的回答应当简洁、准确、实用，且始终返回有效的JSON格式数据。"},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.2,  # 降低随机性，提高精确度
-                max_tokens=1500
-            )
-            result = response.choices[0].message.content
-        else:
-            # 新版API (openai >= 1.0.0)
-            client = openai.OpenAI(**client_params)
-            response = client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "system", "content": "你是一个专业的文档分析助手，擅长提取文档中的关键信息。你的回答应当简洁、准确、实用，且始终返回有效的JSON格式数据。"},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.2,  # 降低随机性，提高精确度
-                max_tokens=1500
-            )
-            result = response.choices[0].message.content
-        
+    def save(self):
+        self._stream.write(self.template.tail)
+        self._stream.close()
+        self._zip.close()
+
+    def discard(self):
         try:
-            # 直接尝试解析整个响应为JSON
-            try:
-                keywords = json.loads(result)
-                return keywords
-            except:
-                # 如果整个响应不是JSON，尝试提取JSON部分
-                json_start = result.find('{')
-                json_end = result.rfind('}') + 1
-                if json_start >= 0 and json_end > json_start:
-                    json_str = result[json_start:json_end]
-                    keywords = json.loads(json_str)
-                    return keywords
-                else:
-                    st.warning("AI返回的结果不包含有效的JSON数据")
-                    return None
-        except Exception as e:
-            st.warning(f"解析AI返回的JSON数据失败: {str(e)}")
-            return None
-    except Exception as e:
-        st.error(f"调用OpenAI API失败: {str(e)}")
-        return None
+            self._stream.close()
+            self._zip.close()
+        finally:
+            if isinstance(self.output_path, (str, os.PathLike)) and os.path.exists(self.output_path):
+                os.unlink(self.output_path)
 
-def guess_document_type(content):
+class DocumentModel:
     """
-    根据内容推测文档类型
+    文档解析一次后的紧凑表示，预览、AI抽样和处理都从它读取，不再重复解析docx。
+    非空段落的文本（已去除首尾空白）连接存放在一个字符串中，按偏移量取出；
+    indexes记录每段在原文档中的位置，与处理记录的index一致
     """
-    content_lower = content.lower()
-    
-    if "培训" in content_lower or "讲座" in content_lower or "报告会" in content_lower:
-        return "培训或讲座活动报告"
-    elif "竞赛" in content_lower or "比赛" in content_lower:
-        return "竞赛活动报告"
-    elif "志愿" in content_lower or "公益" in content_lower:
-        return "志愿服务活动报告"
-    elif "会议" in content_lower:
-        return "会议纪要"
+    __slots__ = ("text", "offsets", "indexes", "paragraph_count")
+
+    def __init__(self, paragraphs=()):
+        parts = []
+        offsets = array.array("L", [0])
+        indexes = array.array("L")
+        total = 0
+        count = 0
+        for i, text in enumerate(paragraphs):
+            count += 1
+            text = text.strip()
+            if not text:
+                continue
+            parts.append(text)
+            total += len(text)
+            offsets.append(total)
+            indexes.append(i)
+        self.text = "".join(parts)
+        self.offsets = offsets
+        self.indexes = indexes
+        # 原文档的段落总数（包括空段落），用于计算处理进度
+        self.paragraph_count = count
+
+    @classmethod
+    def parse(cls, source):
+        """
+        解析docx文件（路径或文件对象）
+        """
+        if hasattr(source, "seek"):
+            source.seek(0)
+        return cls(para.text for para in Document(source).paragraphs)
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [self[i] for i in range(*k.indices(len(self)))]
+        if k < 0:
+            k += len(self)
+        return self.text[self.offsets[k]:self.offsets[k + 1]]
+
+    def __iter__(self):
+        text, offsets = self.text, self.offsets
+        for k in range(len(self.indexes)):
+            yield text[offsets[k]:offsets[k + 1]]
+
+    def items(self):
+        """
+        依次返回 (原文档中的段落位置, 段落文本)
+        """
+        return zip(self.indexes, self)
+
+    def find(self, keyword):
+        """
+        返回包含关键词的段落序号：在连接后的文本上查找，不逐段扫描；跨越段落边界的匹配不计
+        """
+        if not keyword:
+            return list(range(len(self)))
+        text, offsets = self.text, self.offsets
+        found = []
+        start = text.find(keyword)
+        while start != -1:
+            k = bisect.bisect_right(offsets, start) - 1
+            end = offsets[k + 1]
+            if start + len(keyword) <= end:
+                found.append(k)
+                start = text.find(keyword, end)
+            else:
+                start = text.find(keyword, start + 1)
+        return found
+
+    def state(self):
+        """
+        转为只包含内置类型的元组，用于传给进程池（Streamlit以__main__运行脚本，其中的类不能直接传给子进程）
+        """
+        return (self.text, self.offsets.tobytes(), self.indexes.tobytes(), self.paragraph_count)
+
+    @classmethod
+    def from_state(cls, state):
+        model = cls()
+        text, offsets, indexes, model.paragraph_count = state
+        model.text = text
+        model.offsets = array.array("L")
+        model.offsets.frombytes(offsets)
+        model.indexes = array.array("L")
+        model.indexes.frombytes(indexes)
+        return model
+
+def load_document_model(source):
+    """
+    返回source对应的DocumentModel；已经是DocumentModel时直接返回
+    （缓存的模型可能由之前运行的脚本创建，Streamlit每次运行都会重新定义类，因此不用isinstance判断）
+    """
+    return source if hasattr(source, "indexes") else DocumentModel.parse(source)
+
+# WordprocessingML命名空间中的元素名，用于直接解析document.xml
+W_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+W_BODY = W_NAMESPACE + "body"
+W_P = W_NAMESPACE + "p"
+W_R = W_NAMESPACE + "r"
+W_HYPERLINK = W_NAMESPACE + "hyperlink"
+W_T = W_NAMESPACE + "t"
+W_TYPE = W_NAMESPACE + "type"
+# 与python-docx一致：这些元素转为对应的字符（换行只计文字换行，分页符不计）
+W_RUN_CHARS = {W_NAMESPACE + "tab": "\t", W_NAMESPACE + "ptab": "\t", W_NAMESPACE + "cr": "\n",
+               W_NAMESPACE + "noBreakHyphen": "-"}
+W_BR = W_NAMESPACE + "br"
+
+def _paragraph_xml_text(p):
+    # 与python-docx的Paragraph.text相同：连接段落中w:r和超链接中w:r的文本
+    parts = []
+    for child in p:
+        runs = (child,) if child.tag == W_R else child.iterchildren(W_R) if child.tag == W_HYPERLINK else ()
+        for run in runs:
+            for e in run:
+                if e.tag == W_T:
+                    parts.append(e.text or "")
+                elif e.tag == W_BR:
+                    if e.get(W_TYPE, "textWrapping") == "textWrapping":
+                        parts.append("\n")
+                elif e.tag in W_RUN_CHARS:
+                    parts.append(W_RUN_CHARS[e.tag])
+    return "".join(parts)
+
+def iter_docx_paragraphs(source):
+    """
+    直接从docx的document.xml流式读取正文段落文本（与Document(source).paragraphs一致），
+    不构建python-docx对象树，读过的段落随即释放；用于只需要文本的快速预检
+    """
+    if hasattr(source, "seek"):
+        source.seek(0)
+    with zipfile.ZipFile(source) as package, package.open(DocxTemplate._main_document_part(package)) as stream:
+        for _, p in etree.iterparse(stream, events=("end",), tag=W_P):
+            body = p.getparent()
+            # 表格等容器中的段落不属于正文段落，随容器一起释放
+            if body is None or body.tag != W_BODY:
+                continue
+            yield _paragraph_xml_text(p)
+            p.clear()
+            while p.getprevious() is not None:
+                del body[0]
+
+# 处理记录中的一项：输入段落位置、原文、判定类别和输出行（被删除的段落输出行为空）
+TraceEntry = collections.namedtuple("TraceEntry", ["index", "text", "category", "lines"])
+
+def process_docx(input_path, output_path, title_keywords=None, image_keywords=None,
+                font_name="宋体", font_size=12, indent=True, progress_callback=None,
+                redundant_keywords=None, near_duplicates=None, source_name=None, streaming=False, archive=None,
+                template_path=None):
+    doc = load_document_model(input_path)
+    template = get_docx_template(template_path)
+    writer = StreamingDocxWriter(output_path, template) if streaming else PythonDocxWriter(output_path, template)
+    source_name = source_name or os.path.basename(str(input_path))
+    try:
+        trace = _write_processed_paragraphs(doc, writer, title_keywords, image_keywords, font_name, font_size, indent,
+                                            progress_callback, redundant_keywords, near_duplicates, source_name)
+        
+        # 保存文件
+        if progress_callback:
+            progress_callback(95, "正在保存文件...")
+        
+        writer.save()
+    except Exception:
+        writer.discard()
+        raise
+    
+    # 将输出段落写入检索归档
+    if archive is not None:
+        archive.add_document(source_name, [(entry.category, line) for entry in trace for line in entry.lines])
+
+    if progress_callback:
+        progress_callback(100, "处理完成")
+    
+    return trace
+
+def _write_processed_paragraphs(doc, writer, title_keywords, image_keywords, font_name, font_size, indent,
+                                progress_callback, redundant_keywords, near_duplicates, source_name):
+    trace = []
+    for entry in iter_classified_paragraphs(doc, title_keywords, image_keywords, redundant_keywords,
+                                            near_duplicates, source_name, progress_callback):
+        for line in entry.lines:
+            writer.add_paragraph(line, **paragraph_style(entry.category, font_name, font_size, indent))
+        trace.append(entry)
+    return trace
+
+def iter_classified_paragraphs(doc, title_keywords=None, image_keywords=None, redundant_keywords=None,
+                               near_duplicates=None, source_name=None, progress_callback=None, seen_titles=None):
+    """
+    逐段分类文档内容（DocumentModel），生成每个非空段落的TraceEntry。
+    seen_titles为已出现的标题集合，合并多篇文章时传入同一个集合以跨文章去除重复标题
+    """
+    if seen_titles is None:
+        seen_titles = set()
+    
+    # 使用传入的关键词或默认值
+    title_kw, image_kw, redundant_kw = resolve_keywords(title_keywords, image_keywords, redundant_keywords)
+    
+    total_paragraphs = doc.paragraph_count
+
+    for i, text in doc.items():
+        # 更新进度
+        if progress_callback and total_paragraphs > 0:
+            progress_value = int((i / total_paragraphs) * 100)
+            progress_callback(progress_value, f"处理段落 {i+1}/{total_paragraphs}")
+        
+        # 判断段落类别并生成输出（图片说明、冗余信息和重复标题不输出）
+        category = classify_paragraph(text, title_kw, image_kw, redundant_kw)
+        category, lines = resolve_output_lines(text, category, seen_titles)
+        
+        # 跨文件近似重复检测（只检查标题和正文）
+        if near_duplicates is not None and category in (CATEGORY_TITLE, CATEGORY_BODY):
+            if near_duplicates.check(lines[0], source_name, i) and near_duplicates.drop:
+                category, lines = CATEGORY_NEAR_DUPLICATE, []
+        
+        yield TraceEntry(i, text, category, lines)
+
+def export_ndjson(input_path, output, title_keywords=None, image_keywords=None, progress_callback=None,
+                  redundant_keywords=None, near_duplicates=None, source_name=None, archive=None, **_):
+    """
+    按process_docx的规则分类文档，将每个段落写为一行JSON（NDJSON），不生成Word文档。
+    output可以是文件路径或已打开的文本文件；忽略排版相关的参数。指定archive时与process_docx一样写入检索归档
+    """
+    doc = load_document_model(input_path)
+    source_name = source_name or os.path.basename(str(input_path))
+    owns_file = isinstance(output, (str, os.PathLike))
+    f = open(output, "w", encoding="utf-8", newline="\n") if owns_file else output
+    archived = []
+    try:
+        for entry in iter_classified_paragraphs(doc, title_keywords, image_keywords, redundant_keywords,
+                                                near_duplicates, source_name, progress_callback):
+            f.write(trace_record(source_name, entry) + "\n")
+            if archive is not None:
+                archived.extend((entry.category, line) for line in entry.lines)
+    except Exception:
+        if owns_file:
+            f.close()
+            if os.path.exists(output):
+                os.unlink(output)
+        raise
+    if owns_file:
+        f.close()
+    
+    # 将输出段落写入检索归档
+    if archive is not None:
+        archive.add_document(source_name, archived)
+    
+    if progress_callback:
+        progress_callback(100, "处理完成")
+
+def trace_record(source_name, entry):
+    """
+    处理记录的一项转为一行JSON（NDJSON导出格式）
+    """
+    return json.dumps(
+        {"file": source_name, "index": entry.index, "category": entry.category, "text": entry.text, "output": entry.lines},
+        ensure_ascii=False
+    )
+
+def save_trace(trace, path, source_name):
+    with open(path, "w", encoding="utf-8", newline="\n") as f:
+        for entry in trace:
+            f.write(trace_record(source_name, entry) + "\n")
+
+def load_trace(path, source_name=None):
+    """
+    读取NDJSON格式的处理记录；指定source_name时只读取该文件的记录（合并简报包含多个文件）
+    """
+    trace = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                if source_name is not None and record["file"] != source_name:
+                    continue
+                trace.append(TraceEntry(record["index"], record["text"], record["category"], record["output"]))
+    return trace
+
+def trace_path_for(output_path):
+    """
+    批处理输出文档对应的处理记录文件
+    """
+    return str(output_path) + ".trace.ndjson"
+
+def load_output_trace(output_path):
+    """
+    读取处理结果对应的处理记录：NDJSON导出本身就是处理记录；
+    Word文档读取旁边保存的记录文件，没有记录文件时从文档内容生成（只有输出段落）
+    """
+    if str(output_path).endswith(".ndjson"):
+        return load_trace(output_path)
+    trace_path = trace_path_for(output_path)
+    if os.path.exists(trace_path):
+        return load_trace(trace_path)
+    return [TraceEntry(i, text, CATEGORY_BODY, [text]) for i, text in enumerate(extract_docx_text(output_path))]
+
+def trace_output_paragraphs(trace):
+    """
+    处理记录对应的输出段落，与输出文档内容一致
+    """
+    return [line for entry in trace for line in entry.lines]
+
+# 预检时删除内容超过该比例的文件标记为可能丢失内容
+TRIAGE_REMOVED_RATIO = 0.3
+# 被删除的冗余信息超过该字数时可能是误判的正文
+TRIAGE_LONG_REMOVED = 50
+
+def triage_document(source, title_keywords=None, image_keywords=None, redundant_keywords=None):
+    """
+    只运行分类规则预检一个文档，不生成输出文档：统计各类段落数和删除的字数，并列出需要人工检查的问题
+    """
+    title_kw, image_kw, redundant_kw = resolve_keywords(title_keywords, image_keywords, redundant_keywords)
+    seen_titles = set()
+    counts = collections.Counter()
+    total_chars = removed_chars = 0
+    first_title = None
+    long_removed = 0
+    position = 0
+    for text in iter_docx_paragraphs(source):
+        text = text.strip()
+        if not text:
+            continue
+        category = classify_paragraph(text, title_kw, image_kw, redundant_kw)
+        category, lines = resolve_output_lines(text, category, seen_titles)
+        counts[category] += 1
+        total_chars += len(text)
+        if not lines:
+            removed_chars += len(text)
+            if category == CATEGORY_REDUNDANT and len(text) > TRIAGE_LONG_REMOVED:
+                long_removed += 1
+        if category == CATEGORY_TITLE and first_title is None:
+            first_title = position
+        position += 1
+    
+    removed = counts[CATEGORY_CAPTION] + counts[CATEGORY_REDUNDANT] + counts[CATEGORY_DUPLICATE]
+    ratio = removed_chars / total_chars if total_chars else 0
+    issues = []
+    if not position:
+        issues.append("没有文字内容")
+    elif first_title is None:
+        issues.append("未识别到标题")
+    else:
+        if first_title > 2:
+            issues.append(f"标题不在开头（第{first_title + 1}段）")
+        if counts[CATEGORY_TITLE] > 1:
+            issues.append(f"识别到{counts[CATEGORY_TITLE]}个标题")
+    if ratio > TRIAGE_REMOVED_RATIO:
+        issues.append(f"删除{ratio:.0%}的文字")
+    if long_removed:
+        issues.append(f"{long_removed}个较长段落被判定为冗余信息")
+    return {
+        "段落数": position,
+        "标题": counts[CATEGORY_TITLE],
+        "正文": counts[CATEGORY_BODY],
+        "署名": counts[CATEGORY_BYLINE],
+        "审核信息": counts[CATEGORY_REVIEW],
+        "删除段落": removed,
+        "删除字数比例": f"{ratio:.0%}",
+        "问题": "；".join(issues),
+    }
+
+def triage_files(files, title_keywords=None, image_keywords=None, redundant_keywords=None,
+                 progress_callback=None, should_stop=None):
+    """
+    预检一批上传文件，返回每个文件一行的汇总表（按文件顺序）；读取失败的文件记在问题列中
+    """
+    rows = []
+    for i, f in enumerate(files):
+        if should_stop and should_stop():
+            raise JobCancelled()
+        if progress_callback:
+            progress_callback(int(i / len(files) * 100), f"正在预检: {f.name}")
+        try:
+            row = triage_document(f, title_keywords, image_keywords, redundant_keywords)
+        except Exception as e:
+            row = {"段落数": 0, "标题": 0, "正文": 0, "署名": 0, "审核信息": 0, "删除段落": 0,
+                   "删除字数比例": "", "问题": f"读取失败: {str(e)}"}
+        finally:
+            # 释放压缩包中文件的解压缓冲
+            if hasattr(f, "release"):
+                f.release()
+        rows.append({"文件": f.name, **row})
+    if progress_callback:
+        progress_callback(100, "预检完成")
+    return rows
+
+def iter_document_models(sources, pool=None, window=4):
+    """
+    按顺序返回 (文件名, DocumentModel)，解析失败时返回 (文件名, 异常)。
+    sources为 (文件名, 读取源) 列表，读取源可以是文件路径、文件对象或已解析的DocumentModel；
+    指定pool时在工作进程中并行解析，最多提前解析window篇，内存中只保留这几篇文章
+    """
+    pending = collections.deque()
+    sources = iter(sources)
+    while True:
+        while len(pending) < (window if pool is not None else 1):
+            item = next(sources, None)
+            if item is None:
+                break
+            name, source = item
+            if hasattr(source, "indexes") or pool is None:
+                pending.append((name, source, None))
+            else:
+                if not isinstance(source, (str, os.PathLike)):
+                    source.seek(0)
+                    data = source.read()
+                    # 释放压缩包中文件的解压缓冲
+                    if hasattr(source, "release"):
+                        source.release()
+                    source = data
+                pending.append((name, None, pool.parse(source)))
+        if not pending:
+            return
+        name, source, future = pending.popleft()
+        try:
+            model = load_document_model(source) if future is None else DocumentModel.from_state(future.result())
+        except Exception as e:
+            model = e
+        finally:
+            if hasattr(source, "release"):
+                source.release()
+        yield name, model
+
+# 合并简报的输出文件名
+BULLETIN_FILENAME = "合并简报.docx"
+
+def order_batch_files(uploaded_files, order="upload"):
+    """
+    按合并顺序排列上传文件：upload为上传顺序，name为按文件名，也可以直接传入文件序号列表
+    """
+    if order == "name":
+        return sorted(uploaded_files, key=lambda f: f.name)
+    if isinstance(order, (list, tuple)):
+        return [uploaded_files[i] for i in order]
+    return list(uploaded_files)
+
+def merge_documents(sources, output_path, title_keywords=None, image_keywords=None, font_name="宋体", font_size=12,
+                    indent=True, redundant_keywords=None, near_duplicates=None, template_path=None, page_break=False,
+                    progress_callback=None, should_stop=None, trace_path=None, archive=None, pool=None):
+    """
+    将多篇文章按sources的顺序流式合并为一份简报（sources格式见iter_document_models）。
+    各篇文章共用一个已出现标题集合，整份简报中重复的标题只保留第一次；段落逐个写入document.xml，
+    内存中只保留正在处理的文章。指定trace_path时把处理记录逐行写入该文件。
+    返回 {"articles": 合并的文章数, "paragraphs": 输出段落数, "duplicates": 删除的重复标题数, "errors": 失败的文章}
+    """
+    sources = list(sources)
+    total = len(sources)
+    writer = StreamingDocxWriter(output_path, get_docx_template(template_path))
+    trace_file = open(trace_path, "w", encoding="utf-8", newline="\n") if trace_path else None
+    seen_titles = set()
+    summary = {"articles": 0, "paragraphs": 0, "duplicates": 0, "errors": []}
+    try:
+        for done, (name, model) in enumerate(iter_document_models(sources, pool)):
+            if should_stop and should_stop():
+                raise JobCancelled()
+            if progress_callback:
+                progress_callback(int(done / total * 100), f"已合并 {done}/{total}，正在处理: {name}")
+            if isinstance(model, Exception):
+                summary["errors"].append((name, str(model)))
+                continue
+            
+            # 文章之间空一行或分页
+            if summary["articles"]:
+                if page_break:
+                    writer.add_page_break()
+                else:
+                    writer.add_paragraph("", font_name=font_name, font_size=font_size, indent=indent)
+            
+            lines = []
+            for entry in iter_classified_paragraphs(model, title_keywords, image_keywords, redundant_keywords,
+                                                    near_duplicates, name, seen_titles=seen_titles):
+                for line in entry.lines:
+                    writer.add_paragraph(line, **paragraph_style(entry.category, font_name, font_size, indent))
+                    lines.append((entry.category, line))
+                if entry.category == CATEGORY_DUPLICATE:
+                    summary["duplicates"] += 1
+                if trace_file is not None:
+                    trace_file.write(trace_record(name, entry) + "\n")
+            
+            if archive is not None:
+                archive.add_document(name, lines)
+            summary["articles"] += 1
+            summary["paragraphs"] += len(lines)
+        
+        if progress_callback:
+            progress_callback(95, "正在保存文件...")
+        writer.save()
+    except BaseException:
+        writer.discard()
+        raise
+    finally:
+        if trace_file is not None:
+            trace_file.close()
+    
+    if progress_callback:
+        progress_callback(100, "合并完成")
+    return summary
+
+def merge_ndjson_files(files, output_path=None):
+    """
+    将多个NDJSON文件按顺序合并为一个文件，未指定output_path时合并到临时文件
+    """
+    if output_path is None:
+        temp_ndjson = tempfile.NamedTemporaryFile(suffix='.ndjson', delete=False)
+        temp_ndjson.close()
+        output_path = temp_ndjson.name
+    with open(output_path, "wb") as output:
+        for _, filepath in files:
+            with open(filepath, "rb") as f:
+                shutil.copyfileobj(f, output, 1024 * 1024)
+    return output_path
+
+# 检索归档数据库文件名（位于配置目录）
+ARCHIVE_FILENAME = "archive.sqlite3"
+
+class DocumentArchive:
+    """
+    处理结果的全文检索归档：保存每个文档的输出段落、类别和处理时间。
+    段落存于普通表，FTS5（trigram分词）外部内容索引由触发器维护；
+    SQLite不支持trigram时退化为LIKE查询
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS documents (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            title TEXT,
+            content_hash TEXT NOT NULL UNIQUE,
+            processed_at TEXT NOT NULL,
+            paragraph_count INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS paragraphs (
+            id INTEGER PRIMARY KEY,
+            document_id INTEGER NOT NULL REFERENCES documents(id) ON DELETE CASCADE,
+            position INTEGER NOT NULL,
+            category TEXT NOT NULL,
+            text TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS paragraphs_document ON paragraphs(document_id);
+    """
+    FTS_SCHEMA = """
+        CREATE VIRTUAL TABLE IF NOT EXISTS paragraphs_fts USING fts5(
+            text, content='paragraphs', content_rowid='id', tokenize='trigram'
+        );
+        CREATE TRIGGER IF NOT EXISTS paragraphs_ai AFTER INSERT ON paragraphs BEGIN
+            INSERT INTO paragraphs_fts(rowid, text) VALUES (new.id, new.text);
+        END;
+        CREATE TRIGGER IF NOT EXISTS paragraphs_ad AFTER DELETE ON paragraphs BEGIN
+            INSERT INTO paragraphs_fts(paragraphs_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        END;
+    """
+    # trigram分词只能匹配3个字符及以上的词
+    MIN_MATCH_CHARS = 3
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(self.SCHEMA)
+            try:
+                conn.executescript(self.FTS_SCHEMA)
+                self.fts = True
+            except sqlite3.OperationalError:
+                self.fts = False
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # 每次操作使用独立连接，可在后台线程中并发写入
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            conn.execute("PRAGMA foreign_keys=ON")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def add_document(self, name, paragraphs):
+        """
+        归档一个文档的输出段落，paragraphs为 (类别, 文本) 列表；内容相同的文档只保留最新一次
+        """
+        content_hash = hashlib.sha256("\n".join(text for _, text in paragraphs).encode("utf-8")).hexdigest()
+        title = next((text for category, text in paragraphs if category == CATEGORY_TITLE), None)
+        now = datetime.datetime.now().isoformat(sep=" ", timespec="seconds")
+        with self._connect() as conn:
+            conn.execute("DELETE FROM documents WHERE content_hash = ?", (content_hash,))
+            document_id = conn.execute(
+                "INSERT INTO documents (name, title, content_hash, processed_at, paragraph_count) VALUES (?, ?, ?, ?, ?)",
+                (name, title, content_hash, now, len(paragraphs))
+            ).lastrowid
+            conn.executemany(
+                "INSERT INTO paragraphs (document_id, position, category, text) VALUES (?, ?, ?, ?)",
+                [(document_id, position, category, text) for position, (category, text) in enumerate(paragraphs)]
+            )
+        return document_id
+
+    def search(self, query, category=None, limit=200):
+        """
+        检索包含所有关键词（空格分隔）的段落，按相关度排序。
+        3个字符及以上的词走全文索引，较短的词使用LIKE匹配
+        """
+        terms = query.split()
+        if not terms:
+            return []
+        
+        match_terms = [t for t in terms if len(t) >= self.MIN_MATCH_CHARS] if self.fts else []
+        like_terms = [t for t in terms if t not in match_terms]
+        
+        conditions = []
+        params = []
+        if match_terms:
+            # 每个词作为短语匹配，避免用户输入被解析为FTS5查询语法
+            conditions.append("paragraphs_fts MATCH ?")
+            params.append(" AND ".join('"' + t.replace('"', '""') + '"' for t in match_terms))
+        for term in like_terms:
+            conditions.append("p.text LIKE ? ESCAPE '\\'")
+            params.append("%" + re.sub(r"([%_\\])", r"\\\1", term) + "%")
+        if category:
+            conditions.append("p.category = ?")
+            params.append(category)
+        params.append(limit)
+        
+        if match_terms:
+            sql = f"""
+                SELECT d.name, d.title, d.processed_at, p.category, p.position,
+                       snippet(paragraphs_fts, 0, '【', '】', '…', 32)
+                FROM paragraphs_fts
+                JOIN paragraphs p ON p.id = paragraphs_fts.rowid
+                JOIN documents d ON d.id = p.document_id
+                WHERE {" AND ".join(conditions)}
+                ORDER BY rank
+                LIMIT ?
+            """
+        else:
+            sql = f"""
+                SELECT d.name, d.title, d.processed_at, p.category, p.position, p.text
+                FROM paragraphs p
+                JOIN documents d ON d.id = p.document_id
+                WHERE {" AND ".join(conditions)}
+                ORDER BY d.processed_at DESC, p.position
+                LIMIT ?
+            """
+        
+        with self._connect() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        return [
+            {"文件": name, "标题": title or "", "处理时间": processed_at, "类别": category, "段落": position + 1, "内容": text}
+            for name, title, processed_at, category, position, text in rows
+        ]
+
+    def stats(self):
+        """
+        返回 (文档数, 段落数)
+        """
+        with self._connect() as conn:
+            documents = conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+            paragraphs = conn.execute("SELECT COUNT(*) FROM paragraphs").fetchone()[0]
+        return documents, paragraphs
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM paragraphs")
+            conn.execute("DELETE FROM documents")
+            if self.fts:
+                conn.execute("INSERT INTO paragraphs_fts(paragraphs_fts) VALUES ('rebuild')")
+
+class KeywordRule:
+    """
+    单条关键词规则在全部段落上的命中计数，关键词增删时只查找变化的关键词
+    """
+    def __init__(self, paragraphs, max_length=None):
+        self.paragraphs = paragraphs
+        offsets = paragraphs.offsets
+        self.candidates = bytearray(
+            max_length is None or offsets[i + 1] - offsets[i] <= max_length for i in range(len(paragraphs))
+        )
+        self.keywords = set()
+        self.hits = [0] * len(paragraphs)
+
+    def update(self, keywords):
+        """
+        更新关键词，返回命中状态发生变化的段落下标
+        """
+        keywords = set(keywords)
+        changed = set()
+        for keyword, delta in [(k, 1) for k in keywords - self.keywords] + [(k, -1) for k in self.keywords - keywords]:
+            for i in self.paragraphs.find(keyword):
+                if self.candidates[i]:
+                    before = self.hits[i] > 0
+                    self.hits[i] += delta
+                    if before != (self.hits[i] > 0):
+                        changed.add(i)
+        self.keywords = keywords
+        return changed
+
+    def matches(self, i):
+        return self.hits[i] > 0
+
+class IncrementalClassifier:
+    """
+    缓存文档模型（DocumentModel）的逐段分类结果，关键词修改后只重新评估变化的规则
+    """
+    def __init__(self, paragraphs):
+        self.paragraphs = paragraphs
+        self.rules = {
+            "image": KeywordRule(paragraphs, max_length=20),
+            "redundant": KeywordRule(paragraphs),
+            "title": KeywordRule(paragraphs, max_length=40),
+        }
+        self.categories = [None] * len(paragraphs)
+        self.initialized = False
+
+    def _classify(self, i):
+        text = self.paragraphs[i]
+        if self.rules["image"].matches(i):
+            return CATEGORY_CAPTION
+        if self.rules["redundant"].matches(i):
+            return CATEGORY_REDUNDANT
+        if text.startswith("[物电院]") or self.rules["title"].matches(i):
+            return CATEGORY_TITLE
+        if text.startswith("（通讯员"):
+            return CATEGORY_BYLINE
+        if any(k in text for k in REVIEW_MARKERS):
+            return CATEGORY_REVIEW
+        return CATEGORY_BODY
+
+    def update(self, title_keywords=None, image_keywords=None, redundant_keywords=None):
+        """
+        应用新的关键词，返回发生变化的规则名称
+        """
+        title_kw, image_kw, redundant_kw = resolve_keywords(title_keywords, image_keywords, redundant_keywords)
+        changed_rules = []
+        changed = set()
+        for name, keywords in (("image", image_kw), ("redundant", redundant_kw), ("title", title_kw)):
+            if set(keywords) != self.rules[name].keywords:
+                changed_rules.append(name)
+                changed |= self.rules[name].update(keywords)
+        
+        if not self.initialized:
+            changed = range(len(self.paragraphs))
+            self.initialized = True
+        for i in changed:
+            self.categories[i] = self._classify(i)
+        return changed_rules
+
+    def trace(self):
+        """
+        根据当前分类生成处理记录，与process_docx返回的记录一致（不含近似重复检测）
+        """
+        seen_titles = set()
+        trace = []
+        for (i, text), category in zip(self.paragraphs.items(), self.categories):
+            category, lines = resolve_output_lines(text, category, seen_titles)
+            trace.append(TraceEntry(i, text, category, lines))
+        return trace
+
+def get_upload_digest(uploaded_file):
+    """
+    获取上传文件的内容哈希，按上传文件ID缓存，页面重新运行时不再重复计算
+    """
+    file_id = getattr(uploaded_file, 'file_id', None)
+    if file_id is None:
+        return upload_digest(uploaded_file)
+    
+    if 'upload_digests' not in st.session_state:
+        st.session_state.upload_digests = {}
+    digests = st.session_state.upload_digests
+    if file_id not in digests:
+        digests[file_id] = upload_digest(uploaded_file)
+    return digests[file_id]
+
+class DocumentModelCache:
+    """
+    按内容哈希缓存解析后的DocumentModel，进程内所有会话和后台任务共享。
+    按文本总字数限制缓存大小，超出时淘汰最久未使用的文档
+    """
+    def __init__(self, max_chars=20_000_000):
+        self.max_chars = max_chars
+        self.models = collections.OrderedDict()
+        self.chars = 0
+        self.lock = threading.Lock()
+
+    def peek(self, digest):
+        """
+        返回已缓存的文档模型，未缓存时返回None（不解析）
+        """
+        with self.lock:
+            return self.models.get(digest)
+
+    def get(self, digest, source):
+        """
+        返回内容哈希对应的文档模型，未缓存时解析source（文件路径或文件对象）
+        """
+        with self.lock:
+            model = self.models.get(digest)
+            if model is not None:
+                self.models.move_to_end(digest)
+                return model
+        
+        # 在锁外解析，不阻塞其他文件
+        model = DocumentModel.parse(source)
+        with self.lock:
+            if digest not in self.models:
+                self.models[digest] = model
+                self.chars += len(model.text)
+                while self.chars > self.max_chars and len(self.models) > 1:
+                    _, evicted = self.models.popitem(last=False)
+                    self.chars -= len(evicted.text)
+            return self.models[digest]
+
+@st.cache_resource
+def get_document_models():
+    """
+    获取所有会话共享的文档模型缓存
+    """
+    return DocumentModelCache()
+
+def get_document_model(uploaded_file):
+    """
+    返回上传文件的文档模型（按内容哈希缓存，预览、AI分析和处理共用）
+    """
+    return get_document_models().get(get_upload_digest(uploaded_file), uploaded_file)
+
+def get_document_classifier(uploaded_file):
+    """
+    获取上传文档的增量分类器，按文件内容哈希缓存在会话状态中
+    """
+    digest = get_upload_digest(uploaded_file)
+    if 'doc_classifiers' not in st.session_state:
+        st.session_state.doc_classifiers = {}
+    classifiers = st.session_state.doc_classifiers
+    
+    if digest not in classifiers:
+        # 只保留最近的几份文档，避免会话内存持续增长
+        while len(classifiers) >= 5:
+            classifiers.pop(next(iter(classifiers)))
+        classifiers[digest] = IncrementalClassifier(get_document_model(uploaded_file))
+    return classifiers[digest]
+
+def extract_docx_text(docx_file):
+    """
+    从docx文件中提取非空段落的文本
+    """
+    return list(load_document_model(docx_file))
+
+def render_preview(paragraphs, max_height=400):
+    """
+    渲染文档预览
+    """
+    if not paragraphs:
+        st.info("无内容可预览")
+        return
+    
+    # 创建一个固定高度的容器，带滚动条
+    preview_container = st.container()
+    
+    # 在容器中使用自定义CSS创建一个可滚动的区域
+    scrollable_text = f"""
+    <div style="height: {max_height}px; overflow-y: auto; border: 1px solid #e6e6e6; padding: 15px; border-radius: 5px; background-color: #f9f9f9;">
+    """
+    
+    # 添加段落
+    for para in paragraphs[:100]:  # 限制最多显示100段，避免过大
+        if para.startswith("[物电院]") or (len(para) <= 40 and any(kw in para for kw in TITLE_KEYWORDS)):
+            # 标题样式
+            scrollable_text += f'<p style="font-weight: bold; font-size: 16px; margin-bottom: 8px;">{para}</p>'
+        else:
+            # 普通段落样式
+            scrollable_text += f'<p style="margin-bottom: 8px; text-indent: 2em;">{para}</p>'
+    
+    if len(paragraphs) > 100:
+        scrollable_text += '<p style="color: #888;">...</p>'
+    
+    scrollable_text += "</div>"
+    
+    # 显示预览
+    preview_container.markdown(scrollable_text, unsafe_allow_html=True)
+
+# 差异视图中各类别的标签和样式
+CATEGORY_LABELS = {
+    CATEGORY_TITLE: "标题",
+    CATEGORY_CAPTION: "图片说明",
+    CATEGORY_REDUNDANT: "冗余信息",
+    CATEGORY_DUPLICATE: "重复标题",
+    CATEGORY_NEAR_DUPLICATE: "近似重复",
+    CATEGORY_BYLINE: "署名",
+    CATEGORY_REVIEW: "审核信息",
+    CATEGORY_BODY: "正文",
+}
+REMOVED_CATEGORIES = (CATEGORY_CAPTION, CATEGORY_REDUNDANT, CATEGORY_DUPLICATE, CATEGORY_NEAR_DUPLICATE)
+
+def render_trace_diff(trace, max_height=600, max_entries=200):
+    """
+    按处理记录渲染差异视图：删除的段落划线标红，标题显示添加标签后的文本，改写的段落显示改写结果
+    """
+    if not trace:
+        st.info("无内容可预览")
+        return
+    
+    counts = collections.Counter(entry.category for entry in trace)
+    st.caption("，".join(f"{CATEGORY_LABELS.get(c, c)} {n}" for c, n in counts.items()))
+    
+    html = f"""
+    <div style="height: {max_height}px; overflow-y: auto; border: 1px solid #e6e6e6; padding: 15px; border-radius: 5px; background-color: #f9f9f9;">
+    """
+    for entry in trace[:max_entries]:
+        label = f'<span style="font-size: 12px; color: #888; margin-right: 6px;">[{CATEGORY_LABELS.get(entry.category, entry.category)}]</span>'
+        text = xml_escape(entry.text)
+        if entry.category in REMOVED_CATEGORIES:
+            html += f'<p style="margin-bottom: 8px; color: #c0392b; background-color: #fdecea; text-decoration: line-through;">{label}{text}</p>'
+        elif entry.category == CATEGORY_TITLE:
+            html += f'<p style="margin-bottom: 8px; font-weight: bold; background-color: #e8f6ef;">{label}{xml_escape(entry.lines[0])}</p>'
+        elif entry.lines != [entry.text]:
+            rewritten = "<br>".join(xml_escape(line) for line in entry.lines)
+            html += f'<p style="margin-bottom: 8px;">{label}<span style="color: #888; text-decoration: line-through;">{text}</span><br><span style="background-color: #eaf2fb;">{rewritten}</span></p>'
+        else:
+            html += f'<p style="margin-bottom: 8px;">{label}{text}</p>'
+    
+    if len(trace) > max_entries:
+        html += '<p style="color: #888;">...</p>'
+    
+    html += "</div>"
+    st.markdown(html, unsafe_allow_html=True)
+
+def get_binary_file_downloader_html(bin_file, file_label='文件'):
+    with open(bin_file, 'rb') as f:
+        data = f.read()
+    b64 = base64.b64encode(data).decode()
+    href = f'<a href="data:application/octet-stream;base64,{b64}" download="{os.path.basename(bin_file)}">{file_label}</a>'
+    return href
+
+def process_single_file(uploaded_file, title_keywords, image_keywords, font_name, font_size, indent,
+                        redundant_keywords=None, streaming=False, progress_callback=None, archive=None,
+                        template_path=None, pool=None, model=None, output_path=None):
+    """
+    处理单个上传文件，返回 (输出文件路径, 处理记录)；处理出错时抛出异常。
+    不直接操作界面，可以在后台线程中运行；指定pool时在共享进程池中处理，
+    指定model（预览时已解析的DocumentModel）时直接处理，不再重新解析文档。
+    未指定output_path时输出到临时文件
+    """
+    if uploaded_file is None:
+        return None, None
+        
+    # 没有解析好的文档模型时，创建临时文件
+    temp_input = None
+    source = model
+    if source is None:
+        temp_input = tempfile.NamedTemporaryFile(suffix='.docx', delete=False)
+        temp_input.write(uploaded_file.getvalue())
+        temp_input.close()
+        source = temp_input.name
+    
+    # 创建输出文件路径
+    if output_path is None:
+        temp_output = tempfile.NamedTemporaryFile(suffix='_标准化处理.docx', delete=False)
+        temp_output.close()
+        output_path = temp_output.name
+    
+    try:
+        process = pool.run if pool is not None else process_docx
+        trace = process(
+            source,
+            output_path,
+            title_keywords=title_keywords,
+            image_keywords=image_keywords,
+            font_name=font_name,
+            font_size=font_size,
+            indent=indent,
+            progress_callback=progress_callback,
+            redundant_keywords=redundant_keywords,
+            source_name=uploaded_file.name,
+            streaming=streaming,
+            archive=archive,
+            template_path=template_path
+        )
+        
+        # 返回输出文件路径和处理记录（预览直接使用处理记录，不再重新解析输出文档）
+        return output_path, trace
+    except BaseException:
+        if os.path.exists(output_path):
+            os.unlink(output_path)
+        raise
+    finally:
+        # 清理临时输入文件
+        if temp_input is not None and os.path.exists(temp_input.name):
+            os.unlink(temp_input.name)
+
+def current_rss():
+    """
+    返回当前进程的常驻内存（字节），无法获取时返回None
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+class PeakMemoryMonitor:
+    """
+    记录一段处理过程中的内存峰值：能读取进程常驻内存时后台定时采样，
+    否则退回到tracemalloc统计Python对象内存
+    """
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.baseline = None
+        self.peak = None
+        self.traced_peak = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._started_tracing = False
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            rss = current_rss()
+            if rss is not None and rss > self.peak:
+                self.peak = rss
+
+    def __enter__(self):
+        self.baseline = current_rss()
+        if self.baseline is not None:
+            self.peak = self.baseline
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        elif not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self.peak = max(self.peak, current_rss() or 0)
+        elif self._started_tracing:
+            self.traced_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return False
+
+    def summary(self):
+        if self.peak is not None:
+            return f"进程内存峰值: {self.peak / 1024 / 1024:.1f} MB（处理期间增长 {(self.peak - self.baseline) / 1024 / 1024:.1f} MB）"
+        if self.traced_peak is not None:
+            return f"Python对象内存峰值: {self.traced_peak / 1024 / 1024:.1f} MB"
+        return "无法获取内存使用情况"
+
+# 性能分析结果中显示的热点函数数
+PROFILE_TOP_FUNCTIONS = 25
+# 线程等待（锁、睡眠）不是处理耗时，热点列表中不显示
+PROFILE_IDLE_FUNCTIONS = {
+    "<method 'acquire' of '_thread.lock' objects>",
+    "<method 'get' of '_queue.SimpleQueue' objects>",
+    "<built-in method time.sleep>",
+}
+
+# Python 3.12起cProfile基于sys.monitoring，一个分析器即记录进程中的所有线程；更早的版本只记录启用它的线程
+PROFILE_COVERS_ALL_THREADS = sys.version_info >= (3, 12)
+
+# 同一时间只能有一次性能分析（Python 3.12起同一进程只能启用一个分析器）
+_profile_lock = threading.Lock()
+# 当前线程正在进行的性能分析，提交到线程池的任务据此记录到同一次分析中
+_active_profile = threading.local()
+
+class RunProfiler:
+    """
+    用cProfile（确定性分析）记录一次处理。Python 3.12起同时记录进程中的所有线程（包括同时运行的其他会话）；
+    更早的版本中，处理期间通过profile_thread_task提交到线程池的任务（批处理的并行窗口）在各线程自己的分析器中记录。
+    工作进程中的处理无法记录，分析时应在本进程中处理。结果保存为pstats格式的.prof文件，
+    可以用snakeviz、gprof2dot或python -m pstats打开
+    """
+    def __init__(self):
+        self.profiler = cProfile.Profile()
+        self.thread_profilers = []
+        self._threads = threading.local()
+        self.elapsed = None
+        self.stats = None
+
+    def wrap(self, fn):
+        """
+        包装在其他线程中运行的任务：任务运行期间启用该线程的分析器，结束后立即停用
+        """
+        def run_profiled(*args, **kwargs):
+            profiler = getattr(self._threads, "profiler", None)
+            if profiler is None:
+                profiler = self._threads.profiler = cProfile.Profile()
+                self.thread_profilers.append(profiler)
+            profiler.enable()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                profiler.disable()
+        return run_profiled
+
+    def __enter__(self):
+        _profile_lock.acquire()
+        _active_profile.profiler = self
+        self._start = time.perf_counter()
+        self.profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.profiler.disable()
+        self.elapsed = time.perf_counter() - self._start
+        _active_profile.profiler = None
+        _profile_lock.release()
+        self.stats = pstats.Stats(self.profiler)
+        for profiler in self.thread_profilers:
+            self.stats.add(profiler)
+        return False
+
+    def save(self, path):
+        self.stats.dump_stats(path)
+        return path
+
+    def top_functions(self, limit=PROFILE_TOP_FUNCTIONS):
+        """
+        按函数自身耗时排序的热点函数列表
+        """
+        rows = []
+        for (filename, line, name), (_, calls, self_time, total_time, _) in self.stats.stats.items():
+            if name in PROFILE_IDLE_FUNCTIONS:
+                continue
+            rows.append({
+                "函数": name if filename == "~" else f"{name} ({os.path.basename(filename)}:{line})",
+                "调用次数": calls,
+                "自身耗时(秒)": round(self_time, 4),
+                "累计耗时(秒)": round(total_time, 4),
+            })
+        rows.sort(key=lambda row: -row["自身耗时(秒)"])
+        return rows[:limit]
+
+def profile_thread_task(fn):
+    """
+    当前线程正在进行性能分析时，包装要提交到线程池的任务，使其也记录到这次分析中；
+    没有进行分析或分析器已覆盖所有线程时原样返回
+    """
+    profiler = getattr(_active_profile, "profiler", None)
+    if profiler is None or PROFILE_COVERS_ALL_THREADS:
+        return fn
+    return profiler.wrap(fn)
+
+def spool_upload(uploaded_file, threshold_bytes):
+    """
+    准备上传文件的读取源：小文件直接读取上传缓冲区，
+    超过阈值的文件分块写入磁盘临时文件，不在内存中再复制一份。
+    返回 (读取源, 需要清理的临时文件路径或None)
+    """
+    uploaded_file.seek(0)
+    if uploaded_file.size <= threshold_bytes:
+        return uploaded_file, None
+    
+    temp_input = tempfile.NamedTemporaryFile(suffix='.docx', delete=False)
+    with temp_input:
+        # 压缩包中的文件直接从压缩流分块写出，不先解压到内存
+        source = uploaded_file.open_stream() if hasattr(uploaded_file, "open_stream") else uploaded_file
+        shutil.copyfileobj(source, temp_input, 1024 * 1024)
+    return temp_input.name, temp_input.name
+
+def process_uploaded_file(uploaded_file, output_path, spool_threshold, progress_callback=None,
+                          export_format="docx", pool=None, model=None, **options):
+    """
+    处理单个上传文件（生成Word文档或NDJSON分类数据），完成后清理磁盘暂存文件。
+    指定pool时在共享进程池中处理；近似重复索引需要在整批文件间共享，启用时仍在当前线程中处理。
+    指定model（已解析的DocumentModel）时不再读取上传文件
+    """
+    if model is not None:
+        source, spooled_path = model, None
+    else:
+        source, spooled_path = spool_upload(uploaded_file, spool_threshold)
+    if pool is not None and options.get("near_duplicates") is None:
+        options.pop("near_duplicates", None)
+        if model is None and not spooled_path:
+            source = uploaded_file.read()
+        process = functools.partial(pool.run, export_format=export_format)
+    else:
+        process = export_ndjson if export_format == "ndjson" else process_docx
+    try:
+        return process(
+            source,
+            output_path,
+            progress_callback=progress_callback,
+            source_name=uploaded_file.name,
+            **options
+        )
+    finally:
+        if spooled_path and os.path.exists(spooled_path):
+            os.unlink(spooled_path)
+
+# 批处理任务目录，服务重启后仍可恢复
+JOBS_ROOT = os.path.join(tempfile.gettempdir(), "WordFormatter_jobs")
+
+def upload_digest(uploaded_file):
+    """
+    计算上传文件内容的SHA-256哈希；提供content_digest的文件（压缩包或磁盘上的文件）由其自行分块计算
+    """
+    content_digest = getattr(uploaded_file, "content_digest", None)
+    if content_digest:
+        return content_digest
+    return hashlib.sha256(uploaded_file.getbuffer()).hexdigest()
+
+class ZipEntryUpload:
+    """
+    ZIP压缩包中的一个docx文件，提供与上传文件相同的读取接口（name、size、seek、read、getbuffer）。
+    内容在第一次读取时才从压缩包解压到内存，处理完成后调用release()释放，
+    内存中只保留正在处理的文件。file_id由压缩包的上传文件ID和文件在压缩包中的路径组成，
+    页面重新运行时展开的新对象仍按它缓存内容哈希（get_upload_digest）
+    """
+    def __init__(self, archive, info, file_id=None):
+        self.archive = archive
+        self.info = info
+        self.name = zip_entry_name(info)
+        self.size = info.file_size
+        self.file_id = file_id
+        self._digest = None
+        self._buffer = None
+
+    @property
+    def content_digest(self):
+        # 内容哈希用作批处理任务和共享文档模型缓存的键，必须由实际内容计算，不能使用压缩包头中的CRC32。
+        # 分块读取解压流计算，不把文件整体读入内存；读到结尾时zipfile会校验CRC32
+        if self._digest is None:
+            sha256 = hashlib.sha256()
+            if self._buffer is not None:
+                sha256.update(self._buffer.getbuffer())
+            else:
+                with self.open_stream() as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                        sha256.update(chunk)
+            self._digest = sha256.hexdigest()
+        return self._digest
+
+    def _load(self):
+        if self._buffer is None:
+            self._buffer = io.BytesIO(self.archive.read(self.info))
+        return self._buffer
+
+    def open_stream(self):
+        """
+        返回压缩包中该文件的解压流（不整体读入内存）
+        """
+        return self.archive.open(self.info)
+
+    def seek(self, offset, whence=0):
+        if self._buffer is None and offset == 0 and whence == 0:
+            return 0
+        return self._load().seek(offset, whence)
+
+    def tell(self):
+        return self._buffer.tell() if self._buffer is not None else 0
+
+    def read(self, size=-1):
+        return self._load().read(size)
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def getbuffer(self):
+        return self._load().getbuffer()
+
+    def getvalue(self):
+        return self._load().getvalue()
+
+    def release(self):
+        self._buffer = None
+
+def zip_entry_name(info):
+    """
+    压缩包内的文件名；未标记UTF-8的文件名按GBK解码（Windows下创建的压缩包）
+    """
+    if info.flag_bits & 0x800:
+        return info.filename
+    try:
+        return info.filename.encode("cp437").decode("gbk")
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        return info.filename
+
+def open_zip_entries(source):
+    """
+    打开ZIP压缩包，返回其中docx文件的ZipEntryUpload列表（不解压到磁盘）
+    """
+    archive = zipfile.ZipFile(source)
+    archive_id = getattr(source, "file_id", None)
+    entries = []
+    for info in archive.infolist():
+        name = zip_entry_name(info)
+        basename = os.path.basename(name)
+        # 跳过目录、macOS资源文件和Word临时文件
+        if info.is_dir() or name.startswith("__MACOSX/") or basename.startswith("~$"):
+            continue
+        if basename.lower().endswith(".docx"):
+            entries.append(ZipEntryUpload(archive, info, f"{archive_id}:{info.filename}" if archive_id else None))
+    return entries
+
+def expand_batch_uploads(uploaded_files):
+    """
+    展开批处理输入：docx文件原样保留，ZIP压缩包展开为其中的docx文件
+    """
+    files = []
+    for uploaded_file in uploaded_files:
+        if uploaded_file.name.lower().endswith(".zip"):
+            files.extend(open_zip_entries(uploaded_file))
+        else:
+            files.append(uploaded_file)
+    return files
+
+def output_stem(name):
+    """
+    输出文件名的主干；压缩包内的目录层级用下划线连接，避免不同目录下的同名文件互相覆盖
+    """
+    return os.path.splitext(name.replace("\\", "/").strip("/"))[0].replace("/", "_")
+
+class BatchJob:
+    """
+    可恢复的批处理任务：任务目录中保存清单（输入文件哈希、状态和输出路径），
+    相同文件和设置的任务重新运行时跳过已完成的文件
+    """
+    MANIFEST = "manifest.json"
+
+    def __init__(self, job_dir, manifest):
+        self.job_dir = job_dir
+        self.manifest = manifest
+
+    @property
+    def job_id(self):
+        return self.manifest["job_id"]
+
+    @classmethod
+    def open(cls, files, settings, root=JOBS_ROOT, max_age_days=7):
+        """
+        打开或创建任务，files为 (文件名, 内容哈希) 列表；任务ID由文件和设置决定
+        """
+        cls.prune(root, max_age_days)
+        
+        identity = json.dumps({"files": sorted(files), "settings": settings}, ensure_ascii=False, sort_keys=True)
+        job_id = hashlib.sha256(identity.encode("utf-8")).hexdigest()[:16]
+        job_dir = os.path.join(root, job_id)
+        manifest_path = os.path.join(job_dir, cls.MANIFEST)
+        
+        if os.path.exists(manifest_path):
+            try:
+                with open(manifest_path, "r", encoding="utf-8") as f:
+                    return cls(job_dir, json.load(f))
+            except (OSError, ValueError):
+                pass  # 清单损坏时重新创建
+        
+        os.makedirs(job_dir, exist_ok=True)
+        now = datetime.datetime.now().isoformat(timespec="seconds")
+        manifest = {
+            "job_id": job_id,
+            "created": now,
+            "updated": now,
+            "settings": settings,
+            "files": {
+                cls.file_key(name, digest): {"name": name, "sha256": digest, "status": "pending", "output": None, "error": None}
+                for name, digest in files
+            },
+        }
+        job = cls(job_dir, manifest)
+        job.save()
+        return job
+
+    @staticmethod
+    def file_key(name, digest):
+        return f"{digest}:{name}"
+
+    @classmethod
+    def prune(cls, root=JOBS_ROOT, max_age_days=7):
+        """
+        删除超过保留期限的旧任务目录
+        """
+        if not os.path.isdir(root):
+            return
+        cutoff = time.time() - max_age_days * 86400
+        for name in os.listdir(root):
+            job_dir = os.path.join(root, name)
+            try:
+                if os.path.getmtime(job_dir) < cutoff:
+                    shutil.rmtree(job_dir, ignore_errors=True)
+            except OSError:
+                pass
+
+    def save(self):
+        # 先写临时文件再替换，避免中断时留下不完整的清单
+        self.manifest["updated"] = datetime.datetime.now().isoformat(timespec="seconds")
+        manifest_path = os.path.join(self.job_dir, self.MANIFEST)
+        temp_path = manifest_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, manifest_path)
+
+    def output_path(self, filename):
+        return os.path.join(self.job_dir, filename)
+
+    def is_done(self, key):
+        entry = self.manifest["files"].get(key)
+        return bool(entry and entry["status"] == "done" and entry["output"] and os.path.exists(entry["output"]))
+
+    def mark(self, key, status, output=None, error=None):
+        entry = self.manifest["files"][key]
+        entry["status"] = status
+        entry["output"] = output
+        entry["error"] = error
+        self.save()
+
+    def cleanup(self):
+        shutil.rmtree(self.job_dir, ignore_errors=True)
+
+def process_batch_files(uploaded_files, title_keywords, image_keywords, font_name, font_size, indent,
+                        redundant_keywords=None, near_duplicates=None, spool_threshold_mb=8, window=2,
+                        streaming=False, progress_callback=None, should_stop=None, export_format="docx",
+                        archive=None, template_path=None, output_zip=None, pool=None, models=None):
+    """
+    批量处理上传文件，返回处理结果字典（输出文件、失败文件、恢复的文件数和内存峰值）。
+    export_format为"ndjson"时每个文件输出NDJSON分类数据而不是Word文档；
+    指定output_zip时每个文件完成后立即写入该ZIP，不必等全部完成后再打包；
+    指定models（DocumentModelCache）时，预览或AI分析已解析过的文件直接使用缓存的文档模型。
+    不直接操作界面，可以在后台线程中运行；should_stop返回True时不再开始新的文件
+    """
+    if not uploaded_files:
+        return None
+    
+    # 近似重复检测要求文件按上传顺序逐个登记：同时处理的文件会逐段落相互比较，
+    # 结果取决于线程调度（两份相同的文件各被删掉约一半），因此逐个处理
+    if near_duplicates is not None:
+        window = 1
+    
+    # 打开可恢复的批处理任务（相同文件和设置会复用之前的任务目录）
+    settings = {
+        "title_keywords": title_keywords,
+        "image_keywords": image_keywords,
+        "redundant_keywords": redundant_keywords,
+        "font_name": font_name,
+        "font_size": font_size,
+        "indent": indent,
+        "streaming": streaming,
+        "export_format": export_format,
+        # 模板内容变化后不复用之前的输出
+        "template": [template_path, os.path.getmtime(template_path)] if template_path else None,
+        "near_duplicates": None if near_duplicates is None else [near_duplicates.threshold, near_duplicates.drop],
+    }
+    files = [(f.name, upload_digest(f)) for f in uploaded_files]
+    files_digests = [digest for _, digest in files]
+    batch_job = BatchJob.open(files, settings)
+    file_keys = [BatchJob.file_key(name, digest) for name, digest in files]
+    output_files = []
+    errors = []
+    
+    zip_writer = zipfile.ZipFile(output_zip, "w", zipfile.ZIP_DEFLATED) if output_zip else None
+    
+    # 跳过已完成的文件
+    remaining = []
+    for i, (uploaded_file, key) in enumerate(zip(uploaded_files, file_keys)):
+        if batch_job.is_done(key):
+            output_path = batch_job.manifest["files"][key]["output"]
+            output_files.append((i, os.path.basename(output_path), output_path))
+            if zip_writer is not None:
+                zip_writer.write(output_path, arcname=os.path.basename(output_path))
+            # 已完成文件的内容加入近似重复索引，保证后续文件仍能与其比较
+            if near_duplicates is not None:
+                for position, text in enumerate(trace_output_paragraphs(load_output_trace(output_path))):
+                    near_duplicates.add(text, uploaded_file.name, position)
+        else:
+            remaining.append((i, uploaded_file, key))
+    resumed = len(output_files)
+    
+    options = {
+        "title_keywords": title_keywords,
+        "image_keywords": image_keywords,
+        "font_name": font_name,
+        "font_size": font_size,
+        "indent": indent,
+        "redundant_keywords": redundant_keywords,
+        "near_duplicates": near_duplicates,
+        "streaming": streaming,
+        "export_format": export_format,
+        "archive": archive,
+        "template_path": template_path,
+        "pool": pool,
+    }
+    output_suffix = "_分类数据.ndjson" if export_format == "ndjson" else "_标准化处理.docx"
+    spool_threshold = int(spool_threshold_mb * 1024 * 1024)
+    total = len(uploaded_files)
+    files = iter(remaining)
+    pending = {}
+    file_values = {}
+    finished_count = resumed
+    stopped = False
+    
+    def make_progress_callback(index):
+        def update_file_progress(value, message=""):
+            file_values[index] = value
+            if should_stop and should_stop():
+                raise JobCancelled()
+        return update_file_progress
+    
+    process_task = profile_thread_task(process_uploaded_file)
+    zip_context = contextlib.closing(zip_writer) if zip_writer is not None else contextlib.nullcontext()
+    with zip_context, PeakMemoryMonitor() as memory, ThreadPoolExecutor(max_workers=window) as executor:
+        while True:
+            # 补充任务，同时处理的文件数不超过窗口大小
+            while not stopped and len(pending) < window:
+                if should_stop and should_stop():
+                    stopped = True
+                    break
+                item = next(files, None)
+                if item is None:
+                    break
+                i, uploaded_file, key = item
+                
+                # 创建输出文件路径
+                output_filename = output_stem(uploaded_file.name) + output_suffix
+                output_path = batch_job.output_path(output_filename)
+                
+                future = executor.submit(
+                    process_task,
+                    uploaded_file,
+                    output_path,
+                    spool_threshold,
+                    make_progress_callback(i),
+                    model=models.peek(files_digests[i]) if models is not None else None,
+                    **options
+                )
+                pending[future] = (i, uploaded_file, output_filename, output_path, key)
+                file_values[i] = 0
+            
+            if not pending:
+                break
+            
+            done, _ = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+            for future in done:
+                i, uploaded_file, output_filename, output_path, key = pending.pop(future)
+                name = uploaded_file.name
+                file_values.pop(i, None)
+                # 释放压缩包中文件的解压缓冲
+                if hasattr(uploaded_file, "release"):
+                    uploaded_file.release()
+                try:
+                    trace = future.result()
+                    if export_format != "ndjson":
+                        # 保存处理记录，预览时不再重新解析输出文档
+                        save_trace(trace, trace_path_for(output_path), name)
+                    batch_job.mark(key, "done", output=output_path)
+                    output_files.append((i, output_filename, output_path))
+                    if zip_writer is not None:
+                        zip_writer.write(output_path, arcname=output_filename)
+                    finished_count += 1
+                except JobCancelled:
+                    # 取消的文件保持未完成状态，重新运行任务时继续处理
+                    stopped = True
+                except Exception as e:
+                    batch_job.mark(key, "failed", error=str(e))
+                    errors.append((name, str(e)))
+                    finished_count += 1
+            
+            # 更新批量处理进度
+            if progress_callback:
+                in_flight_progress = sum(file_values.values()) / 100
+                in_flight = "、".join(entry[1].name for entry in pending.values())
+                progress_callback(
+                    int((finished_count + in_flight_progress) / total * 100),
+                    f"已完成 {finished_count}/{total}" + (f"，正在处理: {in_flight}" if in_flight else "")
+                )
+    
+    return {
+        # 按上传顺序返回
+        "output_files": [(filename, path) for _, filename, path in sorted(output_files)],
+        "errors": errors,
+        "resumed": resumed,
+        "stopped": stopped,
+        "memory": memory.summary(),
+        "job_dir": batch_job.job_dir,
+    }
+
+def create_zip_of_files(files):
+    import zipfile
+    
+    # 创建临时zip文件
+    temp_zip = tempfile.NamedTemporaryFile(suffix='.zip', delete=False)
+    temp_zip.close()
+    
+    # 添加文件到zip
+    with zipfile.ZipFile(temp_zip.name, 'w') as zipf:
+        for filename, filepath in files:
+            zipf.write(filepath, arcname=filename)
+    
+    return temp_zip.name
+
+# 共享任务队列的租约时长（秒）；工作进程每隔三分之一租约时长续约一次
+QUEUE_LEASE_SECONDS = 120
+# 共享任务队列中每个文件的最多尝试次数（处理失败或租约过期都计为一次）
+QUEUE_MAX_ATTEMPTS = 3
+
+class JobQueue:
+    """
+    基于SQLite的共享任务队列：多个工作进程（可以在共享同一文件系统的多台机器上）从队列领取文件处理任务。
+    领取任务时获得租约，处理期间定时续约；工作进程退出或失联导致租约过期后，任务由其他工作进程重新领取，
+    超过最多尝试次数后标记为失败
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS batches (
+            id TEXT PRIMARY KEY,
+            created REAL NOT NULL,
+            settings TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS tasks (
+            id INTEGER PRIMARY KEY,
+            batch_id TEXT NOT NULL REFERENCES batches(id) ON DELETE CASCADE,
+            position INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            source TEXT NOT NULL,
+            member TEXT,
+            output TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            worker TEXT,
+            lease_expires REAL,
+            error TEXT,
+            updated REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS tasks_status ON tasks(status, id);
+        CREATE INDEX IF NOT EXISTS tasks_batch ON tasks(batch_id, position);
+    """
+
+    def __init__(self, db_path, max_attempts=QUEUE_MAX_ATTEMPTS):
+        self.db_path = os.path.abspath(db_path)
+        self.max_attempts = max_attempts
+        conn = sqlite3.connect(self.db_path, timeout=60)
+        try:
+            conn.executescript(self.SCHEMA)
+        finally:
+            conn.close()
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # 队列文件可能位于多台机器共享的网络文件系统上，WAL模式依赖共享内存不能跨机器使用，
+        # 因此使用默认的回滚日志；每次操作都在写事务中进行，领取任务不会被两个工作进程同时拿到
+        conn = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+        try:
+            conn.execute("PRAGMA foreign_keys=ON")
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def batch_dir(self, batch_id):
+        """
+        批次的工作目录（与队列文件位于同一共享目录下），保存上传的输入文件和处理结果
+        """
+        return os.path.join(os.path.dirname(self.db_path), "WordFormatter_batches", batch_id)
+
+    def enqueue(self, items, settings, batch_id=None):
+        """
+        提交一批文件，items为 (文件名, 输入文件路径, 压缩包内文件名或None) 列表；
+        输出写入批次工作目录的outputs子目录。返回批次ID
+        """
+        batch_id = batch_id or uuid.uuid4().hex[:16]
+        output_dir = os.path.join(self.batch_dir(batch_id), "outputs")
+        os.makedirs(output_dir, exist_ok=True)
+        output_suffix = "_分类数据.ndjson" if settings.get("export_format") == "ndjson" else "_标准化处理.docx"
+        # 不同目录下的同名文件由不同工作进程处理，输出文件名加序号区分
+        outputs = []
+        used_stems = set()
+        for name, _, _ in items:
+            stem = output_stem(name)
+            candidate, n = stem, 1
+            while candidate in used_stems:
+                n += 1
+                candidate = f"{stem}_{n}"
+            used_stems.add(candidate)
+            outputs.append(os.path.join(output_dir, candidate + output_suffix))
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO batches (id, created, settings) VALUES (?, ?, ?)",
+                (batch_id, now, json.dumps(settings, ensure_ascii=False))
+            )
+            conn.executemany(
+                "INSERT INTO tasks (batch_id, position, name, source, member, output, updated) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (batch_id, position, name, os.path.abspath(source), member, output, now)
+                    for position, ((name, source, member), output) in enumerate(zip(items, outputs))
+                ]
+            )
+        return batch_id
+
+    def lease(self, worker_id, lease_seconds=QUEUE_LEASE_SECONDS):
+        """
+        领取一个待处理或租约已过期的任务，返回任务字典（含批次设置）；没有任务时返回None
+        """
+        now = time.time()
+        with self._connect() as conn:
+            # 租约过期且已用完尝试次数的任务不再分配
+            conn.execute(
+                """UPDATE tasks SET status = 'failed', worker = NULL, lease_expires = NULL, updated = ?,
+                          error = COALESCE(error, '处理超时：工作进程多次未能按时完成')
+                   WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?""",
+                (now, now, self.max_attempts)
+            )
+            row = conn.execute(
+                """SELECT t.id, t.batch_id, t.name, t.source, t.member, t.output, t.attempts, b.settings
+                   FROM tasks t JOIN batches b ON b.id = t.batch_id
+                   WHERE t.status = 'pending' OR (t.status = 'leased' AND t.lease_expires < ?)
+                   ORDER BY t.id
+                   LIMIT 1""",
+                (now,)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE tasks SET status = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1, updated = ? WHERE id = ?",
+                (worker_id, now + lease_seconds, now, row[0])
+            )
+        task_id, batch_id, name, source, member, output, attempts, settings = row
+        return {
+            "id": task_id,
+            "batch_id": batch_id,
+            "name": name,
+            "source": source,
+            "member": member,
+            "output": output,
+            "attempt": attempts + 1,
+            "settings": json.loads(settings),
+        }
+
+    def heartbeat(self, task_id, worker_id, lease_seconds=QUEUE_LEASE_SECONDS):
+        """
+        续约，返回该工作进程是否仍持有任务（租约过期后被其他工作进程领取时返回False）
+        """
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE tasks SET lease_expires = ?, updated = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+                (now + lease_seconds, now, task_id, worker_id)
+            )
+        return cursor.rowcount == 1
+
+    def complete(self, task_id, worker_id):
+        with self._connect() as conn:
+            cursor = conn.execute(
+                """UPDATE tasks SET status = 'done', worker = NULL, lease_expires = NULL, error = NULL, updated = ?
+                   WHERE id = ? AND worker = ? AND status = 'leased'""",
+                (time.time(), task_id, worker_id)
+            )
+        return cursor.rowcount == 1
+
+    def fail(self, task_id, worker_id, error):
+        """
+        记录处理失败；未用完尝试次数时重新排队
+        """
+        with self._connect() as conn:
+            cursor = conn.execute(
+                """UPDATE tasks SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END,
+                          worker = NULL, lease_expires = NULL, error = ?, updated = ?
+                   WHERE id = ? AND worker = ? AND status = 'leased'""",
+                (self.max_attempts, error, time.time(), task_id, worker_id)
+            )
+        return cursor.rowcount == 1
+
+    def release(self, task_id, worker_id):
+        """
+        工作进程正常停止时交还任务：重新排队，本次领取不计入尝试次数
+        """
+        with self._connect() as conn:
+            cursor = conn.execute(
+                """UPDATE tasks SET status = 'pending', attempts = MAX(attempts - 1, 0),
+                          worker = NULL, lease_expires = NULL, updated = ?
+                   WHERE id = ? AND worker = ? AND status = 'leased'""",
+                (time.time(), task_id, worker_id)
+            )
+        return cursor.rowcount == 1
+
+    def cancel(self, batch_id):
+        """
+        取消批次中尚未开始的任务（正在处理的任务会继续完成）
+        """
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE tasks SET status = 'cancelled', updated = ? WHERE batch_id = ? AND status = 'pending'",
+                (time.time(), batch_id)
+            )
+
+    def progress(self, batch_id):
+        """
+        返回批次中各状态的任务数和正在处理的工作进程数
+        """
+        with self._connect() as conn:
+            counts = dict(conn.execute(
+                "SELECT status, COUNT(*) FROM tasks WHERE batch_id = ? GROUP BY status", (batch_id,)
+            ).fetchall())
+            workers = conn.execute(
+                "SELECT COUNT(DISTINCT worker) FROM tasks WHERE batch_id = ? AND status = 'leased'", (batch_id,)
+            ).fetchone()[0]
+        counts["total"] = sum(counts.values())
+        counts["workers"] = workers
+        return counts
+
+    def tasks(self, batch_id):
+        """
+        按提交顺序返回批次中的任务 (任务ID, 文件名, 输出路径, 状态, 错误信息)
+        """
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT id, name, output, status, error FROM tasks WHERE batch_id = ? ORDER BY position", (batch_id,)
+            ).fetchall()
+
+    def remove_batch(self, batch_id):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM batches WHERE id = ?", (batch_id,))
+        shutil.rmtree(self.batch_dir(batch_id), ignore_errors=True)
+
+def run_queue_task(task, archive=None, progress_callback=None):
+    """
+    按任务中的批次设置处理一个文件。先写入临时文件再替换为输出路径，
+    租约过期后两个工作进程处理同一文件时也不会留下不完整的输出
+    """
+    settings = dict(task["settings"])
+    export_format = settings.pop("export_format", "docx")
+    output_path = task["output"]
+    temp_output = f"{output_path}.{uuid.uuid4().hex[:8]}.part"
+    with contextlib.ExitStack() as stack:
+        source = task["source"]
+        if task["member"]:
+            # 压缩包中的文件直接从共享目录下的压缩包读取，不解压到磁盘
+            source = io.BytesIO(stack.enter_context(zipfile.ZipFile(source)).read(task["member"]))
+        process = export_ndjson if export_format == "ndjson" else process_docx
+        try:
+            trace = process(source, temp_output, progress_callback=progress_callback, source_name=task["name"],
+                            archive=archive, **settings)
+            if export_format != "ndjson":
+                save_trace(trace, temp_output + ".trace", task["name"])
+                os.replace(temp_output + ".trace", trace_path_for(output_path))
+            os.replace(temp_output, output_path)
+        finally:
+            for path in (temp_output, temp_output + ".trace"):
+                if os.path.exists(path):
+                    os.unlink(path)
+
+def run_queue_worker(queue, worker_id=None, lease_seconds=QUEUE_LEASE_SECONDS, poll_interval=2,
+                     exit_when_idle=False, should_stop=None, archive=None, log=None):
+    """
+    工作进程主循环：领取任务、处理期间后台续约、完成后报告结果。
+    exit_when_idle为True时队列为空即退出，否则持续等待新任务；返回处理成功的文件数
+    """
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    log = log or (lambda message: None)
+    processed = 0
+    while not (should_stop and should_stop()):
+        task = queue.lease(worker_id, lease_seconds)
+        if task is None:
+            if exit_when_idle:
+                break
+            time.sleep(poll_interval)
+            continue
+        
+        finished = threading.Event()
+        lease_lost = threading.Event()
+        
+        def keep_lease():
+            while not finished.wait(lease_seconds / 3):
+                try:
+                    if not queue.heartbeat(task["id"], worker_id, lease_seconds):
+                        lease_lost.set()
+                        return
+                except sqlite3.Error:
+                    pass  # 数据库暂时不可用，下次再续约
+        
+        def check_lease(value, message=""):
+            # 租约已被其他工作进程接手时放弃当前文件
+            if lease_lost.is_set() or (should_stop and should_stop()):
+                raise JobCancelled()
+        
+        heartbeat_thread = threading.Thread(target=keep_lease, daemon=True)
+        heartbeat_thread.start()
+        log(f"开始处理 {task['name']}（第 {task['attempt']} 次尝试）")
+        try:
+            run_queue_task(task, archive, check_lease)
+            if queue.complete(task["id"], worker_id):
+                processed += 1
+                log(f"✅ 完成 {task['name']}")
+        except JobCancelled:
+            if lease_lost.is_set():
+                log(f"租约已过期，放弃 {task['name']}")
+            else:
+                # 工作进程停止时把任务放回队列，由其他工作进程继续处理（不计入尝试次数）
+                queue.release(task["id"], worker_id)
+                log(f"工作进程停止，{task['name']} 已放回队列")
+        except Exception as e:
+            queue.fail(task["id"], worker_id, str(e))
+            log(f"❌ 处理 {task['name']} 失败: {str(e)}")
+        finally:
+            finished.set()
+            heartbeat_thread.join()
+    return processed
+
+def stage_uploads(uploaded_files, input_dir):
+    """
+    将上传文件分块写入共享目录，返回可提交到任务队列的 (文件名, 路径, None) 列表
+    """
+    os.makedirs(input_dir, exist_ok=True)
+    items = []
+    for position, uploaded_file in enumerate(uploaded_files):
+        path = os.path.join(input_dir, f"{position:05d}.docx")
+        uploaded_file.seek(0)
+        source = uploaded_file.open_stream() if hasattr(uploaded_file, "open_stream") else uploaded_file
+        with open(path, "wb") as f:
+            shutil.copyfileobj(source, f, 1024 * 1024)
+        if hasattr(uploaded_file, "release"):
+            uploaded_file.release()
+        items.append((uploaded_file.name, path, None))
+    return items
+
+def process_batch_via_queue(queue, uploaded_files, options, progress_callback=None, should_stop=None, output_zip=None):
+    """
+    把上传文件写入共享目录并提交到任务队列，等待工作进程处理完成。
+    近似重复索引和检索归档只在本进程内有效，队列处理时不使用
+    """
+    settings = {
+        key: options[key]
+        for key in ("title_keywords", "image_keywords", "redundant_keywords", "font_name", "font_size", "indent",
+                    "streaming", "export_format", "template_path")
+    }
+    batch_id = uuid.uuid4().hex[:16]
+    if progress_callback:
+        progress_callback(0, "正在把文件写入共享目录...")
+    items = stage_uploads(uploaded_files, os.path.join(queue.batch_dir(batch_id), "inputs"))
+    queue.enqueue(items, settings, batch_id)
+    return wait_for_queue_batch(queue, batch_id, progress_callback, should_stop, output_zip)
+
+def wait_for_queue_batch(queue, batch_id, progress_callback=None, should_stop=None, output_zip=None, poll_interval=1):
+    """
+    等待共享队列中的批次处理完成，汇总进度；指定output_zip时每个文件完成后立即写入该ZIP。
+    返回与process_batch_files相同格式的结果字典
+    """
+    written = set()
+    stopped = False
+    zip_writer = zipfile.ZipFile(output_zip, "w", zipfile.ZIP_DEFLATED) if output_zip else None
+    zip_context = contextlib.closing(zip_writer) if zip_writer is not None else contextlib.nullcontext()
+    with zip_context:
+        while True:
+            if not stopped and should_stop and should_stop():
+                queue.cancel(batch_id)
+                stopped = True
+            
+            counts = queue.progress(batch_id)
+            if zip_writer is not None:
+                for task_id, _, output_path, status, _ in queue.tasks(batch_id):
+                    if status == "done" and task_id not in written:
+                        zip_writer.write(output_path, arcname=os.path.basename(output_path))
+                        written.add(task_id)
+            
+            finished = counts.get("done", 0) + counts.get("failed", 0)
+            if progress_callback:
+                total = counts["total"] or 1
+                progress_callback(
+                    int(finished / total * 100),
+                    f"已完成 {finished}/{counts['total']}，{counts['workers']} 个工作进程正在处理，"
+                    f"等待处理 {counts.get('pending', 0)} 个"
+                )
+            if counts.get("pending", 0) == 0 and counts.get("leased", 0) == 0:
+                break
+            if stopped:
+                break
+            time.sleep(poll_interval)
+    
+    tasks = queue.tasks(batch_id)
+    return {
+        "output_files": [
+            (os.path.basename(output_path), output_path)
+            for _, _, output_path, status, _ in tasks if status == "done" and os.path.exists(output_path)
+        ],
+        "errors": [(name, error) for _, name, _, status, error in tasks if status == "failed"],
+        "resumed": 0,
+        "stopped": stopped,
+        "memory": None,
+        "job_dir": queue.batch_dir(batch_id),
+        "queue": queue,
+        "batch_id": batch_id,
+    }
+
+class JobCancelled(Exception):
+    """
+    后台任务被取消
+    """
+
+class BackgroundJob:
+    """
+    后台任务的状态、进度和结果
+    """
+    def __init__(self, job_id, session_id, label, fn, meta=None, cleanup=None):
+        self.job_id = job_id
+        self.session_id = session_id
+        self.label = label
+        self.fn = fn
+        self.meta = meta or {}
+        self.cleanup = cleanup
+        self.status = "queued"
+        self.progress = 0
+        self.message = "排队中..."
+        self.result = None
+        self.error = None
+        self.traceback = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self._cancel_event = threading.Event()
+
+    @property
+    def active(self):
+        return self.status in ("queued", "running")
+
+    def report(self, value, message=""):
+        """
+        进度回调；任务已被取消时抛出JobCancelled，作为协作式取消点
+        """
+        self.progress = value
+        if message:
+            self.message = message
+        if self._cancel_event.is_set():
+            raise JobCancelled()
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+class BackgroundJobExecutor:
+    """
+    进程级的后台任务执行器，所有会话共享。任务按会话分别排队，
+    空闲的工作线程轮流从各会话的队列中取任务，单个用户的大批量任务不会占满服务器
+    """
+    def __init__(self, max_workers=2, keep_seconds=3600):
+        self.keep_seconds = keep_seconds
+        self.jobs = {}
+        self.queues = collections.OrderedDict()
+        self.condition = threading.Condition()
+        for i in range(max_workers):
+            threading.Thread(target=self._worker, name=f"WordFormatterJob-{i}", daemon=True).start()
+
+    def submit(self, session_id, label, fn, meta=None, cleanup=None):
+        """
+        提交任务，fn接收BackgroundJob作为参数，返回值保存为任务结果
+        """
+        job = BackgroundJob(uuid.uuid4().hex[:12], session_id, label, fn, meta=meta, cleanup=cleanup)
+        with self.condition:
+            self._prune()
+            self.jobs[job.job_id] = job
+            self.queues.setdefault(session_id, collections.deque()).append(job)
+            self.condition.notify()
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id) if job_id else None
+
+    def queue_position(self, job):
+        """
+        返回排队任务前面还有多少个任务（按轮询顺序估算）
+        """
+        with self.condition:
+            queue = self.queues.get(job.session_id, ())
+            ahead = list(queue).index(job) if job in queue else 0
+            return sum(min(len(q), ahead + 1) for sid, q in self.queues.items() if sid != job.session_id) + ahead
+
+    def discard(self, job_id):
+        """
+        取消并移除任务，释放其结果占用的文件
+        """
+        with self.condition:
+            job = self.jobs.pop(job_id, None)
+        if job is None:
+            return
+        job.cancel()
+        if not job.active:
+            self._cleanup(job)
+
+    def _cleanup(self, job):
+        if job.cleanup:
+            try:
+                job.cleanup(job)
+            except Exception:
+                pass
+
+    def _prune(self):
+        # 移除结束较久的任务
+        cutoff = time.time() - self.keep_seconds
+        for job_id, job in list(self.jobs.items()):
+            if job.finished and job.finished < cutoff:
+                del self.jobs[job_id]
+                self._cleanup(job)
+
+    def _next_job(self):
+        # 轮询各会话的队列：取出队首会话的任务后把该会话移到末尾
+        while self.queues:
+            session_id, queue = next(iter(self.queues.items()))
+            job = queue.popleft()
+            if queue:
+                self.queues.move_to_end(session_id)
+            else:
+                del self.queues[session_id]
+            if job.cancelled():
+                job.status = "cancelled"
+                job.finished = time.time()
+                continue
+            return job
+        return None
+
+    def _worker(self):
+        while True:
+            with self.condition:
+                job = self._next_job()
+                while job is None:
+                    self.condition.wait()
+                    job = self._next_job()
+                job.status = "running"
+                job.message = "处理中..."
+                job.started = time.time()
+            
+            try:
+                job.result = job.fn(job)
+                job.status = "cancelled" if job.cancelled() else "done"
+                if job.status == "done":
+                    job.progress = 100
+            except JobCancelled:
+                job.status = "cancelled"
+            except Exception as e:
+                job.status = "failed"
+                job.error = str(e)
+                job.traceback = traceback.format_exc()
+            finally:
+                job.finished = time.time()
+            
+            # 任务在运行期间被移除时，结束后再释放其文件
+            if job.job_id not in self.jobs:
+                self._cleanup(job)
+
+# 后台工作线程数
+BACKGROUND_WORKERS = 2
+
+@st.cache_resource
+def get_job_executor():
+    """
+    获取所有会话共享的后台任务执行器
+    """
+    return BackgroundJobExecutor(max_workers=BACKGROUND_WORKERS)
+
+# 处理结果（下载文件）的存储目录，每个服务进程一个子目录
+ARTIFACTS_ROOT = os.path.join(tempfile.gettempdir(), "WordFormatter_artifacts")
+# 处理结果最后一次访问后的保留时间（秒）
+ARTIFACT_TTL_SECONDS = 3600
+# 所有会话的处理结果（下载文件）占用磁盘的上限；批处理任务目录（JOBS_ROOT）另行按保留天数清理，不计入
+ARTIFACT_QUOTA_BYTES = 2 * 1024 * 1024 * 1024
+# 服务进程运行期间一直锁定的文件，其他进程据此判断存储目录是否仍在使用
+ARTIFACT_LOCK_FILE = ".lock"
+
+# 处理结果已被清理时的提示
+ARTIFACT_EXPIRED_MESSAGE = "处理结果已超过保留时间或因磁盘空间限制被清理，请重新处理"
+
+class ArtifactStore:
+    """
+    处理结果文件的托管存储，所有会话共享：每个会话一个子目录，结果在最后一次访问（预览、下载）后
+    保留ttl_seconds；总大小超过quota_bytes时先删除最久未访问的结果。正在写入的结果不会被删除
+    """
+    def __init__(self, root, ttl_seconds=ARTIFACT_TTL_SECONDS, quota_bytes=ARTIFACT_QUOTA_BYTES):
+        self.root = root
+        self.ttl_seconds = ttl_seconds
+        self.quota_bytes = quota_bytes
+        # 路径 -> {"session": 会话ID, "size": 字节数, "accessed": 最后访问时间, "pinned": 是否正在写入}，按访问先后排列
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.lock_file = None
+
+    def claim(self):
+        """
+        创建存储目录并锁定其中的锁文件，服务进程退出前一直持有，其他进程启动时不会删除这个目录
+        """
+        os.makedirs(self.root, exist_ok=True)
+        self.lock_file = lock_file(os.path.join(self.root, ARTIFACT_LOCK_FILE))
+
+    def allocate(self, session_id, suffix="", directory=False):
+        """
+        在会话目录中创建一个新的结果文件（或目录），写入完成后调用commit()
+        """
+        self.sweep()
+        session_dir = os.path.join(self.root, session_id)
+        os.makedirs(session_dir, exist_ok=True)
+        if directory:
+            path = tempfile.mkdtemp(suffix=suffix, dir=session_dir)
+        else:
+            fd, path = tempfile.mkstemp(suffix=suffix, dir=session_dir)
+            os.close(fd)
+        with self.lock:
+            self.entries[path] = {"session": session_id, "size": 0, "accessed": time.time(), "pinned": True}
+        return path
+
+    def commit(self, path):
+        """
+        结果写入完成：记录占用的大小，之后可以按保留时间和磁盘配额清理
+        """
+        size = directory_size(path) if os.path.isdir(path) else os.path.getsize(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None:
+                entry.update(size=size, accessed=time.time(), pinned=False)
+                self.entries.move_to_end(path)
+        self.sweep()
+        return path
+
+    def touch(self, path):
+        """
+        记录一次访问，返回结果是否仍然存在（已过期或超出配额被清理时返回False）
+        """
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None:
+                entry["accessed"] = time.time()
+                self.entries.move_to_end(path)
+        return bool(path) and os.path.exists(path)
+
+    def release(self, path):
+        with self.lock:
+            self.entries.pop(path, None)
+        remove_path(path)
+
+    def sweep(self):
+        """
+        删除过期的结果，再按最久未访问的顺序删除结果直到总大小不超过配额
+        """
+        cutoff = time.time() - self.ttl_seconds
+        removed = []
+        with self.lock:
+            for path, entry in list(self.entries.items()):
+                if not entry["pinned"] and entry["accessed"] < cutoff:
+                    removed.append(path)
+                    del self.entries[path]
+            total = sum(entry["size"] for entry in self.entries.values())
+            for path, entry in list(self.entries.items()):
+                if total <= self.quota_bytes:
+                    break
+                if not entry["pinned"]:
+                    removed.append(path)
+                    total -= entry["size"]
+                    del self.entries[path]
+        for path in removed:
+            remove_path(path)
+        return len(removed)
+
+    def usage(self, session_id=None):
+        """
+        返回 (结果数, 占用字节数)；指定session_id时只统计该会话
+        """
+        with self.lock:
+            sizes = [entry["size"] for entry in self.entries.values() if session_id in (None, entry["session"])]
+        return len(sizes), sum(sizes)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+        shutil.rmtree(self.root, ignore_errors=True)
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+def remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif path and os.path.exists(path):
+        os.unlink(path)
+
+def lock_file(path):
+    """
+    以非阻塞方式独占锁定文件，返回打开的文件对象（关闭即释放锁，进程退出时由系统释放）；
+    文件已被其他进程锁定时返回None
+    """
+    f = open(path, "a+b")
+    try:
+        if os.name == "nt":
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+def remove_stale_artifact_roots(root=ARTIFACTS_ROOT, min_age_seconds=60):
+    """
+    删除已退出的服务进程留下的存储目录：锁文件没有被任何进程持有即可删除。
+    跳过刚创建的目录（对应的进程可能还没来得及锁定）
+    """
+    if not os.path.isdir(root):
+        return
+    cutoff = time.time() - min_age_seconds
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        try:
+            if not os.path.isdir(path) or os.path.getmtime(path) > cutoff:
+                continue
+            handle = lock_file(os.path.join(path, ARTIFACT_LOCK_FILE))
+        except OSError:
+            continue
+        if handle is None:
+            continue  # 其他服务进程正在使用
+        handle.close()
+        shutil.rmtree(path, ignore_errors=True)
+
+@st.cache_resource(ttl=60, show_spinner=False)
+def batch_jobs_usage():
+    """
+    批处理任务目录占用的字节数（每分钟最多统计一次）
+    """
+    return directory_size(JOBS_ROOT) if os.path.isdir(JOBS_ROOT) else 0
+
+@st.cache_resource
+def get_artifact_store():
+    """
+    获取所有会话共享的处理结果存储；服务进程退出时删除全部结果。
+    启动时清理之前异常退出的进程留下的目录（锁文件已无进程持有）
+    """
+    remove_stale_artifact_roots()
+    store = ArtifactStore(os.path.join(ARTIFACTS_ROOT, str(os.getpid())))
+    # 进程ID在运行中的进程之间唯一，同名目录只可能是以前使用相同ID的进程留下的
+    shutil.rmtree(store.root, ignore_errors=True)
+    store.claim()
+    atexit.register(store.clear)
+    return store
+
+# 共享进程池的工作进程数（保留一个CPU给界面和后台线程）
+PROCESS_POOL_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))
+# 进程池记住的已预热配置数，超出后最早的配置再次使用时重新预热
+PROCESS_POOL_WARMED_CONFIGS = 8
+
+class ProcessingPool:
+    """
+    预热的进程池，所有会话共享：工作进程启动时已导入python-docx、解析输出模板并编译关键词匹配，
+    第一个文件与之后的文件一样快；输出模板或关键词变化后，工作进程在处理文件前按文件的配置自行预热，warm()可以提前触发。
+    各会话的任务仍由BackgroundJobExecutor轮流调度，进程池只负责执行
+    """
+    def __init__(self, processes=PROCESS_POOL_WORKERS, template_path=None, keyword_lists=()):
+        import WordFormatter_worker
+        self.worker = WordFormatter_worker
+        self.processes = processes
+        self.broken = False
+        # Streamlit服务器是多线程进程，fork会复制其他线程持有的锁，因此统一使用spawn（Windows上也只能使用spawn）
+        self.executor = ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=WordFormatter_worker.warm_up,
+            initargs=(template_path, keyword_lists)
+        )
+        # 立即启动全部工作进程并在后台预热，不等第一个文件提交
+        self.warm_up = [self.executor.submit(WordFormatter_worker.ping) for _ in range(processes)]
+        self.warmed = collections.deque([warm_up_key(template_path, keyword_lists)], maxlen=PROCESS_POOL_WARMED_CONFIGS)
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return all(future.done() for future in self.warm_up)
+
+    def warm(self, template_path=None, keyword_lists=()):
+        """
+        配置变化后提前预热工作进程：按进程数提交预热任务，但不保证每个工作进程都分到一个，
+        只是尽力而为；没有分到的工作进程在处理下一个文件前自行预热（WordFormatter_worker.process_file）
+        """
+        key = warm_up_key(template_path, keyword_lists)
+        with self._lock:
+            if key in self.warmed:
+                return
+            self.warmed.append(key)
+        try:
+            for _ in range(self.processes):
+                self.executor.submit(self.worker.warm_up, template_path, keyword_lists)
+        except BrokenProcessPool:
+            self.broken = True
+
+    def run(self, source, output_path, export_format="docx", progress_callback=None, **options):
+        """
+        在工作进程中处理一个文件，source为文件路径、文件内容（bytes）或DocumentModel，返回处理记录。
+        等待期间通过progress_callback检查取消；已经开始处理的文件会等它完成后再取消
+        """
+        if hasattr(source, "indexes"):
+            source = source.state()
+        # 归档在工作进程中按路径重新打开（连接不能跨进程传递）
+        archive = options.pop("archive", None)
+        archive_path = archive.db_path if archive is not None else None
+        try:
+            future = self.executor.submit(self.worker.process_file, source, output_path, export_format, options, archive_path)
+        except BrokenProcessPool:
+            self.broken = True
+            raise RuntimeError("工作进程异常退出，请重新处理")
+        try:
+            while not wait([future], timeout=0.2)[0]:
+                if progress_callback:
+                    progress_callback(50 if future.running() else 0, "处理中..." if future.running() else "等待工作进程...")
+        except BaseException:
+            if not future.cancel():
+                wait([future])
+            raise
+        try:
+            trace = future.result()
+        except BrokenProcessPool:
+            self.broken = True
+            raise RuntimeError("工作进程异常退出，请重新处理")
+        if progress_callback:
+            progress_callback(100, "处理完成")
+        return trace
+
+    def parse(self, source):
+        """
+        在工作进程中解析文档，返回结果为DocumentModel.state()的Future
+        """
+        try:
+            return self.executor.submit(self.worker.parse_document, source)
+        except BrokenProcessPool:
+            self.broken = True
+            raise RuntimeError("工作进程异常退出，请重新处理")
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+def warm_up_key(template_path, keyword_lists):
+    # 模板文件修改后视为新的配置
+    mtime = os.path.getmtime(template_path) if template_path and os.path.exists(template_path) else None
+    return template_path, mtime, tuple(tuple(keywords) for keywords in keyword_lists)
+
+@st.cache_resource(validate=lambda pool: not pool.broken, show_spinner=False)
+def open_processing_pool():
+    """
+    创建所有会话共享的进程池，以第一个会话的输出模板和关键词预热；工作进程异常退出后重新创建
+    """
+    return ProcessingPool(
+        template_path=get_template_path(),
+        keyword_lists=(st.session_state.title_keywords, st.session_state.image_keywords, st.session_state.redundant_keywords)
+    )
+
+def get_processing_pool():
+    """
+    返回共享进程池并按当前会话的输出模板和关键词预热，未启用进程池或无法启动时返回None（在后台线程中处理）
+    """
+    if not st.session_state.get('process_pool', False):
+        return None
+    try:
+        pool = open_processing_pool()
+        pool.warm(get_template_path(),
+                  (st.session_state.title_keywords, st.session_state.image_keywords, st.session_state.redundant_keywords))
+        return pool
+    except Exception:
+        return None
+
+@st.cache_resource
+def open_document_archive(db_path):
+    """
+    打开检索归档数据库，进程内所有会话共享
+    """
+    return DocumentArchive(db_path)
+
+def get_document_archive():
+    """
+    返回当前配置目录下的检索归档，未启用归档时返回None
+    """
+    if not st.session_state.get('archive_enabled', True):
+        return None
+    config_dir = get_config_dir()
+    if not config_dir:
+        return None
+    return open_document_archive(os.path.join(config_dir, ARCHIVE_FILENAME))
+
+@st.cache_resource
+def open_job_queue(db_path):
+    """
+    打开共享任务队列，进程内所有会话共享
+    """
+    return JobQueue(db_path)
+
+def get_job_queue():
+    """
+    返回系统设置中配置的共享任务队列，未配置时返回None
+    """
+    queue_path = st.session_state.get('queue_path')
+    if not queue_path:
+        return None
+    return open_job_queue(os.path.abspath(queue_path))
+
+# 单位模板在配置目录中的文件名
+HOUSE_TEMPLATE_FILENAME = "house_template.docx"
+
+def get_template_path():
+    """
+    返回当前使用的输出模板路径，未设置单位模板或模板文件不存在时返回None（使用默认模板）
+    """
+    template_path = st.session_state.get('template_path')
+    if template_path and os.path.exists(template_path):
+        return template_path
+    return None
+
+def get_session_id():
+    if 'session_id' not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+    return st.session_state.session_id
+
+# AI请求失败时可以重试的HTTP状态码
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+
+class AIServiceError(Exception):
+    """
+    AI服务调用失败（已按超时和重试策略处理）
+    """
+
+class AICircuitOpenError(AIServiceError):
+    """
+    AI服务连续失败，熔断期间不再发起请求
+    """
+
+def is_retryable_ai_error(error):
+    """
+    判断AI请求错误是否为暂时性错误（超时、连接失败、限流和服务端错误），兼容新旧版openai
+    """
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    status = getattr(error, "status_code", None) or getattr(error, "http_status", None)
+    if isinstance(status, int):
+        return status in RETRYABLE_STATUS_CODES or status >= 500
+    name = type(error).__name__
+    return any(k in name for k in ("Timeout", "Connection", "RateLimit", "ServiceUnavailable"))
+
+def retry_after_seconds(error):
+    """
+    读取限流响应中的Retry-After头，没有时返回None
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or getattr(error, "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+class LatencyTracker:
+    """
+    记录最近成功请求的耗时，用于计算延迟分位数
+    """
+    def __init__(self, window=200):
+        self.samples = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.samples)
+
+    def record(self, seconds):
+        with self._lock:
+            self.samples.append(seconds)
+
+    def percentile(self, p):
+        with self._lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+class CircuitBreaker:
+    """
+    熔断器：连续失败达到阈值后在冷却时间内拒绝请求，冷却结束后放行一个试探请求
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half_open"
+
+    def before_call(self):
+        """
+        请求前检查状态；本次请求是试探请求时返回True，调用方结束后必须调用release_probe
+        """
+        with self._lock:
+            state = self.state
+            if state == "open" or (state == "half_open" and self.probing):
+                wait_seconds = max(0, self.reset_timeout - (time.monotonic() - self.opened_at))
+                raise AICircuitOpenError(f"AI服务连续 {self.failures} 次请求失败，已暂停调用，请在 {wait_seconds:.0f} 秒后重试")
+            if state == "half_open":
+                self.probing = True
+                return True
+            return False
+
+    def release_probe(self):
+        # 试探请求以不计入熔断的方式结束（参数错误、超时、被中断）时释放试探名额，熔断状态不变
+        with self._lock:
+            self.probing = False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.probing = False
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+class AIEndpointHealth:
+    """
+    同一API地址和模型的调用状态（延迟、熔断器和计数），所有会话共享
+    """
+    def __init__(self):
+        self.latency = LatencyTracker()
+        self.breaker = CircuitBreaker()
+        self.counts = collections.Counter()
+
+    def summary(self):
+        p50 = self.latency.percentile(0.5)
+        p95 = self.latency.percentile(0.95)
+        parts = [f"成功 {self.counts['success']} 次", f"失败 {self.counts['failure']} 次", f"重试 {self.counts['retry']} 次"]
+        if p50 is not None:
+            parts.append(f"延迟 P50 {p50:.1f}s / P95 {p95:.1f}s")
+        if self.counts["hedge"]:
+            parts.append(f"备份请求 {self.counts['hedge']} 次（胜出 {self.counts['hedge_win']} 次）")
+        state = {"closed": "正常", "open": "熔断中", "half_open": "试探恢复"}[self.breaker.state]
+        parts.append(f"状态: {state}")
+        return "，".join(parts)
+
+class AIClient:
+    """
+    带超时、重试和熔断的AI调用层：
+    - 每次调用有总期限，单次请求超时不超过剩余时间
+    - 暂时性错误按带随机抖动的指数退避重试
+    - 请求耗时超过历史延迟分位数时发送一个备份请求，取先返回的结果
+    """
+    def __init__(self, api_key, model, api_base=None, timeout=60, attempt_timeout=30, max_retries=3,
+                 backoff_base=0.5, backoff_max=8.0, hedge=True, hedge_percentile=0.95, min_hedge_samples=10,
+                 health=None):
+        self.api_key = api_key
+        self.model = model
+        self.api_base = api_base.strip() if api_base else ""
+        self.timeout = timeout
+        self.attempt_timeout = attempt_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_samples = min_hedge_samples
+        self.health = health or AIEndpointHealth()
+
+    def _create(self, messages, timeout, stream=False, **params):
+        # 根据API版本调用不同的方法；重试由本类负责，关闭SDK自带的重试
+        if is_old_api:
+            openai.api_key = self.api_key
+            if self.api_base:
+                openai.api_base = self.api_base
+            # noinspection PyUnresolvedReferences
+            return openai.ChatCompletion.create(
+                model=self.model,
+                messages=messages,
+                stream=stream,
+                request_timeout=timeout,
+                **params
+            )
+        client_params = {"api_key": self.api_key, "max_retries": 0, "timeout": timeout}
+        if self.api_base:
+            client_params["base_url"] = self.api_base
+        client = openai.OpenAI(**client_params)
+        return client.chat.completions.create(model=self.model, messages=messages, stream=stream, **params)
+
+    def _timed_request(self, messages, timeout, params):
+        start = time.monotonic()
+        response = self._create(messages, timeout, **params)
+        self.health.latency.record(time.monotonic() - start)
+        return response.choices[0].message.content
+
+    def hedge_delay(self):
+        """
+        发送备份请求前的等待时间；样本不足或未启用时返回None
+        """
+        if not self.hedge or len(self.health.latency) < self.min_hedge_samples:
+            return None
+        return self.health.latency.percentile(self.hedge_percentile)
+
+    def _attempt(self, messages, timeout, params):
+        # 请求在线程中运行，超过单次超时直接返回，不等待卡住的连接
+        pool = ThreadPoolExecutor(max_workers=2)
+        try:
+            end = time.monotonic() + timeout
+            futures = [pool.submit(self._timed_request, messages, timeout, params)]
+            delay = self.hedge_delay()
+            if delay is not None and delay < timeout:
+                done, _ = wait(futures, timeout=delay)
+                if not done:
+                    futures.append(pool.submit(self._timed_request, messages, max(0.1, end - time.monotonic()), params))
+                    self.health.counts["hedge"] += 1
+            hedged = futures[1] if len(futures) > 1 else None
+            
+            error = None
+            remaining = list(futures)
+            while remaining:
+                done, _ = wait(remaining, timeout=max(0, end - time.monotonic()), return_when=FIRST_COMPLETED)
+                if not done:
+                    raise TimeoutError(f"AI请求超过 {timeout:.0f} 秒未响应")
+                for future in done:
+                    remaining.remove(future)
+                    if future.exception() is None:
+                        if future is hedged:
+                            self.health.counts["hedge_win"] += 1
+                        return future.result()
+                    error = future.exception()
+            raise error
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def _backoff(self, attempt, error, remaining):
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        retry_after = retry_after_seconds(error)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return min(delay, remaining)
+
+    def _run_with_retries(self, call):
+        deadline = time.monotonic() + self.timeout
+        attempt = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise AIServiceError(f"AI请求超时（超过 {self.timeout} 秒）")
+            probe = self.health.breaker.before_call()
+            try:
+                result = call(min(self.attempt_timeout, remaining))
+            except Exception as e:
+                if not is_retryable_ai_error(e):
+                    # 参数、认证等错误重试也不会成功，不计入熔断
+                    self.health.counts["failure"] += 1
+                    raise AIServiceError(str(e)) from e
+                self.health.breaker.record_failure()
+                remaining = deadline - time.monotonic()
+                if attempt >= self.max_retries or remaining <= 0:
+                    self.health.counts["failure"] += 1
+                    raise AIServiceError(f"AI请求失败（已重试 {attempt} 次）: {e}") from e
+                time.sleep(self._backoff(attempt, e, remaining))
+                attempt += 1
+                self.health.counts["retry"] += 1
+                continue
+            else:
+                self.health.breaker.record_success()
+            finally:
+                if probe:
+                    self.health.breaker.release_probe()
+            self.health.counts["success"] += 1
+            return result
+
+    def complete(self, messages, **params):
+        """
+        发送聊天请求并返回回复文本
+        """
+        return self._run_with_retries(lambda timeout: self._attempt(messages, timeout, params))
+
+    def stream(self, messages, **params):
+        """
+        流式返回回复文本片段；只在收到第一个片段前重试，之后出错直接抛出
+        """
+        deadline = time.monotonic() + self.timeout
+        start = time.monotonic()
+        response = self._run_with_retries(lambda timeout: self._create(messages, timeout, stream=True, **params))
+        first_chunk = True
+        try:
+            for chunk in response:
+                if time.monotonic() > deadline:
+                    raise AIServiceError(f"AI回复超时（超过 {self.timeout} 秒）")
+                if not chunk.choices:
+                    continue
+                if is_old_api:
+                    content = chunk.choices[0].get("delta", {}).get("content")
+                else:
+                    content = chunk.choices[0].delta.content
+                if content:
+                    if first_chunk:
+                        # 以首个片段的到达时间作为流式请求的延迟
+                        self.health.latency.record(time.monotonic() - start)
+                        first_chunk = False
+                    yield content
+        except AIServiceError:
+            raise
+        except Exception as e:
+            self.health.breaker.record_failure()
+            raise AIServiceError(f"AI回复中断: {e}") from e
+
+@st.cache_resource
+def get_ai_endpoint_health(api_base, model):
+    """
+    返回API地址和模型对应的调用状态，进程内共享
+    """
+    return AIEndpointHealth()
+
+def get_ai_client(api_key=None, model=None, api_base=None, **options):
+    """
+    按当前AI设置创建调用客户端
+    """
+    api_key = api_key if api_key is not None else st.session_state.api_key
+    model = model if model is not None else st.session_state.model
+    api_base = api_base if api_base is not None else st.session_state.api_base
+    options.setdefault("timeout", st.session_state.get('ai_timeout', DEFAULT_CONFIG["ai_settings"]["timeout"]))
+    options.setdefault("hedge", st.session_state.get('ai_hedge', DEFAULT_CONFIG["ai_settings"]["hedge"]))
+    health = get_ai_endpoint_health((api_base or "").strip(), model)
+    return AIClient(api_key, model, api_base, health=health, **options)
+
+# AI分析内容的token预算
+AI_SAMPLE_TOKEN_BUDGET = 1200
+# 不超过该长度的段落视为候选短句（可能是标题或图片说明）
+AI_CANDIDATE_MAX_CHARS = 40
+# 较长段落只截取开头作为正文摘录
+AI_EXCERPT_CHARS = 60
+
+def estimate_tokens(text):
+    """
+    粗略估计文本的token数：汉字约1个token，其他字符约4个字符1个token
+    """
+    cjk = sum(1 for ch in text if '\u4e00' <= ch <= '\u9fff')
+    return cjk + (len(text) - cjk + 3) // 4
+
+def spread_order(n):
+    """
+    返回覆盖整个区间的访问顺序：先取首尾和中点，再逐级二分，预算不足时抽样仍分布在全文
+    """
+    order = []
+    seen = set()
+    stride = 1 << max(0, (n - 1).bit_length())
+    while stride:
+        for k in range(0, n, stride):
+            if k not in seen:
+                seen.add(k)
+                order.append(k)
+        stride //= 2
+    return order
+
+def sample_lines_for_ai(paragraphs, token_budget=AI_SAMPLE_TOKEN_BUDGET, redundant_keywords=None):
+    """
+    按token预算从全文抽取段落：优先选取短句（可能的标题和图片说明），剩余预算用于正文摘录；
+    跳过空段落、重复段落和已匹配冗余关键词的段落，结果保持原文顺序
+    """
+    _, _, redundant_kw = resolve_keywords(redundant_keywords=redundant_keywords)
+    short_lines = []
+    excerpts = []
+    seen = set()
+    for i, text in enumerate(paragraphs):
+        text = text.strip()
+        if not text or text in seen or is_redundant(text, redundant_kw):
+            continue
+        seen.add(text)
+        if len(text) <= AI_CANDIDATE_MAX_CHARS:
+            short_lines.append((i, text))
+        else:
+            excerpts.append((i, text[:AI_EXCERPT_CHARS] + "…"))
+    
+    selected = {}
+    used = 0
+    for candidates in (short_lines, excerpts):
+        for k in spread_order(len(candidates)):
+            i, text = candidates[k]
+            cost = estimate_tokens(text) + 1  # 换行符
+            if used + cost > token_budget:
+                continue
+            selected[i] = text
+            used += cost
+    
+    return [selected[i] for i in sorted(selected)]
+
+def extract_content_for_ai(docx_file, token_budget=AI_SAMPLE_TOKEN_BUDGET):
+    """
+    提取文档内容，用于AI分析（按token预算从全文抽样）；docx_file可以是文件路径、文件对象或DocumentModel
+    """
+    return "\n".join(sample_lines_for_ai(load_document_model(docx_file), token_budget))
+
+# 整批摘要的token预算
+BATCH_DIGEST_TOKEN_BUDGET = 2000
+
+def build_batch_digest(documents, token_budget=BATCH_DIGEST_TOKEN_BUDGET, redundant_keywords=None):
+    """
+    构建整批文档的摘要：汇总各文档中的候选短句（可能的标题和图片说明），
+    去重后按出现的文档数从多到少排列，直到用完token预算。
+    documents为每个文档的段落列表（或DocumentModel），返回 (摘要文本, 文档数, 候选短句数, 摘要包含的短句数)
+    """
+    _, _, redundant_kw = resolve_keywords(redundant_keywords=redundant_keywords)
+    frequencies = collections.Counter()
+    document_count = 0
+    for paragraphs in documents:
+        document_count += 1
+        lines = set()
+        for text in paragraphs:
+            # 去掉末尾标点，同一短句带不带句号视为相同
+            text = text.strip().rstrip("。.；;")
+            if text and len(text) <= AI_CANDIDATE_MAX_CHARS and not is_redundant(text, redundant_kw):
+                lines.add(text)
+        frequencies.update(lines)
+    
+    digest_lines = []
+    used = 0
+    # Counter按计数排序，计数相同时保持首次出现的顺序
+    for text, count in frequencies.most_common():
+        line = f"{text}（{count}篇）" if count > 1 else text
+        cost = estimate_tokens(line) + 1
+        if used + cost > token_budget:
+            continue
+        digest_lines.append(line)
+        used += cost
+    
+    return "\n".join(digest_lines), document_count, len(frequencies), len(digest_lines)
+
+def analyze_with_openai(content, api_key, model, api_base=None, batch_documents=None):
+    """
+    使用OpenAI API分析文档内容，提取关键词；
+    batch_documents为整批摘要对应的文档数，此时content为build_batch_digest生成的摘要
+    """
+    try:
+        client = get_ai_client(api_key, model, api_base or "")
+        
+        if batch_documents:
+            content_note = f"这是一批共{batch_documents}篇文档的摘要：各篇中的短句去重后按出现篇数排列，括号内为出现的篇数；关键词需要适用于整批文档"
+        else:
+            content_note = "从全文抽取的短句和正文摘录，较长段落只保留开头"
+        
+        # 增强提示信息
+        prompt = f"""
+        你是一位专业的文档分析师，擅长分析学术报告和活动文档。你的任务是从以下文档内容中提取**关键词**，这将用于文档格式化和规范化。
+
+        ## 分析要求
+        请识别并提取以下三类关键词：
+
+        1. **标题关键词**：这些词通常出现在文档的标题和小标题中，用于描述具体活动或事件。它们一般是**动词+名词**的组合，标识了文档的核心内容。请提取与活动描述直接相关的关键词，避免长句或短语：
+           - 例如：举办、开展、协助、组织、召开、宣讲会、志愿活动、竞赛等。
+
+        2. **图片说明关键词**：这些词通常用于描述图片的内容，简短且与图片直接相关。关键词通常为**动词或名词**，而非长短语。请提取与图片动作或场景相关的词汇：
+           - 例如：主持人、发言、展示、合影、授课、讲解等。
+
+        3. **系统冗余关键词**：这些是自动生成的无实质意义的词，通常包括元数据或格式标记，应当被移除：
+           - 例如：发布人、浏览数、日期、审稿信息（如一审、二审、三审）等。
+
+        ## 文档上下文
+        这份文档是一个{guess_document_type(content)}。请根据文档类型调整你的分析策略。
+
+        ## 文档内容开始（{content_note}）：
+        {content}
+        ## 文档内容结束
+
+        ## 输出要求
+        1. 每类关键词至少提供**5个**，最多**15个**。
+        2. 关键词应当是**具体**且**简短**，避免长句或描述。
+        3. 关键词应当是文档中**实际出现过的**或**高度相关**的词汇。
+        4. 严格按照以下JSON格式返回结果，确保格式正确：
+
+        ```json
+        {{
+          "title_keywords": ["关键词1", "关键词2", ...],
+          "image_keywords": ["关键词1", "关键词2", ...],
+          "redundant_keywords": ["关键词1", "关键词2", ...]
+        }}
+        ```
+
+        只返回JSON数据，不要有其他任何解释或说明。
+        """
+
+        
+        result = client.complete(
+            [
+                {"role": "system", "content": "你是一个专业的文档分析助手，擅长提取文档中的关键信息。你的回答应当简洁、准确、实用，且始终返回有效的JSON格式数据。"},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0.2,  # 降低随机性，提高精确度
+            max_tokens=1500
+        )
+        
+        try:
+            # 直接尝试解析整个响应为JSON
+            try:
+                keywords = json.loads(result)
+                return keywords
+            except:
+                # 如果整个响应不是JSON，尝试提取JSON部分
+                json_start = result.find('{')
+                json_end = result.rfind('}') + 1
+                if json_start >= 0 and json_end > json_start:
+                    json_str = result[json_start:json_end]
+                    keywords = json.loads(json_str)
+                    return keywords
+                else:
+                    st.warning("AI返回的结果不包含有效的JSON数据")
+                    return None
+        except Exception as e:
+            st.warning(f"解析AI返回的JSON数据失败: {str(e)}")
+            return None
+    except Exception as e:
+        st.error(f"调用OpenAI API失败: {str(e)}")
+        return None
+
+def guess_document_type(content):
+    """
+    根据内容推测文档类型
+    """
+    content_lower = content.lower()
+    
+    if "培训" in content_lower or "讲座" in content_lower or "报告会" in content_lower:
+        return "培训或讲座活动报告"
+    elif "竞赛" in content_lower or "比赛" in content_lower:
+        return "竞赛活动报告"
+    elif "志愿" in content_lower or "公益" in content_lower:
+        return "志愿服务活动报告"
+    elif "会议" in content_lower:
+        return "会议纪要"
     elif "通知" in content_lower or "公告" in content_lower:
         return "通知公告"
     else:
         return "学术活动或机构报告"
 
+@st.fragment
+def basic_settings_panel():
+    """
+    基本设置选项卡
+    """
+    st.header("格式选项")
+    
+    font_name = st.selectbox(
+        "字体",
+        options=["宋体", "黑体", "微软雅黑", "仿宋", "楷体"],
+        index=0 if st.session_state.font_name not in ["宋体", "黑体", "微软雅黑", "仿宋", "楷体"] else ["宋体", "黑体", "微软雅黑", "仿宋", "楷体"].index(st.session_state.font_name)
+    )
+    st.session_state.font_name = font_name
+    
+    font_size = st.select_slider(
+        "字体大小",
+        options=[10, 12, 14, 16, 18],
+        value=st.session_state.font_size
+    )
+    st.session_state.font_size = font_size
+    
+    indent = st.checkbox("首行缩进", value=st.session_state.indent)
+    st.session_state.indent = indent
+    
+    st.header("关键词设置")
+    
+    previous_keywords = (
+        st.session_state.title_keywords,
+        st.session_state.image_keywords,
+        st.session_state.redundant_keywords
+    )
+    
+    title_keywords_text = st.text_area(
+        "标题关键词",
+        value=", ".join(st.session_state.title_keywords),
+        height=100
+    )
+    title_keywords = [kw.strip() for kw in title_keywords_text.split(",") if kw.strip()]
+    st.session_state.title_keywords = title_keywords
+    
+    image_keywords_text = st.text_area(
+        "图片说明关键词",
+        value=", ".join(st.session_state.image_keywords),
+        height=100
+    )
+    image_keywords = [kw.strip() for kw in image_keywords_text.split(",") if kw.strip()]
+    st.session_state.image_keywords = image_keywords
+    
+    redundant_keywords_text = st.text_area(
+        "系统冗余关键词",
+        value=", ".join(st.session_state.redundant_keywords),
+        height=100
+    )
+    redundant_keywords = [kw.strip() for kw in redundant_keywords_text.split(",") if kw.strip()]
+    st.session_state.redundant_keywords = redundant_keywords
+    
+    # 关键词变化会影响处理后预览，需要重新运行整个页面（文档解析结果已缓存）
+    if previous_keywords != (title_keywords, image_keywords, redundant_keywords):
+        st.rerun()
+    
+    if st.button("保存基本设置"):
+        if update_config():
+            st.success("设置已保存到配置文件")
+        else:
+            st.error("保存设置失败")
+
+@st.fragment
+def ai_settings_panel():
+    """
+    AI智能选项卡
+    """
+    st.header("AI智能设置")
+    
+    enable_ai = st.toggle("启用AI智能关键词分析", value=st.session_state.enable_ai)
+    st.session_state.enable_ai = enable_ai
+    
+    if enable_ai:
+        with st.form(key="api_settings"):
+            st.subheader("OpenAI API 设置")
+            
+            api_key = st.text_input(
+                "OpenAI API 密钥",
+                type="password",
+                value=st.session_state.api_key,
+                help="输入你的OpenAI API密钥"
+            )
+            
+            model = st.text_input(
+                "模型名称",
+                value=st.session_state.model,
+                help="输入用于分析的AI模型名称，例如：gpt-3.5-turbo、gpt-4等"
+            )
+            
+            api_base = st.text_input(
+                "API Base URL (可选)",
+                value=st.session_state.api_base,
+                help="适用于使用代理或自定义API端点，留空使用OpenAI默认地址"
+            )
+            
+            ai_timeout = st.number_input(
+                "请求超时 (秒)",
+                min_value=5,
+                max_value=600,
+                value=int(st.session_state.ai_timeout),
+                help="单次AI调用（包括重试）的最长等待时间"
+            )
+            
+            ai_hedge = st.checkbox(
+                "慢请求时发送备份请求",
+                value=st.session_state.ai_hedge,
+                help="请求耗时超过近期95%的请求时，再发送一个相同的请求并采用先返回的结果，降低长尾延迟"
+            )
+            
+            submit_button = st.form_submit_button(label="保存AI设置")
+            
+            if submit_button:
+                st.session_state.api_key = api_key
+                st.session_state.model = model
+                st.session_state.api_base = api_base
+                st.session_state.ai_timeout = ai_timeout
+                st.session_state.ai_hedge = ai_hedge
+                if update_config():
+                    st.success("AI设置已保存到配置文件!")
+                else:
+                    st.error("保存AI设置失败")
+        
+        if st.button("测试API连接"):
+            if not st.session_state.api_key:
+                st.error("请先设置API密钥!")
+            else:
+                with st.spinner("正在测试API连接..."):
+                    try:
+                        # 测试连接不重试，尽快反馈配置是否正确
+                        client = get_ai_client(timeout=15, max_retries=0, hedge=False)
+                        client.complete([{"role": "user", "content": "Hello, World!"}], max_tokens=5)
+                        
+                        st.success(f"API连接测试成功! 耗时 {client.health.latency.samples[-1]:.1f} 秒")
+                    except Exception as e:
+                        st.error(f"API连接测试失败: {str(e)}")
+        
+        # 显示当前API地址和模型的调用统计
+        health = get_ai_endpoint_health(st.session_state.api_base.strip(), st.session_state.model)
+        st.caption(health.summary())
+
+@st.fragment
+def system_settings_panel():
+    """
+    系统设置选项卡
+    """
+    st.header("系统设置")
+    
+    config_dir = st.text_input(
+        "配置文件目录",
+        value=st.session_state.get('config_dir', get_config_dir()),
+        help="设置配置文件存储目录，留空使用默认目录"
+    )
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        if st.button("选择目录"):
+            try:
+                import tkinter as tk
+                from tkinter import filedialog
+                
+                root = tk.Tk()
+                root.withdraw()
+                
+                folder_path = filedialog.askdirectory(
+                    title="选择配置文件目录",
+                    initialdir=config_dir if os.path.exists(config_dir) else os.path.expanduser("~")
+                )
+                
+                if folder_path:
+                    st.session_state.config_dir = folder_path
+                    config_dir = folder_path
+                    st.rerun()
+            except Exception as e:
+                st.error(f"选择目录失败: {str(e)}")
+    
+    with col2:
+        if st.button("打开配置目录"):
+            try:
+                os.startfile(get_config_dir())
+            except Exception as e:
+                st.error(f"无法打开目录: {str(e)}")
+    
+    if st.button("应用配置目录"):
+        if config_dir and config_dir != get_config_dir():
+            try:
+                # 保存当前配置路径
+                old_config_dir = get_config_dir()
+                
+                # 更新会话状态
+                st.session_state.config_dir = config_dir
+                
+                # 确保新目录存在
+                if not os.path.exists(config_dir):
+                    os.makedirs(config_dir)
+                
+                # 如果旧配置存在，复制到新目录
+                old_config_path = os.path.join(old_config_dir, 'config.json')
+                new_config_path = os.path.join(config_dir, 'config.json')
+                
+                if os.path.exists(old_config_path) and not os.path.exists(new_config_path):
+                    shutil.copy2(old_config_path, new_config_path)
+                
+                st.success(f"配置目录已更改为: {config_dir}")
+                # 重新加载配置
+                init_session_state()
+            except Exception as e:
+                st.error(f"应用配置目录失败: {str(e)}")
+    
+    st.markdown("---")
+    st.subheader("处理设置")
+    
+    streaming_writer = st.toggle(
+        "流式写出文档",
+        value=st.session_state.streaming_writer,
+        help="直接逐段写出document.xml，不构建python-docx对象，大文档写出更快、内存占用更平稳"
+    )
+    st.session_state.streaming_writer = streaming_writer
+    
+    process_pool = st.toggle(
+        "使用共享进程池",
+        value=st.session_state.process_pool,
+        help=f"在 {PROCESS_POOL_WORKERS} 个预先启动的工作进程中处理文件，所有用户共享；关闭后在后台线程中处理"
+    )
+    st.session_state.process_pool = process_pool
+    
+    archive_enabled = st.toggle(
+        "归档处理结果",
+        value=st.session_state.archive_enabled,
+        help="将处理后的段落保存到配置目录下的全文检索库，可在「归档检索」标签页中搜索"
+    )
+    st.session_state.archive_enabled = archive_enabled
+    
+    # 性能分析只对当前会话生效，不保存到配置文件
+    st.toggle(
+        "分析处理性能",
+        key="profile_runs",
+        help="用cProfile记录之后的单文件处理、批量处理和合并简报，在结果下方显示最耗时的函数并提供.prof文件下载；"
+             "分析期间不使用共享进程池，处理会变慢"
+    )
+    
+    # 单位模板：输出文档沿用模板的页面设置、页眉页脚和样式，模板中原有的正文不会保留
+    template_path = get_template_path()
+    if template_path:
+        st.caption(f"当前输出模板: {template_path}")
+    else:
+        st.caption("当前输出模板: 默认模板")
+    template_file = st.file_uploader(
+        "单位模板",
+        type=["docx", "dotx"],
+        key="house_template",
+        help="上传后作为输出文档的基础，保留其页面设置、页眉页脚和样式"
+    )
+    template_col1, template_col2 = st.columns(2)
+    with template_col1:
+        if st.button("使用该模板", disabled=template_file is None):
+            config_dir = get_config_dir()
+            if config_dir:
+                new_template_path = os.path.join(config_dir, HOUSE_TEMPLATE_FILENAME)
+                temp_template_path = new_template_path + ".tmp"
+                try:
+                    with open(temp_template_path, "wb") as f:
+                        f.write(template_file.getbuffer())
+                    DocxTemplate(temp_template_path)  # 检查模板能否正常读取
+                    os.replace(temp_template_path, new_template_path)
+                    st.session_state.template_path = new_template_path
+                    st.success("单位模板已启用，点击「保存处理设置」可保存到配置文件")
+                except Exception as e:
+                    if os.path.exists(temp_template_path):
+                        os.unlink(temp_template_path)
+                    st.error(f"无法使用该模板: {str(e)}")
+    with template_col2:
+        if st.button("使用默认模板", disabled=template_path is None):
+            st.session_state.template_path = ""
+            st.rerun(scope="fragment")
+    
+    # 共享任务队列：批量处理可以提交到队列，由一台或多台机器上的工作进程处理
+    queue_path = st.text_input(
+        "共享任务队列文件",
+        value=st.session_state.queue_path,
+        placeholder="例如 \\\\server\\share\\queue.sqlite3",
+        help="位于共享目录中的SQLite队列文件，工作进程使用 python WordFormatter_cli.py --worker 队列文件 启动；留空表示在本机处理"
+    )
+    if queue_path != st.session_state.queue_path:
+        st.session_state.queue_path = queue_path.strip()
+    if st.session_state.queue_path:
+        try:
+            job_queue = get_job_queue()
+            st.caption(f"任务队列: {job_queue.db_path}")
+        except Exception as e:
+            st.error(f"无法打开任务队列: {str(e)}")
+    
+    # 处理结果（下载文件）按保留时间和磁盘配额自动清理
+    store = get_artifact_store()
+    _, session_bytes = store.usage(get_session_id())
+    total_count, total_bytes = store.usage()
+    st.caption(
+        f"处理结果占用 {total_bytes / 1024 / 1024:.1f} MB（共 {total_count} 个，本会话 {session_bytes / 1024 / 1024:.1f} MB），"
+        f"最后访问 {ARTIFACT_TTL_SECONDS // 60} 分钟后或总量超过 {ARTIFACT_QUOTA_BYTES // 1024 // 1024} MB 时自动清理；"
+        f"批处理任务目录（用于中断后继续处理）另占 {batch_jobs_usage() / 1024 / 1024:.1f} MB，保留7天"
+    )
+    
+    if st.button("保存处理设置"):
+        if update_config():
+            st.success("处理设置已保存到配置文件")
+        else:
+            st.error("保存处理设置失败")
+    
+    st.markdown("---")
+    
+    if st.button("恢复默认设置"):
+        if st.session_state.get('confirm_reset', False):
+            # 重置为默认配置（复制列表，之后修改关键词不影响DEFAULT_CONFIG）
+            for path, session_key in CONFIG_SESSION_KEYS.items():
+                value = config_value(DEFAULT_CONFIG, path)
+                st.session_state[session_key] = list(value) if isinstance(value, list) else value
+            
+            # 恢复默认配置文件
+            save_config(DEFAULT_CONFIG)
+            
+            st.session_state.confirm_reset = False
+            st.success("已恢复默认设置")
+            st.rerun()
+        else:
+            st.session_state.confirm_reset = True
+            st.warning("⚠️ 确定要恢复默认设置吗？再次点击\"恢复默认设置\"确认。")
+    else:
+        # 重置确认状态
+        if 'confirm_reset' in st.session_state:
+            st.session_state.confirm_reset = False
+            
+
+@st.fragment
+def chat_assistant_panel():
+    """
+    AI助手选项卡 - 与AI聊天的功能
+    """
+    st.header("AI助手")
+    
+    if not st.session_state.api_key:
+        st.warning("请先在「AI智能」设置中配置API密钥")
+    else:
+        # 显示聊天历史
+        chat_container = st.container()
+        with chat_container:
+            for msg in st.session_state.chat_messages:
+                with st.chat_message(msg["role"]):
+                    st.markdown(msg["content"])
+        
+        # 用户输入
+        user_input = st.chat_input("输入你的问题：")
+        
+        if user_input:
+            # 添加用户消息到聊天历史
+            st.session_state.chat_messages.append({"role": "user", "content": user_input})
+            
+            # 在界面上显示用户消息
+            with st.chat_message("user"):
+                st.markdown(user_input)
+            
+            # 在界面上添加助手消息占位符
+            with st.chat_message("assistant"):
+                message_placeholder = st.empty()
+            
+            try:
+                # 创建消息列表
+                messages = [{"role": msg["role"], "content": msg["content"]} for msg in st.session_state.chat_messages]
+                
+                full_response = ""
+                
+                # 流式响应（首个片段到达前的暂时性错误会自动重试）
+                for content in get_ai_client().stream(messages):
+                    full_response += content
+                    message_placeholder.markdown(full_response + "▌")
+                
+                # 更新最终响应
+                message_placeholder.markdown(full_response)
+                
+                # 检查是否包含JSON数据并提取
+                try:
+                    json_start = full_response.find('{')
+                    json_end = full_response.rfind('}') + 1
+                    
+                    if json_start >= 0 and json_end > json_start:
+                        json_str = full_response[json_start:json_end]
+                        try:
+                            keywords_data = json.loads(json_str)
+                            
+                            # 检查是否包含关键词字段
+                            if any(k in keywords_data for k in ["title_keywords", "image_keywords", "redundant_keywords"]):
+                                st.success("检测到关键词数据！")
+                                
+                                # 创建应用按钮
+                                if st.button("应用这些关键词"):
+                                    # 更新关键词
+                                    if "title_keywords" in keywords_data and keywords_data["title_keywords"]:
+                                        st.session_state.title_keywords = keywords_data["title_keywords"]
+                                    
+                                    if "image_keywords" in keywords_data and keywords_data["image_keywords"]:
+                                        st.session_state.image_keywords = keywords_data["image_keywords"]
+                                    
+                                    if "redundant_keywords" in keywords_data and keywords_data["redundant_keywords"]:
+                                        st.session_state.redundant_keywords = keywords_data["redundant_keywords"]
+                                    
+                                    # 保存配置
+                                    if update_config():
+                                        st.success("成功应用关键词！")
+                                        st.rerun()
+                                    else:
+                                        st.error("保存配置失败")
+                                
+                                # 显示关键词预览
+                                with st.expander("预览关键词"):
+                                    if "title_keywords" in keywords_data:
+                                        st.write("**标题关键词:**")
+                                        st.write(", ".join(keywords_data["title_keywords"]))
+                                    
+                                    if "image_keywords" in keywords_data:
+                                        st.write("**图片说明关键词:**")
+                                        st.write(", ".join(keywords_data["image_keywords"]))
+                                    
+                                    if "redundant_keywords" in keywords_data:
+                                        st.write("**系统冗余关键词:**")
+                                        st.write(", ".join(keywords_data["redundant_keywords"]))
+                        except Exception as e:
+                            st.warning(f"解析JSON失败: {str(e)}")
+                except Exception as e:
+                    pass  # 如果没有JSON数据，忽略错误
+                    
+                # 添加助手响应到聊天历史
+                st.session_state.chat_messages.append({"role": "assistant", "content": full_response})
+                
+            except Exception as e:
+                st.error(f"发生错误: {str(e)}")
+        
+        # 清空聊天按钮
+        if st.button("清空聊天记录"):
+            st.session_state.chat_messages = []
+            st.rerun(scope="fragment")
+
+@st.fragment(run_every=1)
+def job_status_panel(job_id):
+    """
+    轮询后台任务进度，任务结束后重新运行页面以显示结果
+    """
+    executor = get_job_executor()
+    job = executor.get(job_id)
+    if job is None or not job.active:
+        st.rerun()
+    
+    message = job.message
+    if job.status == "queued":
+        message = f"排队中，前面还有 {executor.queue_position(job)} 个任务..."
+    st.progress(min(job.progress, 100) / 100, text=message)
+    
+    if job.cancelled():
+        st.info("正在取消...")
+    elif st.button("取消任务", key=f"cancel_{job_id}"):
+        job.cancel()
+        st.rerun(scope="fragment")
+
+def profiled_job(run, store, session_id):
+    """
+    包装后台任务函数，用RunProfiler记录整个任务；任务结束（包括失败和取消）后
+    分析文件保存到处理结果存储，路径、总耗时和热点函数记在job.meta["profile"]中
+    """
+    def run_profiled(job):
+        profiler = RunProfiler()
+        try:
+            with profiler:
+                return run(job)
+        finally:
+            profile_path = store.commit(profiler.save(store.allocate(session_id, ".prof")))
+            job.meta["profile"] = {"path": profile_path, "elapsed": profiler.elapsed, "top": profiler.top_functions()}
+    return run_profiled
+
+def profile_panel(job):
+    """
+    显示任务的性能分析结果（热点函数和.prof文件下载）
+    """
+    profile = job.meta.get("profile")
+    if not profile:
+        return
+    with st.expander("性能分析结果"):
+        st.caption(f"总耗时 {profile['elapsed']:.2f} 秒，按函数自身耗时排序（不含线程等待）")
+        st.dataframe(profile["top"], use_container_width=True)
+        if get_artifact_store().touch(profile["path"]):
+            st.markdown(
+                get_binary_file_downloader_html(profile["path"], '下载性能分析文件 (.prof，可用snakeviz等工具打开)'),
+                unsafe_allow_html=True
+            )
+        else:
+            st.info(ARTIFACT_EXPIRED_MESSAGE)
+
+def remove_job_outputs(job):
+    """
+    释放后台任务结果占用的临时文件
+    """
+    store = get_artifact_store()
+    if job.meta.get("profile"):
+        store.release(job.meta["profile"]["path"])
+    if job.result is None:
+        return
+    if isinstance(job.result, tuple):
+        if job.result[0]:
+            store.release(job.result[0])
+        return
+    
+    for key in ("zip_file", "ndjson_file"):
+        if job.result.get(key):
+            store.release(job.result[key])
+    # 有失败文件时保留任务目录，便于重新运行时恢复
+    if "bulletin" in job.result:
+        # 合并简报没有可恢复的任务目录，输出目录本身就是处理结果
+        store.release(job.result["job_dir"])
+    elif job.status == "done" and not job.result["errors"]:
+        if job.result.get("queue") is not None:
+            job.result["queue"].remove_batch(job.result["batch_id"])
+        shutil.rmtree(job.result["job_dir"], ignore_errors=True)
+
+def submit_single_file_job(uploaded_file, digest):
+    """
+    以当前设置提交单文件处理的后台任务
+    """
+    options = {
+        "title_keywords": st.session_state.title_keywords,
+        "image_keywords": st.session_state.image_keywords,
+        "font_name": st.session_state.font_name,
+        "font_size": st.session_state.font_size,
+        "indent": st.session_state.indent,
+        "redundant_keywords": st.session_state.redundant_keywords,
+        "streaming": st.session_state.streaming_writer,
+        "archive": get_document_archive(),
+        "template_path": get_template_path(),
+        "pool": get_processing_pool(),
+        "model": get_document_model(uploaded_file),
+    }
+    store = get_artifact_store()
+    session_id = get_session_id()
+    
+    def run(job):
+        output_path = store.allocate(session_id, "_标准化处理.docx")
+        try:
+            result = process_single_file(uploaded_file, progress_callback=job.report, output_path=output_path, **options)
+        except BaseException:
+            store.release(output_path)
+            raise
+        store.commit(output_path)
+        return result
+    
+    # 性能分析只能记录本进程中的处理，不使用进程池
+    if st.session_state.get('profile_runs'):
+        options["pool"] = None
+        run = profiled_job(run, store, session_id)
+    
+    job = get_job_executor().submit(
+        get_session_id(),
+        f"处理 {uploaded_file.name}",
+        run,
+        meta={"digest": digest},
+        cleanup=remove_job_outputs
+    )
+    st.session_state.single_job_id = job.job_id
+    return job
+
+def submit_batch_job(uploaded_files, near_duplicates, spool_threshold_mb, window, export_format="docx", job_queue=None):
+    """
+    以当前设置提交批量处理的后台任务，处理完成后在后台打包ZIP（NDJSON导出时合并为一个文件）。
+    指定job_queue时把文件提交到共享任务队列，由工作进程处理，后台任务只汇总进度
+    """
+    options = {
+        "title_keywords": st.session_state.title_keywords,
+        "image_keywords": st.session_state.image_keywords,
+        "font_name": st.session_state.font_name,
+        "font_size": st.session_state.font_size,
+        "indent": st.session_state.indent,
+        "redundant_keywords": st.session_state.redundant_keywords,
+        "near_duplicates": near_duplicates,
+        "spool_threshold_mb": spool_threshold_mb,
+        "window": window,
+        "streaming": st.session_state.streaming_writer,
+        "export_format": export_format,
+        "archive": get_document_archive(),
+        "template_path": get_template_path(),
+        "pool": get_processing_pool(),
+        "models": get_document_models(),
+    }
+    store = get_artifact_store()
+    session_id = get_session_id()
+    
+    def run(job):
+        # Word文档输出在每个文件完成时直接写入ZIP
+        output_zip = None
+        if export_format != "ndjson":
+            output_zip = store.allocate(session_id, ".zip")
+        try:
+            if job_queue is not None:
+                result = process_batch_via_queue(job_queue, uploaded_files, options, job.report, job.cancelled, output_zip)
+            else:
+                result = process_batch_files(uploaded_files, progress_callback=job.report, should_stop=job.cancelled,
+                                             output_zip=output_zip, **options)
+        except BaseException:
+            if output_zip:
+                store.release(output_zip)
+            raise
+        result["near_duplicates"] = near_duplicates
+        result["zip_file"] = None
+        result["ndjson_file"] = None
+        if result["output_files"]:
+            if export_format == "ndjson":
+                ndjson_path = store.allocate(session_id, ".ndjson")
+                result["ndjson_file"] = store.commit(merge_ndjson_files(result["output_files"], ndjson_path))
+            else:
+                result["zip_file"] = store.commit(output_zip)
+        elif output_zip:
+            store.release(output_zip)
+        return result
+    
+    # 共享任务队列由其他进程处理，本进程只汇总进度，不进行性能分析
+    if st.session_state.get('profile_runs') and job_queue is None:
+        options["pool"] = None
+        run = profiled_job(run, store, session_id)
+    
+    job = get_job_executor().submit(
+        get_session_id(),
+        f"批量处理 {len(uploaded_files)} 个文件",
+        run,
+        cleanup=remove_job_outputs
+    )
+    st.session_state.batch_job_id = job.job_id
+    return job
+
+def submit_bulletin_job(uploaded_files, near_duplicates, page_break=False):
+    """
+    以当前设置提交合并简报的后台任务：按uploaded_files的顺序把所有文章流式写入一个Word文档
+    """
+    models = get_document_models()
+    # 已在预览或AI分析中解析过的文件直接使用缓存的文档模型
+    sources = [(f.name, models.peek(get_upload_digest(f)) or f) for f in uploaded_files]
+    options = {
+        "title_keywords": st.session_state.title_keywords,
+        "image_keywords": st.session_state.image_keywords,
+        "font_name": st.session_state.font_name,
+        "font_size": st.session_state.font_size,
+        "indent": st.session_state.indent,
+        "redundant_keywords": st.session_state.redundant_keywords,
+        "near_duplicates": near_duplicates,
+        "template_path": get_template_path(),
+        "page_break": page_break,
+        "archive": get_document_archive(),
+        "pool": get_processing_pool(),
+    }
+    store = get_artifact_store()
+    session_id = get_session_id()
+    
+    def run(job):
+        job_dir = store.allocate(session_id, "_bulletin", directory=True)
+        output_path = os.path.join(job_dir, BULLETIN_FILENAME)
+        try:
+            summary = merge_documents(sources, output_path, progress_callback=job.report, should_stop=job.cancelled,
+                                      trace_path=trace_path_for(output_path), **options)
+        except BaseException:
+            store.release(job_dir)
+            raise
+        store.commit(job_dir)
+        return {
+            "output_files": [(BULLETIN_FILENAME, output_path)] if summary["articles"] else [],
+            "errors": summary["errors"],
+            "resumed": 0,
+            "memory": None,
+            "job_dir": job_dir,
+            "near_duplicates": near_duplicates,
+            "zip_file": None,
+            "ndjson_file": None,
+            "bulletin_file": output_path if summary["articles"] else None,
+            "bulletin": summary,
+        }
+    
+    if st.session_state.get('profile_runs'):
+        options["pool"] = None
+        run = profiled_job(run, store, session_id)
+    
+    job = get_job_executor().submit(
+        get_session_id(),
+        f"合并 {len(uploaded_files)} 篇文章",
+        run,
+        cleanup=remove_job_outputs
+    )
+    st.session_state.batch_job_id = job.job_id
+    return job
+
+def apply_ai_keywords(keywords):
+    """
+    用AI返回的关键词更新会话状态（只更新非空的类别）
+    """
+    if 'title_keywords' in keywords and keywords['title_keywords']:
+        st.session_state.title_keywords = keywords['title_keywords']
+    
+    if 'image_keywords' in keywords and keywords['image_keywords']:
+        st.session_state.image_keywords = keywords['image_keywords']
+    
+    if 'redundant_keywords' in keywords and keywords['redundant_keywords']:
+        st.session_state.redundant_keywords = keywords['redundant_keywords']
+
+def show_ai_analysis_result():
+    """
+    显示当前生效的关键词
+    """
+    with st.expander("查看AI分析结果"):
+        st.write("**标题关键词:**")
+        st.write(", ".join(st.session_state.title_keywords))
+        st.write("**图片说明关键词:**")
+        st.write(", ".join(st.session_state.image_keywords))
+        st.write("**系统冗余关键词:**")
+        st.write(", ".join(st.session_state.redundant_keywords))
+
+@st.fragment
+def single_file_panel():
+    """
+    单文件处理标签页
+    """
+    st.header("单文件处理")
+    
+    uploaded_file = st.file_uploader("选择Word文档", type=["docx"], key="single_file")
+    
+    if uploaded_file is not None:
+        st.write(f"已选择: {uploaded_file.name}")
+        
+        # 预处理 - 提取原始文档内容（按文件内容缓存，修改关键词时无需重新加载）
+        with st.spinner("加载预览..."):
+            classifier = get_document_classifier(uploaded_file)
+            input_paragraphs = classifier.paragraphs
+        
+        # AI分析按钮 - 仅在启用AI和上传文件后显示
+        if st.session_state.enable_ai and 'api_key' in st.session_state and st.session_state.api_key:
+            if st.button("使用AI分析关键词", key="analyze_ai_single"):
+                with st.spinner("AI正在分析文档..."):
+                    content = extract_content_for_ai(get_document_model(uploaded_file))
+                    keywords = analyze_with_openai(
+                        content, 
+                        st.session_state.api_key,
+                        st.session_state.model,
+                        st.session_state.api_base
+                    )
+                    
+                    if keywords:
+                        apply_ai_keywords(keywords)
+                        
+                        # 重新运行整个页面，使侧边栏显示新的关键词
+                        st.session_state.ai_analysis_done = True
+                        st.rerun()
+        
+        if st.session_state.pop('ai_analysis_done', False):
+            st.success("AI分析完成，关键词已更新!")
+            show_ai_analysis_result()
+        
+        # 当前文件对应的后台任务（上传了其他文件时不再显示旧结果）
+        executor = get_job_executor()
+        digest = get_upload_digest(uploaded_file)
+        job = executor.get(st.session_state.get('single_job_id'))
+        if job is not None and job.meta.get('digest') != digest:
+            job = None
+        
+        # 创建处理按钮
+        process_btn = st.button("开始处理", key="process_single", disabled=job is not None and job.active)
+
+        trace = None  # 初始化处理记录变量
+        
+        # 在处理按钮点击后提交后台任务
+        if process_btn:
+            if job is not None:
+                executor.discard(job.job_id)
+            job = submit_single_file_job(uploaded_file, digest)
+        
+        if job is not None:
+            if job.active:
+                job_status_panel(job.job_id)
+            elif job.status == "done":
+                output_file, trace = job.result
+                st.success("处理完成!")
+                if get_artifact_store().touch(output_file):
+                    st.markdown(
+                        get_binary_file_downloader_html(output_file, '点击下载处理后的文件'),
+                        unsafe_allow_html=True
+                    )
+                else:
+                    st.info(ARTIFACT_EXPIRED_MESSAGE)
+                if not trace_output_paragraphs(trace):
+                    st.warning("处理后的文档内容为空，请检查处理逻辑")
+            elif job.status == "failed":
+                st.error(f"处理出错: {job.error}")
+                st.error(f"详细错误: {job.traceback}")
+            else:
+                st.warning("处理已取消")
+            if not job.active:
+                profile_panel(job)
+        
+        # 更新预览区域（未处理时根据当前关键词实时生成处理后预览）
+        live_preview = trace is None
+        if live_preview:
+            classifier.update(
+                st.session_state.title_keywords,
+                st.session_state.image_keywords,
+                st.session_state.redundant_keywords
+            )
+            trace = classifier.trace()
+        update_preview_area(input_paragraphs, trace, live=live_preview, key="single_preview")
+
+@st.fragment
+def batch_panel():
+    """
+    批量处理标签页
+    """
+    st.header("批量处理")
+    
+    uploads = st.file_uploader(
+        "选择多个Word文档",
+        type=["docx", "zip"],
+        accept_multiple_files=True,
+        key="batch_files",
+        help="也可以直接上传包含docx文件的ZIP压缩包，其中的文件逐个从压缩包读取，无需解压"
+    )
+    
+    batch_input_paragraphs = None
+    batch_trace = None
+    
+    # 展开ZIP压缩包中的docx文件
+    uploaded_files = []
+    for upload in uploads or []:
+        try:
+            uploaded_files.extend(expand_batch_uploads([upload]))
+        except zipfile.BadZipFile:
+            st.error(f"无法读取压缩包 {upload.name}，请确认文件是有效的ZIP格式")
+    
+    if uploaded_files:
+        st.write(f"已选择 {len(uploaded_files)} 个文件")
+        
+        file_list = ""
+        for file in uploaded_files:
+            file_list += f"- {file.name}\n"
+        
+        # 文件较多（例如上传了压缩包）时折叠显示
+        if len(uploaded_files) > 20:
+            with st.expander("文件列表"):
+                st.markdown(file_list)
+        else:
+            st.markdown(file_list)
+        
+        # 预览选择的文件
+        if len(uploaded_files) > 0:
+            preview_file = st.selectbox(
+                "选择要预览的文件",
+                options=[file.name for file in uploaded_files],
+                index=0
+            )
+            
+            # 获取选中的文件对象
+            selected_file = next((f for f in uploaded_files if f.name == preview_file), None)
+            
+            if selected_file:
+                with st.spinner("加载预览..."):
+                    batch_classifier = get_document_classifier(selected_file)
+                    batch_input_paragraphs = batch_classifier.paragraphs
+        
+        
+        # AI分析整批关键词 - 汇总所有文件的候选短句，只调用一次AI
+        if st.session_state.enable_ai and 'api_key' in st.session_state and st.session_state.api_key:
+            if st.button("使用AI分析整批关键词", key="analyze_ai_batch"):
+                with st.spinner("正在汇总整批文档..."):
+                    documents = (get_document_model(f) for f in uploaded_files)
+                    content, document_count, candidate_count, line_count = build_batch_digest(documents)
+                with st.spinner("AI正在分析整批文档..."):
+                    keywords = analyze_with_openai(
+                        content,
+                        st.session_state.api_key,
+                        st.session_state.model,
+                        st.session_state.api_base,
+                        batch_documents=document_count
+                    )
+                    
+                    if keywords:
+                        apply_ai_keywords(keywords)
+                        
+                        # 重新运行整个页面，使侧边栏显示新的关键词
+                        st.session_state.batch_ai_analysis_done = (
+                            f"从 {document_count} 个文件的 {candidate_count} 条候选短句中选取 {line_count} 条发送给AI"
+                        )
+                        st.rerun()
+        
+        batch_ai_summary = st.session_state.pop('batch_ai_analysis_done', None)
+        if batch_ai_summary:
+            st.success("AI分析完成，整批关键词已更新!")
+            st.caption(batch_ai_summary)
+            show_ai_analysis_result()
+        
+        # 跨文件近似重复检测设置
+        dup_col1, dup_col2 = st.columns(2)
+        with dup_col1:
+            dup_mode = st.selectbox(
+                "跨文件近似重复检测",
+                options=["关闭", "仅标记", "标记并删除"],
+                index=0,
+                help="使用MinHash/LSH在整批文档中查找近似重复的标题和段落"
+            )
+        with dup_col2:
+            dup_threshold = st.slider(
+                "相似度阈值",
+                min_value=0.5,
+                max_value=1.0,
+                value=0.8,
+                step=0.05,
+                disabled=dup_mode == "关闭"
+            )
+        
+        export_format = st.radio(
+            "输出格式",
+            options=["docx", "ndjson", "bulletin"],
+            format_func={"docx": "Word文档 (ZIP)", "ndjson": "NDJSON分类数据", "bulletin": "合并为一份简报"}.get,
+            horizontal=True,
+            help="NDJSON格式逐行输出每个段落的文本、类别、来源文件和位置，便于建立索引，不生成Word文档；"
+                 "合并为一份简报时所有文章按顺序写入一个Word文档，整份简报中重复的标题只保留一次"
+        )
+        
+        # 合并简报的文章顺序
+        merge_files = uploaded_files
+        page_break = False
+        if export_format == "bulletin":
+            order_col1, order_col2 = st.columns(2)
+            with order_col1:
+                merge_order = st.selectbox(
+                    "文章顺序",
+                    options=["upload", "name", "custom"],
+                    format_func={"upload": "上传顺序", "name": "按文件名", "custom": "自定义"}.get
+                )
+            with order_col2:
+                page_break = st.checkbox("每篇文章另起一页", value=False)
+            if merge_order == "custom":
+                merge_order = st.multiselect(
+                    "按顺序选择要合并的文章",
+                    options=list(range(len(uploaded_files))),
+                    default=list(range(len(uploaded_files))),
+                    format_func=lambda i: uploaded_files[i].name,
+                    help="简报按这里的先后顺序合并，移除后重新添加可以把文章移到末尾"
+                )
+            merge_files = order_batch_files(uploaded_files, merge_order)
+        
+        with st.expander("内存设置"):
+            mem_col1, mem_col2 = st.columns(2)
+            with mem_col1:
+                spool_threshold_mb = st.number_input(
+                    "磁盘暂存阈值 (MB)",
+                    min_value=0,
+                    max_value=1024,
+                    value=8,
+                    help="超过该大小的文件先分块写入磁盘再处理，避免在内存中复制"
+                )
+            with mem_col2:
+                batch_window = st.number_input(
+                    "同时处理文件数",
+                    min_value=1,
+                    max_value=16,
+                    value=2,
+                    help="限制同时在内存中处理的文件数量（启用近似重复检测时逐个处理）"
+                )
+        
+        use_queue = False
+        if st.session_state.queue_path and export_format != "bulletin":
+            use_queue = st.checkbox(
+                "提交到共享任务队列",
+                key="use_job_queue",
+                help="由连接同一队列的工作进程处理，适合大批量文件；队列处理时不进行跨文件近似重复检测和归档"
+            )
+        
+        # 预检：只运行分类规则，不生成文档，找出可能丢失内容或识别有误的文件
+        triage_key = (
+            tuple(get_upload_digest(f) for f in uploaded_files),
+            tuple(st.session_state.title_keywords),
+            tuple(st.session_state.image_keywords),
+            tuple(st.session_state.redundant_keywords),
+        )
+        if st.button("预检（不生成文档）", key="triage_batch",
+                     help="只运行标题、图片说明、冗余信息等识别规则，快速列出每个文件的段落统计和需要检查的问题"):
+            with st.spinner("正在预检..."):
+                start = time.perf_counter()
+                rows = triage_files(
+                    uploaded_files,
+                    st.session_state.title_keywords,
+                    st.session_state.image_keywords,
+                    st.session_state.redundant_keywords
+                )
+                st.session_state.batch_triage = (triage_key, rows, time.perf_counter() - start)
+        
+        batch_triage = st.session_state.get('batch_triage')
+        # 文件或关键词变化后预检结果不再有效
+        if batch_triage and batch_triage[0] == triage_key:
+            _, rows, elapsed = batch_triage
+            flagged = [row for row in rows if row["问题"]]
+            if flagged:
+                st.warning(f"预检完成（用时 {elapsed:.1f} 秒），{len(flagged)}/{len(rows)} 个文件需要检查")
+            else:
+                st.success(f"预检完成（用时 {elapsed:.1f} 秒），{len(rows)} 个文件均未发现问题")
+            only_flagged = st.checkbox("只显示有问题的文件", value=bool(flagged), key="triage_only_flagged")
+            st.dataframe(flagged if only_flagged else rows, use_container_width=True)
+        
+        executor = get_job_executor()
+        job = executor.get(st.session_state.get('batch_job_id'))
+        
+        if st.button("开始批量处理", key="process_batch", disabled=job is not None and job.active):
+            near_duplicates = None
+            if dup_mode != "关闭" and not use_queue:
+                near_duplicates = NearDuplicateIndex(threshold=dup_threshold, drop=dup_mode == "标记并删除")
+            
+            job_queue = None
+            queue_error = None
+            if use_queue:
+                try:
+                    job_queue = get_job_queue()
+                except Exception as e:
+                    queue_error = str(e)
+            
+            if queue_error:
+                st.error(f"无法打开任务队列: {queue_error}")
+            else:
+                if job is not None:
+                    executor.discard(job.job_id)
+                if export_format == "bulletin":
+                    job = submit_bulletin_job(merge_files, near_duplicates, page_break)
+                else:
+                    job = submit_batch_job(uploaded_files, near_duplicates, spool_threshold_mb, int(batch_window),
+                                           export_format, job_queue=job_queue)
+        
+        if job is not None:
+            if job.active:
+                job_status_panel(job.job_id)
+            elif job.status == "failed":
+                st.error(f"批处理出错: {job.error}")
+            elif job.status == "cancelled":
+                st.warning("批处理已取消，已完成的文件会在重新开始相同的批处理时自动跳过")
+            elif job.result:
+                result = job.result
+                output_files = result["output_files"]
+                if result["resumed"]:
+                    st.info(f"已恢复未完成的批处理任务，跳过 {result['resumed']} 个已完成的文件")
+                for name, error in result["errors"]:
+                    st.error(f"处理文件 {name} 失败: {error}")
+                if result["memory"]:
+                    st.caption(result["memory"])
+                
+                if output_files:
+                    if result.get("bulletin_file"):
+                        bulletin = result["bulletin"]
+                        st.success(
+                            f"简报合并完成! 共 {bulletin['articles']} 篇文章、{bulletin['paragraphs']} 个段落，"
+                            f"删除重复标题 {bulletin['duplicates']} 个"
+                        )
+                    else:
+                        st.success(f"批处理完成! 共处理 {len(output_files)} 个文件")
+                    
+                    # 显示近似重复检测结果
+                    near_duplicates = result["near_duplicates"]
+                    if near_duplicates is not None:
+                        if near_duplicates.duplicates:
+                            action = "已删除" if near_duplicates.drop else "已标记"
+                            st.warning(f"检测到 {len(near_duplicates.duplicates)} 个近似重复段落（{action}）")
+                            with st.expander("查看近似重复详情"):
+                                st.markdown("**文件重复概况**")
+                                st.dataframe(near_duplicates.file_overlaps(), use_container_width=True)
+                                st.markdown("**重复段落**")
+                                st.dataframe(near_duplicates.duplicates, use_container_width=True)
+                        else:
+                            st.info("未检测到近似重复内容")
+                    
+                    # 提供ZIP、NDJSON或合并简报下载（合并简报的处理结果是包含简报和处理记录的目录）
+                    if result.get("bulletin_file"):
+                        artifact, download_file, label = result["job_dir"], result["bulletin_file"], '点击下载合并后的简报'
+                    elif result["ndjson_file"]:
+                        artifact = download_file = result["ndjson_file"]
+                        label = '点击下载分类数据 (NDJSON)'
+                    else:
+                        artifact = download_file = result["zip_file"]
+                        label = '点击下载所有处理后的文件 (ZIP)'
+                    artifact_available = get_artifact_store().touch(artifact)
+                    if artifact_available:
+                        st.markdown(get_binary_file_downloader_html(download_file, label), unsafe_allow_html=True)
+                    else:
+                        st.info(ARTIFACT_EXPIRED_MESSAGE)
+                    
+                    # 更新预览以显示处理后的内容
+                    if result.get("bulletin_file"):
+                        # 合并简报只预览上面选择的文件在简报中的部分
+                        if artifact_available:
+                            batch_trace = load_trace(trace_path_for(result["bulletin_file"]), preview_file)
+                    else:
+                        preview_output_file = st.selectbox(
+                            "选择要预览的处理后文件",
+                            options=[filename for filename, _ in output_files],
+                            index=0
+                        )
+                        
+                        # 获取选中的文件路径
+                        selected_output_path = next((filepath for filename, filepath in output_files if filename == preview_output_file), None)
+                        
+                        if selected_output_path and os.path.exists(selected_output_path):
+                            batch_trace = load_output_trace(selected_output_path)
+        
+            if not job.active:
+                profile_panel(job)
+        
+        # 更新批处理预览（未处理时根据当前关键词实时生成处理后预览）
+        if batch_input_paragraphs:
+            batch_live_preview = batch_trace is None
+            if batch_live_preview:
+                batch_classifier.update(
+                    st.session_state.title_keywords,
+                    st.session_state.image_keywords,
+                    st.session_state.redundant_keywords
+                )
+                batch_trace = batch_classifier.trace()
+            update_preview_area(batch_input_paragraphs, batch_trace, live=batch_live_preview, key="batch_preview")
+
+@st.fragment
+def archive_search_panel():
+    """
+    归档检索标签页
+    """
+    st.header("归档检索")
+    
+    config_dir = get_config_dir()
+    if not config_dir:
+        st.warning("配置目录不可用，无法打开检索归档")
+        return
+    archive = open_document_archive(os.path.join(config_dir, ARCHIVE_FILENAME))
+    
+    document_count, paragraph_count = archive.stats()
+    st.caption(f"已归档 {document_count} 个文档，共 {paragraph_count} 个段落")
+    if not st.session_state.archive_enabled:
+        st.info("归档功能已关闭，可在「系统设置」中开启")
+    
+    search_col1, search_col2 = st.columns([3, 1])
+    with search_col1:
+        query = st.text_input("搜索关键词", placeholder="多个关键词用空格分隔，例如：宣讲会 就业")
+    with search_col2:
+        category_labels = {"": "全部", CATEGORY_TITLE: "标题", CATEGORY_BODY: "正文", CATEGORY_BYLINE: "署名", CATEGORY_REVIEW: "审核信息"}
+        category = st.selectbox("段落类别", options=list(category_labels), format_func=category_labels.get)
+    
+    if query.strip():
+        start = time.perf_counter()
+        results = archive.search(query, category=category or None)
+        elapsed = (time.perf_counter() - start) * 1000
+        
+        if results:
+            st.success(f"找到 {len(results)} 个匹配段落（用时 {elapsed:.1f} 毫秒）")
+            for result in results:
+                result["类别"] = category_labels.get(result["类别"], result["类别"])
+            st.dataframe(results, use_container_width=True)
+        else:
+            st.info(f"没有找到匹配的段落（用时 {elapsed:.1f} 毫秒）")
+    
+    with st.expander("管理归档"):
+        if st.button("清空归档", key="clear_archive"):
+            archive.clear()
+            st.rerun(scope="fragment")
+
 def main():
     st.set_page_config(
         page_title="Word文档格式规范工具",
@@ -614,6 +4845,9 @@ def main():
     
     # 初始化会话状态
     init_session_state()
+    
+    # 启用共享进程池时启动进程池（进程内只启动一次），工作进程在用户上传文件前按当前配置完成预热
+    get_processing_pool()
 
     # 初始化聊天会话状态
     if 'chat_messages' not in st.session_state:
@@ -621,550 +4855,42 @@ def main():
     if 'chat_token_buffer' not in st.session_state:
         st.session_state.chat_token_buffer = ""
     
-    # 侧边栏 - 选项设置
+    # 侧边栏 - 选项设置（各选项卡为独立的fragment，交互时只重新运行所在选项卡）
     with st.sidebar:
         # 创建选项卡
         sidebar_tab1, sidebar_tab2, sidebar_tab3, sidebar_tab4 = st.tabs(["基本设置", "AI智能", "系统设置", "AI助手"])
         
-        # 基本设置选项卡
         with sidebar_tab1:
-            st.header("格式选项")
-            
-            font_name = st.selectbox(
-                "字体",
-                options=["宋体", "黑体", "微软雅黑", "仿宋", "楷体"],
-                index=0 if st.session_state.font_name not in ["宋体", "黑体", "微软雅黑", "仿宋", "楷体"] else ["宋体", "黑体", "微软雅黑", "仿宋", "楷体"].index(st.session_state.font_name)
-            )
-            st.session_state.font_name = font_name
-            
-            font_size = st.select_slider(
-                "字体大小",
-                options=[10, 12, 14, 16, 18],
-                value=st.session_state.font_size
-            )
-            st.session_state.font_size = font_size
-            
-            indent = st.checkbox("首行缩进", value=st.session_state.indent)
-            st.session_state.indent = indent
-            
-            st.header("关键词设置")
-            
-            title_keywords_text = st.text_area(
-                "标题关键词",
-                value=", ".join(st.session_state.title_keywords),
-                height=100
-            )
-            title_keywords = [kw.strip() for kw in title_keywords_text.split(",") if kw.strip()]
-            st.session_state.title_keywords = title_keywords
-            
-            image_keywords_text = st.text_area(
-                "图片说明关键词",
-                value=", ".join(st.session_state.image_keywords),
-                height=100
-            )
-            image_keywords = [kw.strip() for kw in image_keywords_text.split(",") if kw.strip()]
-            st.session_state.image_keywords = image_keywords
-            
-            redundant_keywords_text = st.text_area(
-                "系统冗余关键词",
-                value=", ".join(st.session_state.redundant_keywords),
-                height=100
-            )
-            redundant_keywords = [kw.strip() for kw in redundant_keywords_text.split(",") if kw.strip()]
-            st.session_state.redundant_keywords = redundant_keywords
-            
-            if st.button("保存基本设置"):
-                if update_config():
-                    st.success("设置已保存到配置文件")
-                else:
-                    st.error("保存设置失败")
+            basic_settings_panel()
         
-        # AI智能选项卡
         with sidebar_tab2:
-            st.header("AI智能设置")
-            
-            enable_ai = st.toggle("启用AI智能关键词分析", value=st.session_state.enable_ai)
-            st.session_state.enable_ai = enable_ai
-            
-            if enable_ai:
-                with st.form(key="api_settings"):
-                    st.subheader("OpenAI API 设置")
-                    
-                    api_key = st.text_input(
-                        "OpenAI API 密钥",
-                        type="password",
-                        value=st.session_state.api_key,
-                        help="输入你的OpenAI API密钥"
-                    )
-                    
-                    model = st.text_input(
-                        "模型名称",
-                        value=st.session_state.model,
-                        help="输入用于分析的AI模型名称，例如：gpt-3.5-turbo、gpt-4等"
-                    )
-                    
-                    api_base = st.text_input(
-                        "API Base URL (可选)",
-                        value=st.session_state.api_base,
-                        help="适用于使用代理或自定义API端点，留空使用OpenAI默认地址"
-                    )
-                    
-                    submit_button = st.form_submit_button(label="保存AI设置")
-                    
-                    if submit_button:
-                        st.session_state.api_key = api_key
-                        st.session_state.model = model
-                        st.session_state.api_base = api_base
-                        if update_config():
-                            st.success("AI设置已保存到配置文件!")
-                        else:
-                            st.error("保存AI设置失败")
-                
-                if st.button("测试API连接"):
-                    if not st.session_state.api_key:
-                        st.error("请先设置API密钥!")
-                    else:
-                        with st.spinner("正在测试API连接..."):
-                            try:
-                                openai.api_key = st.session_state.api_key
-                                
-                                # 准备客户端参数
-                                client_params = {"api_key": st.session_state.api_key}
-                                if st.session_state.api_base.strip():
-                                    if is_old_api:
-                                        openai.api_base = st.session_state.api_base
-                                    else:
-                                        client_params["base_url"] = st.session_state.api_base
-                                
-                                if is_old_api:
-                                    # 旧版API - 忽略linter警告
-                                    # noinspection PyUnresolvedReferences
-                                    response = openai.ChatCompletion.create(
-                                        model=st.session_state.model,
-                                        messages=[{"role": "user", "content": "Hello, World!"}],
-                                        max_tokens=5
-                                    )
-                                else:
-                                    # 新版API
-                                    client = openai.OpenAI(**client_params)
-                                    response = client.chat.completions.create(
-                                        model=st.session_state.model,
-                                        messages=[{"role": "user", "content": "Hello, World!"}],
-                                        max_tokens=5
-                                    )
-                                
-                                st.success("API连接测试成功!")
-                            except Exception as e:
-                                st.error(f"API连接测试失败: {str(e)}")
+            ai_settings_panel()
         
-        # 系统设置选项卡
         with sidebar_tab3:
-            st.header("系统设置")
-            
-            config_dir = st.text_input(
-                "配置文件目录",
-                value=st.session_state.get('config_dir', get_config_dir()),
-                help="设置配置文件存储目录，留空使用默认目录"
-            )
-            
-            col1, col2 = st.columns(2)
-            with col1:
-                if st.button("选择目录"):
-                    try:
-                        import tkinter as tk
-                        from tkinter import filedialog
-                        
-                        root = tk.Tk()
-                        root.withdraw()
-                        
-                        folder_path = filedialog.askdirectory(
-                            title="选择配置文件目录",
-                            initialdir=config_dir if os.path.exists(config_dir) else os.path.expanduser("~")
-                        )
-                        
-                        if folder_path:
-                            st.session_state.config_dir = folder_path
-                            config_dir = folder_path
-                            st.rerun()
-                    except Exception as e:
-                        st.error(f"选择目录失败: {str(e)}")
-            
-            with col2:
-                if st.button("打开配置目录"):
-                    try:
-                        os.startfile(get_config_dir())
-                    except Exception as e:
-                        st.error(f"无法打开目录: {str(e)}")
-            
-            if st.button("应用配置目录"):
-                if config_dir and config_dir != get_config_dir():
-                    try:
-                        # 保存当前配置路径
-                        old_config_dir = get_config_dir()
-                        
-                        # 更新会话状态
-                        st.session_state.config_dir = config_dir
-                        
-                        # 确保新目录存在
-                        if not os.path.exists(config_dir):
-                            os.makedirs(config_dir)
-                        
-                        # 如果旧配置存在，复制到新目录
-                        old_config_path = os.path.join(old_config_dir, 'config.json')
-                        new_config_path = os.path.join(config_dir, 'config.json')
-                        
-                        if os.path.exists(old_config_path) and not os.path.exists(new_config_path):
-                            shutil.copy2(old_config_path, new_config_path)
-                        
-                        st.success(f"配置目录已更改为: {config_dir}")
-                        # 重新加载配置
-                        init_session_state()
-                    except Exception as e:
-                        st.error(f"应用配置目录失败: {str(e)}")
-            
-            st.markdown("---")
-            
-            if st.button("恢复默认设置"):
-                if st.session_state.get('confirm_reset', False):
-                    # 重置为默认配置
-                    for key, value in DEFAULT_CONFIG.items():
-                        if isinstance(value, dict):
-                            for sub_key, sub_value in value.items():
-                                if f"{key}_{sub_key}" in st.session_state:
-                                    st.session_state[f"{key}_{sub_key}"] = sub_value
-                                elif sub_key in st.session_state:
-                                    st.session_state[sub_key] = sub_value
-                        else:
-                            if key in st.session_state:
-                                st.session_state[key] = value
-                    
-                    # 恢复默认配置文件
-                    save_config(DEFAULT_CONFIG)
-                    
-                    st.session_state.confirm_reset = False
-                    st.success("已恢复默认设置")
-                    st.rerun()
-                else:
-                    st.session_state.confirm_reset = True
-                    st.warning("⚠️ 确定要恢复默认设置吗？再次点击\"恢复默认设置\"确认。")
-            else:
-                # 重置确认状态
-                if 'confirm_reset' in st.session_state:
-                    st.session_state.confirm_reset = False
-                    
-        # AI助手选项卡 - 与AI聊天的功能
+            system_settings_panel()
+        
         with sidebar_tab4:
-            st.header("AI助手")
-            
-            if not st.session_state.api_key:
-                st.warning("请先在「AI智能」设置中配置API密钥")
-            else:
-                # 显示聊天历史
-                chat_container = st.container()
-                with chat_container:
-                    for msg in st.session_state.chat_messages:
-                        with st.chat_message(msg["role"]):
-                            st.markdown(msg["content"])
-                
-                # 用户输入
-                user_input = st.chat_input("输入你的问题：")
-                
-                if user_input:
-                    # 添加用户消息到聊天历史
-                    st.session_state.chat_messages.append({"role": "user", "content": user_input})
-                    
-                    # 在界面上显示用户消息
-                    with st.chat_message("user"):
-                        st.markdown(user_input)
-                    
-                    # 在界面上添加助手消息占位符
-                    with st.chat_message("assistant"):
-                        message_placeholder = st.empty()
-                    
-                    try:
-                        # 创建消息列表
-                        messages = [{"role": msg["role"], "content": msg["content"]} for msg in st.session_state.chat_messages]
-                        
-                        # 设置API
-                        openai.api_key = st.session_state.api_key
-                        client_params = {"api_key": st.session_state.api_key}
-                        
-                        if st.session_state.api_base.strip():
-                            if is_old_api:
-                                openai.api_base = st.session_state.api_base
-                            else:
-                                client_params["base_url"] = st.session_state.api_base
-                        
-                        full_response = ""
-                        
-                        # 流式响应
-                        if is_old_api:
-                            # 旧版API - 忽略linter警告
-                            # noinspection PyUnresolvedReferences
-                            response = openai.ChatCompletion.create(
-                                model=st.session_state.model,
-                                messages=messages,
-                                stream=True
-                            )
-                            
-                            for chunk in response:
-                                if chunk.choices[0].get("delta", {}).get("content"):
-                                    content = chunk.choices[0]["delta"]["content"]
-                                    full_response += content
-                                    message_placeholder.markdown(full_response + "▌")
-                        else:
-                            # 新版API
-                            client = openai.OpenAI(**client_params)
-                            stream = client.chat.completions.create(
-                                model=st.session_state.model,
-                                messages=messages,
-                                stream=True
-                            )
-                            
-                            for chunk in stream:
-                                if chunk.choices[0].delta.content:
-                                    content = chunk.choices[0].delta.content
-                                    full_response += content
-                                    message_placeholder.markdown(full_response + "▌")
-                        
-                        # 更新最终响应
-                        message_placeholder.markdown(full_response)
-                        
-                        # 检查是否包含JSON数据并提取
-                        try:
-                            json_start = full_response.find('{')
-                            json_end = full_response.rfind('}') + 1
-                            
-                            if json_start >= 0 and json_end > json_start:
-                                json_str = full_response[json_start:json_end]
-                                try:
-                                    keywords_data = json.loads(json_str)
-                                    
-                                    # 检查是否包含关键词字段
-                                    if any(k in keywords_data for k in ["title_keywords", "image_keywords", "redundant_keywords"]):
-                                        st.success("检测到关键词数据！")
-                                        
-                                        # 创建应用按钮
-                                        if st.button("应用这些关键词"):
-                                            # 更新关键词
-                                            if "title_keywords" in keywords_data and keywords_data["title_keywords"]:
-                                                st.session_state.title_keywords = keywords_data["title_keywords"]
-                                            
-                                            if "image_keywords" in keywords_data and keywords_data["image_keywords"]:
-                                                st.session_state.image_keywords = keywords_data["image_keywords"]
-                                            
-                                            if "redundant_keywords" in keywords_data and keywords_data["redundant_keywords"]:
-                                                st.session_state.redundant_keywords = keywords_data["redundant_keywords"]
-                                            
-                                            # 保存配置
-                                            if update_config():
-                                                st.success("成功应用关键词！")
-                                                st.rerun()
-                                            else:
-                                                st.error("保存配置失败")
-                                        
-                                        # 显示关键词预览
-                                        with st.expander("预览关键词"):
-                                            if "title_keywords" in keywords_data:
-                                                st.write("**标题关键词:**")
-                                                st.write(", ".join(keywords_data["title_keywords"]))
-                                            
-                                            if "image_keywords" in keywords_data:
-                                                st.write("**图片说明关键词:**")
-                                                st.write(", ".join(keywords_data["image_keywords"]))
-                                            
-                                            if "redundant_keywords" in keywords_data:
-                                                st.write("**系统冗余关键词:**")
-                                                st.write(", ".join(keywords_data["redundant_keywords"]))
-                                except Exception as e:
-                                    st.warning(f"解析JSON失败: {str(e)}")
-                        except Exception as e:
-                            pass  # 如果没有JSON数据，忽略错误
-                            
-                        # 添加助手响应到聊天历史
-                        st.session_state.chat_messages.append({"role": "assistant", "content": full_response})
-                        
-                    except Exception as e:
-                        st.error(f"发生错误: {str(e)}")
-                
-                # 清空聊天按钮
-                if st.button("清空聊天记录"):
-                    st.session_state.chat_messages = []
-                    st.rerun()
+            chat_assistant_panel()
 
     # 主界面 - 标签页
-    tab1, tab2 = st.tabs(["单文件处理", "批量处理"])
-    
-    # 创建预览区域容器，在任何选项卡之外，作为共享预览区域
-    preview_container = st.container()
+    tab1, tab2, tab3 = st.tabs(["单文件处理", "批量处理", "归档检索"])
     
-    # 单文件处理标签页
     with tab1:
-        st.header("单文件处理")
-        
-        uploaded_file = st.file_uploader("选择Word文档", type=["docx"], key="single_file")
-        
-        if uploaded_file is not None:
-            st.write(f"已选择: {uploaded_file.name}")
-            
-            # 预处理 - 提取原始文档内容
-            with st.spinner("加载预览..."):
-                input_paragraphs = extract_docx_text(uploaded_file)
-            
-            # AI分析按钮 - 仅在启用AI和上传文件后显示
-            if st.session_state.enable_ai and 'api_key' in st.session_state and st.session_state.api_key:
-                if st.button("使用AI分析关键词", key="analyze_ai_single"):
-                    with st.spinner("AI正在分析文档..."):
-                        content = extract_content_for_ai(uploaded_file)
-                        keywords = analyze_with_openai(
-                            content, 
-                            st.session_state.api_key,
-                            st.session_state.model,
-                            st.session_state.api_base
-                        )
-                        
-                        if keywords:
-                            # 更新会话状态中的关键词
-                            if 'title_keywords' in keywords and keywords['title_keywords']:
-                                st.session_state.title_keywords = keywords['title_keywords']
-                                title_keywords = keywords['title_keywords']
-                            
-                            if 'image_keywords' in keywords and keywords['image_keywords']:
-                                st.session_state.image_keywords = keywords['image_keywords']
-                                image_keywords = keywords['image_keywords']
-                            
-                            if 'redundant_keywords' in keywords and keywords['redundant_keywords']:
-                                st.session_state.redundant_keywords = keywords['redundant_keywords']
-                                redundant_keywords = keywords['redundant_keywords']
-                            
-                            st.success("AI分析完成，关键词已更新!")
-                            # 显示分析结果
-                            with st.expander("查看AI分析结果"):
-                                st.write("**标题关键词:**")
-                                st.write(", ".join(st.session_state.title_keywords))
-                                st.write("**图片说明关键词:**")
-                                st.write(", ".join(st.session_state.image_keywords))
-                                st.write("**系统冗余关键词:**")
-                                st.write(", ".join(st.session_state.redundant_keywords))
-            
-            # 创建处理按钮和结果容器
-            process_btn = st.button("开始处理", key="process_single")
-            result_container = st.container()
-
-            output_paragraphs = None  # 初始化输出段落变量
-            
-            # 在处理按钮点击后处理文档
-            if process_btn:
-                with st.spinner("处理中..."):
-                    output_file, output_paragraphs = process_single_file(
-                        uploaded_file,
-                        title_keywords,
-                        image_keywords,
-                        st.session_state.font_name,
-                        st.session_state.font_size,
-                        st.session_state.indent
-                    )
-                    
-                    if output_file and output_paragraphs:
-                        with result_container:
-                            st.success("处理完成!")
-                            st.markdown(
-                                get_binary_file_downloader_html(output_file, '点击下载处理后的文件'),
-                                unsafe_allow_html=True
-                            )
-            
-            # 更新预览区域（这部分会在上传文件后立即执行，并在处理完成后再次更新）
-            with preview_container:
-                update_preview_area(input_paragraphs, output_paragraphs)
+        single_file_panel()
     
-    # 批量处理标签页
     with tab2:
-        st.header("批量处理")
-        
-        uploaded_files = st.file_uploader("选择多个Word文档", type=["docx"], accept_multiple_files=True, key="batch_files")
-        
-        batch_input_paragraphs = None
-        batch_output_paragraphs = None
-        
-        if uploaded_files:
-            st.write(f"已选择 {len(uploaded_files)} 个文件")
-            
-            file_list = ""
-            for file in uploaded_files:
-                file_list += f"- {file.name}\n"
-            
-            st.markdown(file_list)
-            
-            # 预览选择的文件
-            if len(uploaded_files) > 0:
-                preview_file = st.selectbox(
-                    "选择要预览的文件",
-                    options=[file.name for file in uploaded_files],
-                    index=0
-                )
-                
-                # 获取选中的文件对象
-                selected_file = next((f for f in uploaded_files if f.name == preview_file), None)
-                
-                if selected_file:
-                    with st.spinner("加载预览..."):
-                        batch_input_paragraphs = extract_docx_text(selected_file)
-            
-            output_files = None  # 初始化输出文件列表
-            
-            if st.button("开始批量处理", key="process_batch"):
-                with st.spinner("批量处理中..."):
-                    output_files = process_batch_files(
-                        uploaded_files,
-                        st.session_state.title_keywords,
-                        st.session_state.image_keywords,
-                        st.session_state.font_name,
-                        st.session_state.font_size,
-                        st.session_state.indent
-                    )
-                    
-                    if output_files:
-                        st.success(f"批处理完成! 共处理 {len(output_files)} 个文件")
-                        
-                        # 创建ZIP文件并提供下载
-                        zip_file = create_zip_of_files(output_files)
-                        st.markdown(
-                            get_binary_file_downloader_html(zip_file, '点击下载所有处理后的文件 (ZIP)'),
-                            unsafe_allow_html=True
-                        )
-                        
-                        # 更新预览以显示处理后的内容
-                        if len(output_files) > 0:
-                            preview_output_file = st.selectbox(
-                                "选择要预览的处理后文件",
-                                options=[filename for filename, _ in output_files],
-                                index=0
-                            )
-                            
-                            # 获取选中的文件路径
-                            selected_output_path = next((filepath for filename, filepath in output_files if filename == preview_output_file), None)
-                            
-                            if selected_output_path:
-                                batch_output_paragraphs = extract_docx_text(selected_output_path)
-                        
-                        # 清理临时文件
-                        for _, filepath in output_files:
-                            if os.path.exists(filepath):
-                                os.unlink(filepath)
-                        if os.path.exists(zip_file):
-                            os.unlink(zip_file)
-            
-            # 更新批处理预览
-            if batch_input_paragraphs:
-                with preview_container:
-                    update_preview_area(batch_input_paragraphs, batch_output_paragraphs)
+        batch_panel()
     
+    with tab3:
+        archive_search_panel()
+    
+
     # 页脚
     st.markdown("---")
     st.caption("Word文档格式规范工具 © 2023")
 
-def update_preview_area(input_paragraphs, output_paragraphs=None):
-    """更新统一的预览区域"""
+def update_preview_area(input_paragraphs, trace=None, live=False, key="preview"):
+    """更新统一的预览区域，处理后内容和差异视图都由处理记录生成"""
     st.header("文件预览")
     
     if not input_paragraphs:
@@ -1172,9 +4898,22 @@ def update_preview_area(input_paragraphs, output_paragraphs=None):
         return
     
     # 如果没有处理后的内容，只显示输入文件
-    if output_paragraphs is None:
+    if trace is None:
         st.subheader("原始文档")
         render_preview(input_paragraphs)
+        return
+    
+    view = st.radio(
+        "预览方式",
+        options=["并排对比", "差异视图"],
+        horizontal=True,
+        key=key,
+        label_visibility="collapsed"
+    )
+    
+    if view == "差异视图":
+        st.subheader("处理差异（实时预览）" if live else "处理差异")
+        render_trace_diff(trace, max_height=600)
     else:
         # 有处理后的内容，显示对比视图
         st.subheader("文档对比")
@@ -1185,8 +4924,8 @@ def update_preview_area(input_paragraphs, output_paragraphs=None):
             render_preview(input_paragraphs, max_height=600)
         
         with col2:
-            st.markdown("#### 处理后文档")
-            render_preview(output_paragraphs, max_height=600)
+            st.markdown("#### 处理后文档（实时预览）" if live else "#### 处理后文档")
+            render_preview(trace_output_paragraphs(trace), max_height=600)
 
 if __name__ == "__main__":
     main()
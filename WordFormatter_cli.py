@@ -0,0 +1,376 @@
+import os
+import sys
+import json
+import shutil
+import csv
+import hashlib
+import argparse
+
+import WordFormatter_GUI as app
+
+class LocalFileUpload:
+    """
+    磁盘上的docx文件，提供与上传文件相同的读取接口（name、size、seek、read）；
+    文件在第一次读取时才打开，处理完成后调用release()关闭
+    """
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.size = os.path.getsize(path)
+        self._digest = None
+        self._file = None
+
+    @property
+    def content_digest(self):
+        if self._digest is None:
+            sha256 = hashlib.sha256()
+            with open(self.path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    sha256.update(chunk)
+            self._digest = sha256.hexdigest()
+        return self._digest
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.path, "rb")
+        return self._file
+
+    def open_stream(self):
+        return open(self.path, "rb")
+
+    def seek(self, offset, whence=0):
+        return self._open().seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell() if self._file is not None else 0
+
+    def read(self, size=-1):
+        return self._open().read(size)
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def release(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+def collect_inputs(paths):
+    """
+    收集输入文件：docx文件、ZIP压缩包（逐个读取其中的docx，不解压）或包含docx的目录
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                for name in sorted(names):
+                    if name.lower().endswith(".docx") and not name.startswith("~$"):
+                        files.append(LocalFileUpload(os.path.join(root, name)))
+        elif path.lower().endswith(".zip"):
+            files.extend(app.open_zip_entries(path))
+        elif path.lower().endswith(".docx"):
+            files.append(LocalFileUpload(path))
+        else:
+            raise ValueError(f"不支持的输入文件: {path}")
+    return files
+
+def load_settings(config_path):
+    """
+    读取应用的配置文件，未指定时使用默认配置
+    """
+    config = json.loads(json.dumps(app.DEFAULT_CONFIG))
+    if config_path:
+        with open(config_path, "r", encoding="utf-8") as f:
+            user_config = json.load(f)
+        for key, value in user_config.items():
+            if isinstance(value, dict) and isinstance(config.get(key), dict):
+                config[key].update(value)
+            else:
+                config[key] = value
+    return config
+
+def print_progress(value, message=""):
+    sys.stderr.write(f"\r[{value:3d}%] {message[:60]:<60}")
+    sys.stderr.flush()
+
+def queue_items(files):
+    """
+    输入文件转为任务队列的 (文件名, 路径, 压缩包内文件名) 列表；
+    工作进程直接读取这些路径，因此输入需要位于所有机器都能访问的共享目录中
+    """
+    items = []
+    for f in files:
+        if isinstance(f, app.ZipEntryUpload):
+            items.append((f.name, f.archive.filename, f.info.filename))
+        else:
+            items.append((f.name, f.path, None))
+    return items
+
+def run_worker(args):
+    """
+    工作进程模式：从共享任务队列领取文件处理，直到按Ctrl+C停止（或队列为空时退出）
+    """
+    queue = app.JobQueue(args.worker)
+    archive = app.DocumentArchive(args.archive) if args.archive else None
+    print(f"工作进程已启动，队列: {queue.db_path}")
+    try:
+        processed = app.run_queue_worker(
+            queue,
+            worker_id=args.worker_id,
+            lease_seconds=args.lease,
+            exit_when_idle=args.exit_when_idle,
+            archive=archive,
+            log=print
+        )
+    except KeyboardInterrupt:
+        print("已停止，未完成的文件会在租约过期后由其他工作进程重新处理")
+        return 0
+    print(f"队列已空，共处理 {processed} 个文件")
+    return 0
+
+def run_local(args, files, config, output, near_duplicates):
+    """
+    在本进程中处理全部文件
+    """
+    pool = None
+    if args.processes > 0 and near_duplicates is None:
+        pool = app.ProcessingPool(processes=args.processes, template_path=args.template)
+    try:
+        return app.process_batch_files(
+            files,
+            config["title_keywords"],
+            config["image_keywords"],
+            config["formatting"]["font_name"],
+            config["formatting"]["font_size"],
+            config["formatting"]["indent"],
+            redundant_keywords=config["redundant_keywords"],
+            near_duplicates=near_duplicates,
+            spool_threshold_mb=args.spool_mb,
+            window=max(1, args.window, args.processes),
+            streaming=args.streaming,
+            progress_callback=print_progress,
+            export_format=args.format,
+            archive=app.DocumentArchive(args.archive) if args.archive else None,
+            template_path=args.template,
+            output_zip=output if args.format == "docx" else None,
+            pool=pool,
+        )
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+def run_merge(args, files, config, output, near_duplicates):
+    """
+    把全部文件按顺序合并为一份简报
+    """
+    pool = None
+    if args.processes > 0:
+        pool = app.ProcessingPool(processes=args.processes, template_path=args.template)
+    files = app.order_batch_files(files, args.order)
+    try:
+        return app.merge_documents(
+            [(f.name, f) for f in files],
+            output,
+            config["title_keywords"],
+            config["image_keywords"],
+            config["formatting"]["font_name"],
+            config["formatting"]["font_size"],
+            config["formatting"]["indent"],
+            redundant_keywords=config["redundant_keywords"],
+            near_duplicates=near_duplicates,
+            template_path=args.template,
+            page_break=args.page_break,
+            progress_callback=print_progress,
+            trace_path=args.trace,
+            archive=app.DocumentArchive(args.archive) if args.archive else None,
+            pool=pool,
+        )
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+def run_triage(files, config, output=None):
+    """
+    预检模式：只运行分类规则，输出每个文件的段落统计和需要检查的问题，不生成文档
+    """
+    rows = app.triage_files(
+        files,
+        config["title_keywords"],
+        config["image_keywords"],
+        config["redundant_keywords"],
+        progress_callback=print_progress
+    )
+    sys.stderr.write("\n")
+    if output:
+        # 带BOM的UTF-8，Excel可以直接打开
+        with open(output, "w", encoding="utf-8-sig", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+    flagged = [row for row in rows if row["问题"]]
+    for row in flagged:
+        print(f"⚠️ {row['文件']}: {row['问题']}（段落 {row['段落数']}，标题 {row['标题']}，删除 {row['删除段落']}）")
+    print(f"预检完成，{len(flagged)}/{len(rows)} 个文件需要检查" + (f"，汇总表: {output}" if output else ""))
+    return 0
+
+def main():
+    """
+    命令行批量处理Word文档，输入可以是docx文件、ZIP压缩包或目录
+    """
+    parser = argparse.ArgumentParser(description="Word文档格式规范工具（命令行批量处理）")
+    parser.add_argument("inputs", nargs="*", help="docx文件、包含docx的ZIP压缩包或目录")
+    parser.add_argument("-o", "--output",
+                        help="输出文件路径（默认：标准化处理结果.zip，NDJSON格式为 分类数据.ndjson，合并简报为 合并简报.docx）")
+    parser.add_argument("--format", choices=["docx", "ndjson", "bulletin"], default="docx",
+                        help="输出格式：Word文档ZIP、NDJSON分类数据或合并为一份简报")
+    parser.add_argument("--order", choices=["input", "name"], default="input",
+                        help="合并简报的文章顺序：按输入顺序或按文件名")
+    parser.add_argument("--page-break", action="store_true", help="合并简报中每篇文章另起一页")
+    parser.add_argument("--trace", help="合并简报时把处理记录写入该NDJSON文件")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="预检模式：只运行分类规则，列出可能丢失内容或识别有误的文件，不生成文档（-o 指定时写出CSV汇总表）")
+    parser.add_argument("--config", help="配置文件路径（config.json），用于读取关键词和格式设置")
+    parser.add_argument("--template", help="输出文档使用的单位模板（.docx/.dotx）")
+    parser.add_argument("--streaming", action="store_true", help="流式写出document.xml")
+    parser.add_argument("--window", type=int, default=2, help="同时处理的文件数（启用近似重复检测时逐个处理）")
+    parser.add_argument("--processes", type=int, default=0,
+                        help="在指定数量的工作进程中并行处理（0表示在本进程的线程中处理；启用近似重复检测时不使用）")
+    parser.add_argument("--spool-mb", type=float, default=8, help="超过该大小的文件先写入磁盘再处理（MB）")
+    parser.add_argument("--near-duplicates", choices=["off", "mark", "drop"], default="off",
+                        help="跨文件近似重复检测：关闭、仅标记或标记并删除")
+    parser.add_argument("--dup-threshold", type=float, default=0.8, help="近似重复的相似度阈值")
+    parser.add_argument("--archive", help="将处理结果写入该检索归档数据库（archive.sqlite3）")
+    parser.add_argument("--queue", help="提交到该共享任务队列（SQLite文件），由工作进程处理，本进程只汇总进度")
+    parser.add_argument("--worker", metavar="QUEUE", help="以工作进程模式运行，从该共享任务队列领取文件处理")
+    parser.add_argument("--worker-id", help="工作进程标识（默认：主机名:进程号）")
+    parser.add_argument("--lease", type=float, default=app.QUEUE_LEASE_SECONDS, help="任务租约时长（秒）")
+    parser.add_argument("--exit-when-idle", action="store_true", help="队列为空时退出工作进程")
+    parser.add_argument("--profile", metavar="PROF",
+                        help="用cProfile记录整个运行并保存到该文件（pstats格式，可用snakeviz等工具打开），结束时列出最耗时的函数")
+    args = parser.parse_args()
+
+    if not args.profile:
+        return run(args, parser)
+    if args.processes:
+        print("性能分析只能记录本进程中的处理，忽略 --processes")
+        args.processes = 0
+    profiler = app.RunProfiler()
+    with profiler:
+        code = run(args, parser)
+    profiler.save(args.profile)
+    print_profile(profiler)
+    print(f"性能分析文件: {args.profile}")
+    return code
+
+def print_profile(profiler, limit=15):
+    """
+    输出按自身耗时排序的热点函数
+    """
+    print(f"\n总耗时 {profiler.elapsed:.2f} 秒，最耗时的函数（按自身耗时）：")
+    print(f"{'自身耗时':>8} {'累计耗时':>8} {'调用次数':>8}  函数")
+    for row in profiler.top_functions(limit):
+        print(f"{row['自身耗时(秒)']:>12.4f} {row['累计耗时(秒)']:>12.4f} {row['调用次数']:>12}  {row['函数']}")
+
+def run(args, parser):
+    """
+    按命令行参数执行批量处理、预检、合并简报、提交队列或工作进程模式
+    """
+    if args.worker:
+        return run_worker(args)
+    if not args.inputs:
+        parser.error("需要指定输入文件")
+    if args.queue and args.near_duplicates != "off":
+        parser.error("共享任务队列模式不支持跨文件近似重复检测")
+    if args.queue and args.format == "bulletin":
+        parser.error("共享任务队列模式不支持合并简报")
+
+    try:
+        files = collect_inputs(args.inputs)
+    except Exception as e:
+        print(f"❌ 读取输入失败: {str(e)}")
+        return 1
+    if not files:
+        print("❌ 没有找到docx文件")
+        return 1
+    print(f"共 {len(files)} 个文件")
+
+    config = load_settings(args.config)
+    if args.dry_run:
+        return run_triage(files, config, args.output)
+    output = args.output or {"ndjson": "分类数据.ndjson", "bulletin": app.BULLETIN_FILENAME}.get(args.format, "标准化处理结果.zip")
+    near_duplicates = None
+    if args.near_duplicates != "off":
+        near_duplicates = app.NearDuplicateIndex(threshold=args.dup_threshold, drop=args.near_duplicates == "drop")
+
+    if args.format == "bulletin":
+        summary = run_merge(args, files, config, output, near_duplicates)
+        sys.stderr.write("\n")
+        for name, error in summary["errors"]:
+            print(f"❌ 处理文件 {name} 失败: {error}")
+        if not summary["articles"]:
+            os.unlink(output)
+            print("❌ 没有成功处理的文件")
+            return 1
+        print(f"✅ 合并完成，共 {summary['articles']} 篇文章、{summary['paragraphs']} 个段落，"
+              f"删除重复标题 {summary['duplicates']} 个，输出: {output}")
+        return 0
+
+    if args.queue:
+        queue = app.JobQueue(args.queue)
+        settings = {
+            "title_keywords": config["title_keywords"],
+            "image_keywords": config["image_keywords"],
+            "redundant_keywords": config["redundant_keywords"],
+            "font_name": config["formatting"]["font_name"],
+            "font_size": config["formatting"]["font_size"],
+            "indent": config["formatting"]["indent"],
+            "streaming": args.streaming,
+            "export_format": args.format,
+            "template_path": os.path.abspath(args.template) if args.template else None,
+        }
+        batch_id = queue.enqueue(queue_items(files), settings)
+        print(f"已提交到任务队列，批次: {batch_id}")
+        try:
+            result = app.wait_for_queue_batch(
+                queue,
+                batch_id,
+                progress_callback=print_progress,
+                output_zip=output if args.format == "docx" else None
+            )
+        except KeyboardInterrupt:
+            sys.stderr.write("\n")
+            print(f"已停止等待，工作进程会继续处理批次 {batch_id}")
+            return 1
+    else:
+        result = run_local(args, files, config, output, near_duplicates)
+    sys.stderr.write("\n")
+
+    if args.format == "ndjson" and result["output_files"]:
+        shutil.move(app.merge_ndjson_files(result["output_files"]), output)
+
+    if result["resumed"]:
+        print(f"已恢复未完成的批处理任务，跳过 {result['resumed']} 个已完成的文件")
+    for name, error in result["errors"]:
+        print(f"❌ 处理文件 {name} 失败: {error}")
+    if near_duplicates is not None and near_duplicates.duplicates:
+        action = "已删除" if near_duplicates.drop else "已标记"
+        print(f"检测到 {len(near_duplicates.duplicates)} 个近似重复段落（{action}）")
+    if result["memory"]:
+        print(result["memory"])
+
+    if not result["output_files"]:
+        print("❌ 没有成功处理的文件")
+        return 1
+    # 全部成功时删除任务目录；有失败文件时保留，重新运行相同命令可跳过已完成的文件
+    if not result["errors"]:
+        if args.queue:
+            queue.remove_batch(batch_id)
+        shutil.rmtree(result["job_dir"], ignore_errors=True)
+    print(f"✅ 处理完成，共 {len(result['output_files'])} 个文件，输出: {output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,69 @@
+"""
+共享进程池中工作进程执行的函数。
+Streamlit以__main__的方式运行WordFormatter_GUI.py，子进程无法按名称找到脚本中的函数，
+因此提交给进程池的函数放在这个可以导入的模块中
+"""
+import io
+import functools
+
+import WordFormatter_GUI as app
+
+# 预热用的示例段落，覆盖标题、正文、审稿信息等处理分支
+WARM_UP_PARAGRAPHS = ["培训会顺利召开", "（通讯员 张三）", "为提升学生能力，学院开展了培训。", "主持人发言", "一审：李四"]
+
+# 本工作进程最近一次预热的配置（输出模板和关键词）
+_warmed_key = None
+
+def warm_up(template_path=None, keyword_lists=()):
+    """
+    进程池初始化：编译关键词匹配、解析输出模板，并处理一个示例文档，
+    让python-docx和lxml的延迟加载部分在第一个文件之前完成；配置与上次预热相同时直接返回
+    """
+    global _warmed_key
+    key = app.warm_up_key(template_path, keyword_lists)
+    if key == _warmed_key:
+        return
+    for keywords in keyword_lists:
+        app.keyword_pattern(tuple(keywords))
+    app.get_docx_template(template_path)
+
+    sample = app.Document()
+    for text in WARM_UP_PARAGRAPHS:
+        sample.add_paragraph(text)
+    source = io.BytesIO()
+    sample.save(source)
+    for streaming in (False, True):
+        source.seek(0)
+        app.process_docx(source, io.BytesIO(), streaming=streaming, template_path=template_path)
+    _warmed_key = key
+
+def ping():
+    return True
+
+def parse_document(source):
+    """
+    解析文档，返回DocumentModel.state()（只包含内置类型，可以传回主进程）
+    """
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    return app.DocumentModel.parse(source).state()
+
+@functools.lru_cache(maxsize=4)
+def open_archive(db_path):
+    return app.DocumentArchive(db_path)
+
+def process_file(source, output_path, export_format="docx", options=None, archive_path=None):
+    """
+    处理一个文件，source为文件路径、文件内容（bytes）或DocumentModel.state()；返回处理记录（NDJSON导出时返回None）
+    """
+    options = options or {}
+    # 预热任务不一定分配到每个工作进程，处理前按本文件的配置检查，配置变化时先在本进程中预热
+    warm_up(options.get("template_path"),
+            tuple(options.get(key) or () for key in ("title_keywords", "image_keywords", "redundant_keywords")))
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    elif isinstance(source, tuple):
+        source = app.DocumentModel.from_state(source)
+    archive = open_archive(archive_path) if archive_path else None
+    process = app.export_ndjson if export_format == "ndjson" else app.process_docx
+    return process(source, output_path, archive=archive, **options)
@@ -1,81 +1,188 @@
 import os
 import sys
+import ast
+import argparse
 import subprocess
 
-def main():
-    """
-    使用Nuitka打包Streamlit应用为可执行文件
-    """
-    # 确保安装nuitka
-    try:
-        subprocess.run([sys.executable, "-m", "pip", "install", "nuitka"], check=True)
-        print("✅ Nuitka已安装")
-    except Exception as e:
-        print(f"❌ 安装Nuitka失败: {str(e)}")
-        return
-    
-    # 创建启动器脚本
-    launcher_path = "WordFormatter_launcher.py"
-    with open(launcher_path, "w", encoding="utf-8") as f:
-        f.write("""
+APP_SCRIPT = "WordFormatter_GUI.py"
+SERVER_PORT = 8501
+
+# 需要额外打包数据文件的第三方包（模板、前端静态资源等）
+PACKAGE_DATA = {
+    "docx": ["--include-package-data=docx"],
+    "streamlit": ["--include-package-data=streamlit"],
+}
+
+# 标准库模块对应的Nuitka插件
+MODULE_PLUGINS = {
+    "tkinter": ["--enable-plugin=tk-inter"],
+}
+
+LAUNCHER_TEMPLATE = """
 import os
 import sys
-import subprocess
 import threading
 import webbrowser
 import time
+import urllib.request
+import urllib.error
+
+SERVER_PORT = {port}
+APP_URL = f"http://localhost:{{SERVER_PORT}}"
+HEALTH_URL = f"{{APP_URL}}/_stcore/health"
+
+def wait_until_ready(timeout=60, interval=0.1):
+    # 轮询Streamlit健康检查接口，服务器就绪后立即返回
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(HEALTH_URL, timeout=1) as response:
+                if response.status == 200:
+                    return True
+        except (urllib.error.URLError, OSError):
+            pass
+        time.sleep(interval)
+    return False
 
 def open_browser():
-    # 等待服务器启动
-    time.sleep(2)
-    # 打开浏览器
-    webbrowser.open('http://localhost:8501')
+    # 等待服务器就绪后再打开浏览器，超时仍尝试打开
+    wait_until_ready()
+    webbrowser.open(APP_URL)
 
 def main():
-    # 设置环境变量，使Streamlit不显示菜单等
-    os.environ['STREAMLIT_SERVER_HEADLESS'] = 'false'
+    # 设置环境变量，使Streamlit不显示菜单等；浏览器由启动器负责打开
+    os.environ['STREAMLIT_SERVER_HEADLESS'] = 'true'
     os.environ['STREAMLIT_SERVER_ADDRESS'] = 'localhost'
-    os.environ['STREAMLIT_SERVER_PORT'] = '8501'
+    os.environ['STREAMLIT_SERVER_PORT'] = str(SERVER_PORT)
     os.environ['STREAMLIT_SERVER_ENABLE_TELEMETRY'] = 'false'
     os.environ['STREAMLIT_THEME_PRIMARYCOLOR'] = '#2E86C1'
     os.environ['STREAMLIT_BROWSER_GATHER_USAGE_STATS'] = 'false'
-    
+    os.environ['STREAMLIT_GLOBAL_DEVELOPMENT_MODE'] = 'false'
+
+    # 导入主应用，确保打包时跟随其依赖
+    import WordFormatter_GUI
+    from streamlit.web import cli as stcli
+
     # 启动浏览器线程
     threading.Thread(target=open_browser, daemon=True).start()
-    
-    # 导入并运行主应用
-    import WordFormatter_GUI
-    
+
+    # 启动Streamlit服务器
+    app_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "{app_script}")
+    sys.argv = ["streamlit", "run", app_script]
+    sys.exit(stcli.main())
+
 if __name__ == "__main__":
     main()
-""")
-    print(f"✅ 创建启动器脚本: {launcher_path}")
-    
-    # 构建nuitka命令
-    nuitka_cmd = [
-        sys.executable, "-m", "nuitka",
-        "--standalone",
+"""
+
+def find_app_imports(script_path):
+    """
+    扫描应用源码，返回实际导入的顶层模块名（包括函数内部的延迟导入）
+    """
+    with open(script_path, "r", encoding="utf-8") as f:
+        tree = ast.parse(f.read(), filename=script_path)
+
+    modules = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                modules.add(alias.name.split(".")[0])
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            modules.add(node.module.split(".")[0])
+    return modules
+
+def build_slim_options(script_path):
+    """
+    根据应用实际导入的模块生成精简打包参数
+    """
+    modules = find_app_imports(script_path)
+    stdlib = set(sys.stdlib_module_names)
+    third_party = sorted(m for m in modules if m not in stdlib)
+    app_dir = os.path.dirname(os.path.abspath(script_path))
+
+    options = []
+    for module in third_party:
+        if os.path.exists(os.path.join(app_dir, f"{module}.py")):
+            # 本地模块随主程序一起跟随导入
+            options.append(f"--include-module={module}")
+        else:
+            options.append(f"--include-package={module}")
+        options.extend(PACKAGE_DATA.get(module, []))
+    for module in sorted(modules & stdlib):
+        options.extend(MODULE_PLUGINS.get(module, []))
+
+    print(f"应用依赖的第三方模块: {', '.join(third_party)}")
+    return options
+
+def build_full_options():
+    """
+    完整打包参数（包含全部依赖包）
+    """
+    return [
         "--follow-imports",
         "--plugin-enable=numpy",
         "--plugin-enable=pylint-warnings",
         "--plugin-enable=tk-inter",
         "--include-package=streamlit",
+        "--include-package-data=streamlit",
         "--include-package=docx",
+        "--include-package-data=docx",
         "--include-package=openai",
         "--include-package=pandas",
         "--include-package=PIL",
+    ]
+
+def main():
+    """
+    使用Nuitka打包Streamlit应用为可执行文件
+    """
+    parser = argparse.ArgumentParser(description="打包Word文档格式规范工具")
+    parser.add_argument(
+        "--slim",
+        action="store_true",
+        help="精简模式：只打包应用实际导入的模块，体积更小、启动更快"
+    )
+    args = parser.parse_args()
+
+    # 确保安装nuitka
+    try:
+        subprocess.run([sys.executable, "-m", "pip", "install", "nuitka"], check=True)
+        print("✅ Nuitka已安装")
+    except Exception as e:
+        print(f"❌ 安装Nuitka失败: {str(e)}")
+        return
+
+    # 创建启动器脚本
+    launcher_path = "WordFormatter_launcher.py"
+    with open(launcher_path, "w", encoding="utf-8") as f:
+        f.write(LAUNCHER_TEMPLATE.format(port=SERVER_PORT, app_script=APP_SCRIPT))
+    print(f"✅ 创建启动器脚本: {launcher_path}")
+
+    if args.slim:
+        print("使用精简打包模式")
+        package_options = build_slim_options(APP_SCRIPT)
+    else:
+        package_options = build_full_options()
+
+    # 构建nuitka命令
+    nuitka_cmd = [
+        sys.executable, "-m", "nuitka",
+        "--standalone",
+        *package_options,
+        # Streamlit以源码方式运行应用脚本，需要随程序一起分发
+        f"--include-data-files={APP_SCRIPT}={APP_SCRIPT}",
         "--windows-disable-console",
         "--windows-icon-from-ico=favicon.ico" if os.path.exists("favicon.ico") else "",
         "--output-dir=dist",
         launcher_path
     ]
-    
+
     # 移除空字符串
     nuitka_cmd = [item for item in nuitka_cmd if item]
-    
+
     print("开始打包应用...")
     print(f"执行命令: {' '.join(nuitka_cmd)}")
-    
+
     try:
         # 运行nuitka命令
         subprocess.run(nuitka_cmd, check=True)
@@ -85,4 +192,4 @@ if __name__ == "__main__":
         return
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
@@ -0,0 +1,334 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import shutil
+import threading
+import contextlib
+import collections
+import multiprocessing
+import io
+
+from docx import Document
+from streamlit.testing.v1 import AppTest
+
+import WordFormatter_GUI as app
+from mock_ai_server import MockAIServer
+
+APP_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "WordFormatter_GUI.py")
+DOCX_MIME = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+# 合成文档使用的素材，覆盖标题、署名、图片说明、正文和审稿信息等处理分支
+SAMPLE_TITLES = ["学院举办就业宣讲会", "物电学院开展志愿活动", "学院召开学生干部培训会", "学院组织学科竞赛"]
+SAMPLE_CAPTIONS = ["主持人发言", "选手展示作品", "工作人员合影", "主讲人授课"]
+SAMPLE_SENTENCES = [
+    "为提升学生的专业能力，学院精心组织了本次活动。",
+    "活动现场气氛热烈，同学们积极参与讨论。",
+    "与会老师对同学们的表现给予了充分肯定。",
+    "本次活动进一步丰富了校园文化生活。",
+    "同学们纷纷表示收获颇丰，将把所学运用到学习中。",
+]
+
+# 每个模拟会话依次执行的操作
+ACTIONS = ["打开页面", "上传文档", "修改关键词", "AI分析", "单文件处理", "批量处理"]
+
+# AppTest每次运行脚本时都会替换全局的Runtime实例，不能在同一进程中并发运行，
+# 因此各会话的脚本运行依次执行（相当于脚本中的计算都受GIL限制），后台任务仍在共享的执行器和进程池中并发处理。
+# 等待这个锁的时间单独记为排队时间，从操作耗时中扣除后得到服务时间
+SCRIPT_RUN_LOCK = threading.Lock()
+
+def make_sample_document(seed, paragraphs=40):
+    """
+    生成一篇合成的新闻稿（docx字节），内容由seed决定，便于复现
+    """
+    rng = random.Random(seed)
+    doc = Document()
+    doc.add_paragraph(rng.choice(SAMPLE_TITLES))
+    doc.add_paragraph("（通讯员 张三）")
+    for i in range(paragraphs):
+        if i % 8 == 7:
+            doc.add_paragraph(rng.choice(SAMPLE_CAPTIONS))
+        else:
+            doc.add_paragraph("".join(rng.choice(SAMPLE_SENTENCES) for _ in range(rng.randint(2, 6))))
+    doc.add_paragraph("一审：李四 二审：王五 三审：赵六")
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+def process_rss(pid="self"):
+    """
+    返回进程的常驻内存（字节），无法获取时返回None
+    """
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def total_rss():
+    """
+    本进程和子进程（共享进程池的工作进程）的常驻内存之和，无法获取时返回None
+    """
+    rss = process_rss()
+    if rss is None:
+        return None
+    return rss + sum(process_rss(child.pid) or 0 for child in multiprocessing.active_children())
+
+class TotalMemoryMonitor:
+    """
+    后台定时采样本进程及其子进程的常驻内存之和，记录峰值
+    """
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while True:
+            rss = total_rss()
+            if rss is not None and (self.peak is None or rss > self.peak):
+                self.peak = rss
+            if self._stop.wait(self.interval):
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+class LatencyRecorder:
+    """
+    线程安全地记录各操作的服务时间（耗时减去等待其他会话脚本运行的排队时间）、排队时间和出错次数
+    """
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.queued = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.lock = threading.Lock()
+
+    def add(self, action, seconds, queued=0.0):
+        with self.lock:
+            self.latencies[action].append(max(0.0, seconds - queued))
+            self.queued[action].append(queued)
+
+    def error(self, action):
+        with self.lock:
+            self.errors[action] += 1
+
+    def summary(self):
+        with self.lock:
+            return {
+                action: {
+                    "count": len(values),
+                    "p50": percentile(values, 0.5),
+                    "p95": percentile(values, 0.95),
+                    "max": max(values),
+                    "queued_p50": percentile(self.queued[action], 0.5),
+                    "errors": self.errors[action],
+                }
+                for action, values in self.latencies.items()
+            }
+
+class SimulatedSession:
+    """
+    一个模拟用户：通过Streamlit的AppTest在本进程中运行应用脚本，按ACTIONS的顺序操作界面。
+    所有会话共享同一个进程中的缓存资源（后台任务执行器、进程池、文档模型缓存），与一台服务器上的多个用户一致
+    """
+    def __init__(self, session_index, recorder, documents, batch_documents, api_base=None, timeout=120, poll=0.2):
+        self.index = session_index
+        self.recorder = recorder
+        self.documents = documents
+        self.batch_documents = batch_documents
+        self.api_base = api_base
+        self.timeout = timeout
+        self.poll = poll
+        self.at = AppTest.from_file(APP_FILE, default_timeout=timeout)
+        if api_base:
+            self.at.session_state["enable_ai"] = True
+            self.at.session_state["api_key"] = "mock-key"
+            self.at.session_state["api_base"] = api_base
+            self.at.session_state["model"] = "mock-model"
+
+    def _run(self):
+        start = time.perf_counter()
+        with SCRIPT_RUN_LOCK:
+            self.queued += time.perf_counter() - start
+            self.at.run()
+
+    def _timed(self, action, fn):
+        self.queued = 0.0
+        start = time.perf_counter()
+        try:
+            fn()
+            if self.at.exception:
+                raise RuntimeError(self.at.exception[0].value)
+        except Exception:
+            self.recorder.error(action)
+            return False
+        self.recorder.add(action, time.perf_counter() - start, self.queued)
+        return True
+
+    def _wait_for_job(self):
+        # 后台任务运行时页面显示"取消任务"按钮，轮询到按钮消失即任务结束
+        deadline = time.time() + self.timeout
+        while any(button.label == "取消任务" for button in self.at.button):
+            if time.time() > deadline:
+                raise TimeoutError("等待后台任务超时")
+            time.sleep(self.poll)
+            self._run()
+
+    def _upload(self):
+        name, data = self.documents[self.iteration % len(self.documents)]
+        self.at.file_uploader(key="single_file").set_value((f"{self.index}_{name}", data, DOCX_MIME))
+        self._run()
+
+    def _edit_keywords(self):
+        area = next(area for area in self.at.text_area if area.label == "标题关键词")
+        area.set_value(", ".join(app.TITLE_KEYWORDS + [f"测试{self.iteration}"]))
+        self._run()
+
+    def _analyze(self):
+        self.at.button(key="analyze_ai_single").click()
+        self._run()
+
+    def _process(self):
+        self.at.button(key="process_single").click()
+        self._run()
+        self._wait_for_job()
+        if not any(success.value == "处理完成!" for success in self.at.success):
+            raise RuntimeError("单文件处理未完成")
+
+    def _process_batch(self):
+        # 文件名包含轮次，避免后一轮直接恢复前一轮已完成的批处理任务
+        files = [(f"{self.index}_{self.iteration}_{name}", data, DOCX_MIME) for name, data in self.batch_documents]
+        self.at.file_uploader(key="batch_files").set_value(files)
+        self._run()
+        self.at.button(key="process_batch").click()
+        self._run()
+        self._wait_for_job()
+        if not any(success.value.startswith("批处理完成") for success in self.at.success):
+            raise RuntimeError("批量处理未完成")
+
+    def run(self, iterations):
+        if not self._timed("打开页面", self._run):
+            return 0
+        completed = 0
+        for self.iteration in range(iterations):
+            ok = self._timed("上传文档", self._upload) and self._timed("修改关键词", self._edit_keywords)
+            if ok and self.api_base:
+                ok = self._timed("AI分析", self._analyze)
+            if ok:
+                ok = self._timed("单文件处理", self._process)
+            if ok and self.batch_documents:
+                ok = self._timed("批量处理", self._process_batch)
+            completed += ok
+        return completed
+
+def run_level(concurrency, iterations, documents, batch_documents, api_base=None, timeout=120):
+    """
+    同时运行concurrency个模拟会话，返回该并发数下的各操作服务时间、实测吞吐量和内存峰值。
+    吞吐量按实际用时计算，包括脚本依次运行造成的排队，反映的是并发增加时的实际表现
+    """
+    recorder = LatencyRecorder()
+    sessions = [SimulatedSession(i, recorder, documents, batch_documents, api_base, timeout) for i in range(concurrency)]
+    completed = [0] * concurrency
+
+    def worker(i):
+        completed[i] = sessions[i].run(iterations)
+
+    # 能读取进程常驻内存时记录峰值（包括共享进程池的工作进程）
+    monitor = TotalMemoryMonitor() if total_rss() is not None else contextlib.nullcontext()
+    start = time.perf_counter()
+    with monitor:
+        threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.perf_counter() - start
+
+    actions = recorder.summary()
+    scenarios = sum(completed)
+    return {
+        "sessions": concurrency,
+        "elapsed": elapsed,
+        "scenarios": scenarios,
+        "throughput": scenarios / elapsed,
+        "actions_per_second": sum(a["count"] for a in actions.values()) / elapsed,
+        "memory_peak_mb": monitor.peak / 1024 / 1024 if getattr(monitor, "peak", None) else None,
+        "actions": actions,
+    }
+
+def print_report(level):
+    memory = f"{level['memory_peak_mb']:.0f} MB" if level["memory_peak_mb"] else "无法获取"
+    print(f"\n=== 并发会话 {level['sessions']}：用时 {level['elapsed']:.1f} 秒，完成 {level['scenarios']} 轮，"
+          f"吞吐量 {level['throughput'] * 60:.1f} 轮/分钟（{level['actions_per_second']:.2f} 次操作/秒），"
+          f"内存峰值（含工作进程） {memory}")
+    print("各操作服务时间（不含等待其他会话脚本运行的排队时间）：")
+    print(f"{'操作':<8}{'次数':>6}{'p50(秒)':>10}{'p95(秒)':>10}{'最大(秒)':>10}{'排队p50':>10}{'失败':>6}")
+    for action in ACTIONS:
+        stats = level["actions"].get(action)
+        if stats:
+            print(f"{action:<8}{stats['count']:>8}{stats['p50']:>10.2f}{stats['p95']:>10.2f}{stats['max']:>10.2f}{stats['queued_p50']:>12.2f}{stats['errors']:>8}")
+
+def main():
+    """
+    并发会话压力测试：逐级增加同时使用的模拟用户数，测量各操作的延迟分位数、吞吐量和内存，用于估算服务器容量
+    """
+    parser = argparse.ArgumentParser(description="Word文档格式规范工具并发会话压力测试")
+    parser.add_argument("--sessions", default="1,2,4", help="逐级测试的并发会话数，逗号分隔")
+    parser.add_argument("--iterations", type=int, default=2, help="每个会话重复操作的轮数")
+    parser.add_argument("--paragraphs", type=int, default=40, help="合成文档的段落数")
+    parser.add_argument("--batch-files", type=int, default=3, help="每轮批量处理的文件数（0表示不测试批量处理）")
+    parser.add_argument("--ai-latency", default="lognormal:-1,0.5", help="模拟AI服务的响应延迟分布，格式同mock_ai_server.py")
+    parser.add_argument("--no-ai", action="store_true", help="不测试AI分析")
+    parser.add_argument("--timeout", type=float, default=120, help="单次操作的超时时间（秒）")
+    parser.add_argument("--json", help="把测试结果写入该JSON文件")
+    args = parser.parse_args()
+
+    # 配置、检索归档、批处理任务和处理结果都放在临时目录中，不影响本机的配置，测试结束后删除
+    temp_root = tempfile.mkdtemp(prefix="WordFormatter_load_")
+    os.environ["APPDATA"] = temp_root
+    tempfile.tempdir = temp_root
+
+    documents = [(f"稿件{i}.docx", make_sample_document(i, args.paragraphs)) for i in range(4)]
+    batch_documents = [(f"批量{i}.docx", make_sample_document(100 + i, args.paragraphs)) for i in range(args.batch_files)]
+
+    server = None
+    if not args.no_ai:
+        server = MockAIServer(port=0, latency=args.ai_latency, seed=0)
+        server.start()
+        print(f"模拟AI服务: {server.api_base}")
+
+    levels = []
+    try:
+        for concurrency in [int(n) for n in args.sessions.split(",") if n.strip()]:
+            level = run_level(concurrency, args.iterations, documents, batch_documents,
+                              server.api_base if server else None, args.timeout)
+            print_report(level)
+            levels.append(level)
+    finally:
+        if server is not None:
+            server.stop()
+        shutil.rmtree(temp_root, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(levels, f, ensure_ascii=False, indent=2)
+        print(f"\n测试结果已保存: {args.json}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
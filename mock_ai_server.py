@@ -0,0 +1,292 @@
+import json
+import time
+import random
+import argparse
+import threading
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+# 关键词分析请求的默认回复（与analyze_with_openai要求的JSON格式一致）
+DEFAULT_KEYWORDS = {
+    "title_keywords": ["举办", "开展", "组织", "召开", "举行", "宣讲会", "培训会", "竞赛"],
+    "image_keywords": ["主持人", "发言", "授课", "讲解", "展示", "合影", "志愿者"],
+    "redundant_keywords": ["发布人", "浏览数", "日期", "一审", "二审", "三审"],
+}
+
+# 聊天请求的默认回复
+DEFAULT_REPLY = "这是本地模拟AI服务的回复，用于离线测试和性能测量。"
+
+def parse_latency(spec, rng=random):
+    """
+    解析延迟分布，返回生成延迟秒数的函数。支持的格式：
+    fixed:0.5、uniform:0.1,0.8、normal:均值,标准差、lognormal:mu,sigma、
+    pareto:最小值,形状参数（长尾）
+    """
+    if not spec:
+        return lambda: 0.0
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",") if v.strip()] if args else []
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: rng.uniform(values[0], values[1])
+    if kind == "normal":
+        return lambda: max(0.0, rng.gauss(values[0], values[1]))
+    if kind == "lognormal":
+        return lambda: rng.lognormvariate(values[0], values[1])
+    if kind == "pareto":
+        return lambda: values[0] * rng.paretovariate(values[1])
+    raise ValueError(f"不支持的延迟分布: {spec}")
+
+def load_script(path):
+    """
+    读取脚本化回复：JSON列表，每项为字符串（按顺序循环使用）或
+    {"match": "请求中包含的文字", "content": "回复内容"}（按匹配规则回复）
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+class MockAIServer:
+    """
+    兼容chat-completions接口的本地模拟AI服务，支持流式响应、延迟分布和错误注入。
+    可以在命令行运行，也可以在测试代码中启动：start()返回api_base地址
+    """
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, latency=None, chunk_delay=0.02,
+                 error_rate=0.0, error_codes=(429, 500, 503), hang_rate=0.0, hang_seconds=300,
+                 script=None, chunk_chars=4, seed=None):
+        self.host = host
+        self.port = port
+        self.random = random.Random(seed)
+        self.latency = parse_latency(latency, self.random)
+        self.chunk_delay = chunk_delay
+        self.error_rate = error_rate
+        self.error_codes = list(error_codes)
+        self.hang_rate = hang_rate
+        self.hang_seconds = hang_seconds
+        self.script = script or []
+        self.chunk_chars = chunk_chars
+        self.stats = {"requests": 0, "streams": 0, "errors": 0, "hangs": 0, "latencies": []}
+        self._script_index = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def api_base(self):
+        return f"http://{self.host}:{self.port}/v1"
+
+    def reply_for(self, messages):
+        """
+        根据脚本和请求内容选择回复文本
+        """
+        prompt = "\n".join(str(m.get("content", "")) for m in messages)
+        for rule in self.script:
+            if isinstance(rule, dict) and rule.get("match", "") in prompt:
+                return rule["content"]
+        sequence = [rule for rule in self.script if isinstance(rule, str)]
+        if sequence:
+            with self._lock:
+                content = sequence[self._script_index % len(sequence)]
+                self._script_index += 1
+            return content
+        if "title_keywords" in prompt:
+            return json.dumps(DEFAULT_KEYWORDS, ensure_ascii=False)
+        return DEFAULT_REPLY
+
+    def plan_request(self):
+        """
+        为一次请求抽取故障和延迟，返回 (错误状态码或None, 是否挂起, 延迟秒数)
+        """
+        with self._lock:
+            self.stats["requests"] += 1
+            roll = self.random.random()
+            delay = self.latency()
+            self.stats["latencies"].append(round(delay, 4))
+        if roll < self.hang_rate:
+            return None, True, delay
+        if roll < self.hang_rate + self.error_rate:
+            return self.random.choice(self.error_codes), False, delay
+        return None, False, delay
+
+    def summary(self):
+        with self._lock:
+            latencies = sorted(self.stats["latencies"])
+            summary = {k: v for k, v in self.stats.items() if k != "latencies"}
+        if latencies:
+            summary["latency_p50"] = latencies[len(latencies) // 2]
+            summary["latency_p95"] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        return summary
+
+    def bind(self):
+        """
+        绑定监听端口；端口为0时自动分配空闲端口
+        """
+        if self._server is None:
+            self._server = ThreadingHTTPServer((self.host, self.port), self._handler_class())
+            self._server.daemon_threads = True
+            self.port = self._server.server_port
+        return self.api_base
+
+    def start(self):
+        """
+        在后台线程中启动服务，返回api_base地址
+        """
+        self.bind()
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self.api_base
+
+    def serve_forever(self):
+        self.bind()
+        self._server.serve_forever()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def _handler_class(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, status, payload):
+                body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                if status == 429:
+                    self.send_header("Retry-After", "1")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                path = self.path.rstrip("/")
+                if path.endswith("/models"):
+                    self._send_json(200, {"object": "list", "data": [{"id": "mock-model", "object": "model", "owned_by": "mock"}]})
+                elif path.endswith("/stats"):
+                    self._send_json(200, mock.summary())
+                else:
+                    self._send_json(404, {"error": {"message": f"未知路径: {self.path}"}})
+
+            def do_POST(self):
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    self._send_json(404, {"error": {"message": f"未知路径: {self.path}"}})
+                    return
+                length = int(self.headers.get("Content-Length", 0))
+                try:
+                    request = json.loads(self.rfile.read(length) or b"{}")
+                except ValueError:
+                    self._send_json(400, {"error": {"message": "请求体不是有效的JSON"}})
+                    return
+
+                error_status, hang, delay = mock.plan_request()
+                if hang:
+                    with mock._lock:
+                        mock.stats["hangs"] += 1
+                    time.sleep(mock.hang_seconds)
+                    return
+                time.sleep(delay)
+                if error_status:
+                    with mock._lock:
+                        mock.stats["errors"] += 1
+                    self._send_json(error_status, {"error": {"message": f"模拟错误 {error_status}", "type": "mock_error"}})
+                    return
+
+                content = mock.reply_for(request.get("messages", []))
+                model = request.get("model", "mock-model")
+                completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+                if request.get("stream"):
+                    with mock._lock:
+                        mock.stats["streams"] += 1
+                    self._stream(completion_id, model, content)
+                else:
+                    self._send_json(200, {
+                        "id": completion_id,
+                        "object": "chat.completion",
+                        "created": int(time.time()),
+                        "model": model,
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                        "usage": {"prompt_tokens": length // 3, "completion_tokens": len(content), "total_tokens": length // 3 + len(content)},
+                    })
+
+            def _stream(self, completion_id, model, content):
+                # 按SSE格式逐段发送，每段之间按chunk_delay间隔
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Cache-Control", "no-cache")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.close_connection = True
+
+                def event(delta, finish_reason=None):
+                    chunk = {
+                        "id": completion_id,
+                        "object": "chat.completion.chunk",
+                        "created": int(time.time()),
+                        "model": model,
+                        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+                    }
+                    self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+
+                try:
+                    event({"role": "assistant", "content": ""})
+                    for i in range(0, len(content), mock.chunk_chars):
+                        if i and mock.chunk_delay:
+                            time.sleep(mock.chunk_delay)
+                        event({"content": content[i:i + mock.chunk_chars]})
+                    event({}, "stop")
+                    self.wfile.write(b"data: [DONE]\n\n")
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # 客户端提前断开
+
+        return Handler
+
+def main():
+    """
+    启动本地模拟AI服务，在应用的「AI智能」设置中将API Base URL设为输出的地址即可离线测试
+    """
+    parser = argparse.ArgumentParser(description="本地模拟AI服务（兼容chat-completions接口）")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="监听地址")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="监听端口，0表示自动分配")
+    parser.add_argument("--latency", default=None,
+                        help="响应延迟分布，例如 fixed:0.5、uniform:0.1,0.8、lognormal:-1,0.5、pareto:0.2,2")
+    parser.add_argument("--chunk-delay", type=float, default=0.02, help="流式响应每段之间的间隔（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回错误的请求比例（0~1）")
+    parser.add_argument("--error-codes", default="429,500,503", help="注入的错误状态码，逗号分隔")
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="挂起不响应的请求比例（0~1），用于测试超时")
+    parser.add_argument("--script", default=None, help="脚本化回复的JSON文件")
+    parser.add_argument("--seed", type=int, default=None, help="随机种子，便于复现")
+    args = parser.parse_args()
+
+    server = MockAIServer(
+        host=args.host,
+        port=args.port,
+        latency=args.latency,
+        chunk_delay=args.chunk_delay,
+        error_rate=args.error_rate,
+        error_codes=[int(code) for code in args.error_codes.split(",") if code.strip()],
+        hang_rate=args.hang_rate,
+        script=load_script(args.script) if args.script else None,
+        seed=args.seed,
+    )
+    server.bind()
+    print(f"✅ 模拟AI服务已启动: {server.api_base}")
+    print(f"统计信息: {server.api_base}/stats")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"\n已停止，统计: {json.dumps(server.summary(), ensure_ascii=False)}")
+
+if __name__ == "__main__":
+    main()
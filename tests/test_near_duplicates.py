@@ -0,0 +1,34 @@
+import os
+import sys
+import random
+import shutil
+
+from docx import Document
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import WordFormatter_GUI as app
+from WordFormatter_cli import LocalFileUpload
+
+def make_article(path, paragraphs, seed=0):
+    rng = random.Random(seed)
+    doc = Document()
+    for i in range(paragraphs):
+        doc.add_paragraph(f"第{i}段" + "".join(chr(rng.randint(0x4E00, 0x9FA5)) for _ in range(30)) + "。")
+    doc.save(path)
+
+def test_identical_files_keep_first_copy_with_parallel_window(tmp_path):
+    # 两份相同的文件同时处理时，重复段落应全部记在后上传的文件上，结果与线程调度无关
+    for name in ("a.docx", "b.docx"):
+        make_article(tmp_path / name, 300)
+    files = [LocalFileUpload(str(tmp_path / name)) for name in ("a.docx", "b.docx")]
+    index = app.NearDuplicateIndex(drop=True)
+    
+    result = app.process_batch_files(files, [], [], "宋体", 12, True, near_duplicates=index, window=2)
+    try:
+        assert not result["errors"]
+        assert {record["文件"] for record in index.duplicates} == {"b.docx"}
+        assert len(index.duplicates) == index.indexed_counts["a.docx"] > 0
+        assert "b.docx" not in index.indexed_counts
+    finally:
+        shutil.rmtree(result["job_dir"], ignore_errors=True)